@@ -1,8 +1,8 @@
+import json
 import logging
 import os
 import random
 import string
-import threading
 from datetime import datetime
 from typing import List
 from utils import verify_signature
@@ -17,17 +17,24 @@ from flask_jwt_extended import JWTManager, jwt_required, create_access_token, ge
 
 from src import bot_state
 from src.agents import CodyCareAgent
-from src.analytics.analytics_scheduler import process_conversations
-from src.ats.scheduler import run_ats_on_recent_convs
+from src.background import run_in_background
 from src.bot import Bot
+from src.bot_executor import TurnExecutor, TurnRejected
+from src.bot_lease import ConversationLease
+from src.bot_state import StaleBotStateError
+from src.bot_stream_replay import StreamReplayBuffer, sse_frame
+from src.dx_mapping import DxMapping, json_array
 from src.followup.followup_care import FollowupCare
-from src.followup.followup_care_scheduler import process_followup_care
+from src.job_queue import JobQueue
 from src.rx.doctor_service import DoctorService
 from src.rx.doctor_service_state import DoctorServiceOfferEvent
+from src.rx.ehr_service import EhrService
 from src.specialist import Specialist
+from src.stats import get_stats
 from src.sub_specialist import SubSpecialtyDxGroup
 from src.user.users_account import update_user_verified
-from src.utils import refresh_view, MongoDBClient, base_url
+from src.utils import MongoDBClient, base_url
+from src.worker import register_jobs
 
 dotenv.load_dotenv()
 
@@ -66,8 +73,19 @@ valid_credentials_token_endpoint = {
     'social_app': 'social@123'
 }
 
+if os.getenv('ENSURE_INDEXES', 'false').lower() == 'true':
+    MongoDBClient.ensure_indexes()
+
+# Loads the Akute reference data before the first request needs it
+if os.getenv('AKUTE_BASE_URL'):
+    run_in_background(EhrService.warm_up)
+
+# Scheduled jobs run in the web workers, unless a dedicated worker (python -m src.worker) owns them.
+in_process_scheduler = os.getenv('IN_PROCESS_SCHEDULER', 'true').lower() == 'true'
+
 scheduler = BackgroundScheduler()
-scheduler.start()
+if in_process_scheduler:
+    scheduler.start()
 
 
 @application.route('/new_token', methods=['GET'])
@@ -116,7 +134,18 @@ def init():
         # The actual client IP is typically the first one in the list
         ip_address = request.headers['X-Forwarded-For'].split(',')[0].strip()
 
-    bot = Bot(username=current_user, profile=profile, ip_address=ip_address)
+    # Loading the bot may greet the user or resume a turn, which writes the conversation like a turn does.
+    lease = ConversationLease.acquire(current_user)
+    if lease is None:
+        return jsonify({'error': 'Another message of this conversation is being processed, please retry'}), 409
+
+    try:
+        bot = Bot(username=current_user, profile=profile, ip_address=ip_address)
+    except StaleBotStateError as e:
+        logging.error(f'Dropped the state of a concurrent init: {e}')
+        return jsonify({'error': 'The conversation was updated concurrently, please retry'}), 409
+    finally:
+        lease.release()
 
     conv_hist: List[dict] = bot.get_conv_hist()
 
@@ -152,14 +181,69 @@ def ask():
 
     current_user = get_jwt_identity()
 
-    bot = Bot(username=current_user,
-              profile=request.get_json().get('profile', {}),
-              ip_address=ip_address)
+    # The slot of the turn is reserved first, so that a request rejected under load costs nothing.
+    try:
+        reservation = TurnExecutor.get().reserve()
+    except TurnRejected as e:
+        return jsonify({'error': 'Too many requests, please retry', 'retry_after': e.retry_after}), 503, \
+            {'Retry-After': str(e.retry_after)}
 
-    if not input and bot.state.current_agent_name != CodyCareAgent.name:
-        return jsonify({'error': 'Input is required'}), 400
+    # Turns of a conversation run one at a time. A concurrent turn waits for the lease, and gives up after a while.
+    lease = ConversationLease.acquire(current_user)
+    if lease is None:
+        reservation.release()
+        return jsonify({'error': 'Another message of this conversation is being processed, please retry'}), 409
+
+    try:
+        bot = Bot(username=current_user,
+                  profile=request.get_json().get('profile', {}),
+                  ip_address=ip_address)
+
+        if not input and bot.state.current_agent_name != CodyCareAgent.name:
+            lease.release()
+            reservation.release()
+            return jsonify({'error': 'Input is required'}), 400
+
+        event_stream = 'text/event-stream' in request.headers.get('Accept', '')
+
+        # The lease is released by the turn, once it is done.
+        stream = bot.ask(input, event_stream=event_stream, lease=lease, reservation=reservation)
+    except StaleBotStateError as e:
+        lease.release()
+        reservation.release()
+        logging.error(f'Dropped the state of a concurrent turn: {e}')
+        return jsonify({'error': 'The conversation was updated concurrently, please retry'}), 409
+    except Exception:
+        lease.release()
+        reservation.release()
+        raise
+
+    return Response(stream, mimetype="text/event-stream")
+
+
+@application.route('/ask/stream', methods=['GET'])
+@jwt_required()
+def resume_ask():
+    """
+    Resumes the event stream of the latest /ask turn after a disconnect.
+    Chunks after Last-Event-ID are replayed, and the turn is followed until it completes.
+    """
+    current_user = get_jwt_identity()
+
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+
+    replay = StreamReplayBuffer.get()
+
+    if replay.latest_turn(current_user) is None:
+        return jsonify({'error': 'No stream to resume'}), 404
+
+    if not replay.can_resume(current_user, last_event_id):
+        # Some of the missed chunks were dropped from the replay buffer.
+        return jsonify({'error': 'Stream can no longer be resumed, reload the conversation', 'reset': True}), 410
 
-    return Response(bot.ask(input), mimetype="text/event-stream")
+    events = (sse_frame(data, event_id=event_id) for event_id, data in replay.replay(current_user, last_event_id))
+
+    return Response(events, mimetype="text/event-stream")
 
 
 @application.route('/admin/grade/<userid>', methods=['GET'])
@@ -170,7 +254,7 @@ def grading_history(userid: str):
         logging.warning(f'Unauthorized access to grading endpoint by {auth}')
         return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
-    bot = Bot(username=userid)
+    bot = Bot(username=userid, read_only=True)
     conv_hist: List[dict] = bot.get_conv_hist()
 
     return jsonify({
@@ -179,6 +263,17 @@ def grading_history(userid: str):
     }), 200
 
 
+@application.route('/admin/turns', methods=['GET'])
+def turn_gauges():
+    auth = request.authorization
+    if (not auth or auth.username not in valid_credentials_grading_endpoint
+            or valid_credentials_grading_endpoint[auth.username] != auth.password):
+        logging.warning(f'Unauthorized access to grading endpoint by {auth}')
+        return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    return jsonify(TurnExecutor.get().gauges()), 200
+
+
 @application.route('/admin/supported/specialist', methods=['GET'])
 def supported_specialist():
     auth = request.authorization
@@ -203,25 +298,26 @@ def get_llm_mapping():
         logging.warning(f'Unauthorized access to grading endpoint by {auth}')
         return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
-    records = MongoDBClient.get_dx_mapping().find({}).sort('created', -1)
+    bookmark = request.args.get('bookmark')
+    query = DxMapping.query(source=request.args.get('source'), dx_group=request.args.get('dx_group'),
+                            bookmark=None if bookmark is None else bookmark.lower() == 'true')
 
-    response = list[dict]()
+    if request.args.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        # Full export, streamed a mapping per line
+        lines = (json.dumps(mapping) + '\n' for mapping in DxMapping.export(query))
+        return Response(lines, mimetype='application/x-ndjson')
 
-    for record in records:
-        source_ = {
-            'diagnosis': record['diagnosis'],
-            'dx_group': record['dx_group'],
-            'specialist': record['specialist'],
-            'created': record['created'],
-            'source': record['source']
-        }
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        # Former unpaginated response, streamed as a JSON array
+        return Response(json_array(DxMapping.export(query)), mimetype='application/json')
 
-        if record.get('bookmark'):
-            source_['bookmark'] = record['bookmark']
-
-        response.append(source_)
+    try:
+        limit = min(max(int(request.args.get('limit', DxMapping.DEFAULT_PAGE_SIZE)), 1), DxMapping.MAX_PAGE_SIZE)
+        mappings, next_cursor = DxMapping.page(query, limit=limit, cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    return jsonify(response), 200
+    return jsonify({'mappings': mappings, 'next_cursor': next_cursor}), 200
 
 
 @application.route('/admin/mapping/update', methods=['POST'])
@@ -237,23 +333,48 @@ def update_llm_mapping():
     if data is None:
         return jsonify({'error': 'Input is required'}), 400
 
-    update_dict = {
-        'dx_group': data['dx_group'],
-        'specialist': data['specialist'],
-        'updated': datetime.now().isoformat(),
-    }
+    MongoDBClient.get_dx_mapping().bulk_write([DxMapping.update_operation(data, datetime.now())])
+    DxMapping.invalidate()
+
+    return jsonify({'message': 'success'}), 200
+
+
+@application.route('/admin/mapping/bulk', methods=['POST'])
+def bulk_update_llm_mapping():
+    """
+    Applies a JSON array, or NDJSON body, of mapping edits, and returns the result of every edit.
+    """
+    auth = request.authorization
+    if (not auth or auth.username not in valid_credentials_grading_endpoint
+            or valid_credentials_grading_endpoint[auth.username] != auth.password):
+        logging.warning(f'Unauthorized access to grading endpoint by {auth}')
+        return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
-    # we don't want to change source if bookmark is updated
-    if data.get('bookmark') is not None:
-        update_dict['bookmark'] = data['bookmark']
+    if request.mimetype == 'application/x-ndjson':
+        edits = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                edits.append(json.loads(line))
+            except json.JSONDecodeError:
+                return jsonify({'error': f'Invalid JSON on line {number}'}), 400
     else:
-        update_dict['source'] = 'admin'
+        edits = request.get_json(silent=True)
 
-    MongoDBClient.get_dx_mapping().update_one(filter={'diagnosis': data['diagnosis']},
-                                              update={'$set': update_dict},
-                                              upsert=True)
+    if not isinstance(edits, list) or len(edits) == 0:
+        return jsonify({'error': 'A JSON array or NDJSON body of mapping edits is required'}), 400
 
-    return jsonify({'message': 'success'}), 200
+    if len(edits) > DxMapping.MAX_BULK_EDITS:
+        return jsonify({'error': f'At most {DxMapping.MAX_BULK_EDITS} edits per request'}), 413
+
+    results = DxMapping.bulk_update(edits)
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+
+    return jsonify({'counts': counts, 'results': results}), 200
 
 
 @application.route('/ask/meta', methods=['GET'])
@@ -261,7 +382,7 @@ def update_llm_mapping():
 def convo_meta():
     current_user = get_jwt_identity()
 
-    bot = Bot(username=current_user)
+    bot = Bot(username=current_user, read_only=True)
 
     meta_ = {
         'serving_agent_name': bot.state.current_agent_name,
@@ -290,11 +411,7 @@ def convo_meta():
 @application.route('/stats', methods=['GET'])
 @jwt_required()
 def stats():
-    stats_data = MongoDBClient.get_stats().find_one({})
-
-    return jsonify({
-        'dxCount': stats_data['dxCount'],
-    }), 200
+    return jsonify(get_stats()), 200
 
 
 @application.route('/care/optout', methods=['GET'])
@@ -310,10 +427,8 @@ def care_opt_out():
     return jsonify({'message': 'Opted out successfully'}), 200
 
 
-scheduler.add_job(refresh_view, 'interval', hours=6, max_instances=1)
-scheduler.add_job(run_ats_on_recent_convs, 'interval', hours=1, max_instances=1)
-scheduler.add_job(process_followup_care, 'interval', hours=1, max_instances=1)
-scheduler.add_job(process_conversations, 'interval', hours=1, max_instances=1)
+if in_process_scheduler:
+    register_jobs(scheduler)
 
 
 @application.route('/', methods=['GET'])
@@ -449,8 +564,7 @@ def akute_webhook():
         'ehr_task': akute_task
     })
 
-    threading.Thread(target=DoctorService.process_for_certified_plan,
-                     args=(event.offer_id,)).start()
+    DoctorService.enqueue_for_certified_plan(event.offer_id)
 
     return jsonify({'message': 'success'}), 200
 
@@ -572,6 +686,35 @@ def process_offer(offer: str):
     return jsonify({'error': f'Ineligible for processing. Latest event: {latest_event.event}'}), 400
 
 
+@application.route('/admin/jobs', methods=['GET'])
+def job_queue_status():
+    auth = request.authorization
+    if (not auth or auth.username not in valid_credentials_grading_endpoint
+            or valid_credentials_grading_endpoint[auth.username] != auth.password):
+        logging.warning(f'Unauthorized access to job queue endpoint by {auth}')
+        return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    dead = MongoDBClient.get_jobs().find({'status': JobQueue.DEAD},
+                                         projection={'type': 1, 'key': 1, 'attempts': 1, 'last_error': 1,
+                                                     'created': 1}).sort('created', -1).limit(100)
+
+    return jsonify({'counts': JobQueue.stats(), 'dead': list(dead)}), 200
+
+
+@application.route('/admin/jobs/<job_id>/retry', methods=['POST'])
+def retry_job(job_id: str):
+    auth = request.authorization
+    if (not auth or auth.username not in valid_credentials_grading_endpoint
+            or valid_credentials_grading_endpoint[auth.username] != auth.password):
+        logging.warning(f'Unauthorized access to job queue endpoint by {auth}')
+        return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+    if not JobQueue.retry(job_id):
+        return jsonify({'error': f'No dead job {job_id}'}), 404
+
+    return jsonify({'message': 'success'}), 200
+
+
 if __name__ == '__main__':
     # Remove handlers in logger for debug runs
     logging.getLogger().removeHandler(logging.getLogger().handlers[0])
@@ -0,0 +1,11 @@
+import logging
+
+import dotenv
+
+from src.utils import MongoDBClient
+
+logging.getLogger().setLevel(logging.INFO)
+
+if __name__ == '__main__':
+    dotenv.load_dotenv()
+    MongoDBClient.ensure_indexes()
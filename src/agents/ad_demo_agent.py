@@ -15,7 +15,6 @@ class AdDemoAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None) -> None:
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         if self.state.last_human_input.lower().strip() in ['concierge', 'options']:
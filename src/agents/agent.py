@@ -11,3 +11,12 @@ class Agent(ABC):
     @abstractmethod
     def act(self) -> bool:
         pass
+
+    @property
+    def conv_hist(self) -> list:
+        # Looked up on use, so that the stored messages of an agent are only converted once it is used
+        return self.state.conv_hist[self.name]
+
+    @conv_hist.setter
+    def conv_hist(self, conv_hist: list) -> None:
+        self.state.conv_hist[self.name] = conv_hist
@@ -11,7 +11,6 @@ class ChiefComplaintAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         self._identify_chief_complaint_from_nav_agent()
@@ -1,5 +1,4 @@
 import os
-import threading
 
 import phonenumbers
 import stripe
@@ -30,7 +29,6 @@ class CodyCareAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None) -> None:
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
         self.profile = profile
 
     def act(self) -> bool:
@@ -267,11 +265,10 @@ You’ve been matched to your Doctor.
                                   DoctorServiceOfferEvent.SEND_TO_EHR,
                                   {})
 
-            EmailSender().send_cody_care_confirmation(CodyCareConfirmationEmailParameters(
+            EmailSender(outbox=True).send_cody_care_confirmation(CodyCareConfirmationEmailParameters(
                 name=self.state.patient_name, email_address=latest_state.user_id))
 
-            threading.Thread(target=DoctorService.process_for_ehr,
-                             args=(latest_state.offer_id,)).start()
+            DoctorService.enqueue_for_ehr(latest_state.offer_id)
 
         elif (latest_state.event == DoctorServiceOfferEvent.SEND_TO_EHR or
               latest_state.event == DoctorServiceOfferEvent.EHR_SENT):
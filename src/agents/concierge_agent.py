@@ -50,7 +50,6 @@ class ConciergeAgent(agents.Agent):
         self.state = state
         self.llm = llm
         self.profile = profile
-        self.conv_hist = self.state.conv_hist[self.name]
         assert OPTIONS_CALLABLE.keys() == OPTIONS_STR.keys(), \
             "Please add the same keys in both OPTIONS_CALLABLE and OPTIONS_STR, in the same order"
 
@@ -12,6 +12,7 @@ from src import agents
 from src.ad.provider import Provider
 from src.bot_state import BotState
 from src.bot_stream_llm import StreamChatOpenAI, CustomChatOpenAI
+from src.dx_mapping import DxMapping
 from src.followup.followup_care import FollowupCare
 from src.followup.followup_care_scheduler import send_test_email
 from src.specialist import Specialist
@@ -46,7 +47,6 @@ class DiagnosisAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
         self.profile = profile if profile else {}
 
     def act(self) -> bool:
@@ -237,7 +237,7 @@ Do not add anything after the 3 Diagnosis List. Your task is to list out the thr
     @staticmethod
     def _categorize_via_llm(convo_id: str, diag: str, specialist: Specialist) -> SubSpecialtyDxGroup:
 
-        dx_mapping = MongoDBClient.get_dx_mapping().find_one({'diagnosis': diag})
+        dx_mapping = DxMapping.find(diag)
 
         if dx_mapping is not None:
             logging.info(f'LLM identified diagnosis group for diagnosis {diag} found in database. Skipping calling '
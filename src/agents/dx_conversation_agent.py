@@ -18,7 +18,6 @@ class DxConversationAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         if len(self.conv_hist) == 0:
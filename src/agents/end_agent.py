@@ -11,7 +11,6 @@ class EndAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None) -> None:
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         if len(self.conv_hist) == 0:
@@ -17,7 +17,6 @@ class ExistingDiagnosisAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None) -> None:
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         self._extract_disease_name()
@@ -40,7 +40,6 @@ class FindCareAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None) -> None:
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
         self.profile = profile
 
     def act(self) -> bool:
@@ -89,7 +88,8 @@ And more…
                                                                             dx_name=self.state.existing_dx, tx_plan='',
                                                                             username=self.state.username,
                                                                             errors=self.state.errors_care,
-                                                                            specialist=self.state.specialist)
+                                                                            specialist=self.state.specialist,
+                                                                            location=self.state.location)
 
             self.conv_hist.append(AIMessage(content=msg))
             self.llm.stream_callback.on_llm_new_token(
@@ -152,7 +152,8 @@ Please let me know your address to find the best doctor nearest you."""))
                 self.state.address = arguments['address']
                 tx_plan = self.state.treatment_plans.get(str(self.state.treatment_plans_seen[-1]))
                 msg, has_search_result = self._lookup_find_care(self.state.address, dx_name, tx_plan, self.state.username,
-                                                                errors=self.state.errors_care, specialist=self.state.specialist)
+                                                                errors=self.state.errors_care, specialist=self.state.specialist,
+                                                                location=self.state.location)
 
                 self.conv_hist.append(AIMessage(content=msg))
                 self.llm.stream_callback.on_llm_new_token(
@@ -173,7 +174,8 @@ Please let me know your address to find the best doctor nearest you."""))
                     return False
 
     @staticmethod
-    def _lookup_find_care(address_, dx_name, tx_plan, username, errors:list[str], specialist:Specialist) -> tuple[str, bool]:
+    def _lookup_find_care(address_, dx_name, tx_plan, username, errors:list[str], specialist:Specialist,
+                          location: dict = None) -> tuple[str, bool]:
         search_result = True
         # Striping out abbreviation if DX has one
         dx_name = dx_name.split('(')[0].strip()
@@ -200,19 +202,14 @@ Please let me know your address to find the best doctor nearest you."""))
             search_terms.append(specialist.inventory_name.lower())
         search_terms.append(dx_name.lower())
         search_terms.append('near ' + address_)
-        search = CareSearch(search_terms=search_terms)
+        search = CareSearch(search_terms=search_terms, location=location)
         try:
             logging.info(f'Finding care for convo id {username} with search terms {search_terms}')
-            msg = agents.FindCareAgent.care_provider_renderer.render(search)
-
             # Google search api behaves weirdly when specialist is passed together with primary care.
-            # So we first try to find care with specialist and then with primary care.
-            if msg == "":
-                logging.info(
-                    f'Falling back to primary care for convo id {username} with search terms {dx_name.lower()}')
-                msg = agents.FindCareAgent.care_provider_renderer.render(
-                    CareSearch(search_terms=[dx_name.lower(), 'doctor', 'near ' + address_])
-                    if address_ else CareSearch(search_terms=[dx_name.lower(), 'doctor']))
+            # So we search for the specialist and the primary care together, and prefer the specialist results.
+            fallback = CareSearch(search_terms=[dx_name.lower(), 'doctor', 'near ' + address_], location=location) \
+                if address_ else CareSearch(search_terms=[dx_name.lower(), 'doctor'], location=location)
+            msg = agents.FindCareAgent.care_provider_renderer.render(search, fallback=fallback)
 
         except Exception as e:
             logging.error(f'Unable to find care for convo id {username} with message {str(e)}',
@@ -19,7 +19,6 @@ class FollowupAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
         self.profile = profile
 
         # We use these to reset the state in case of exceptions like timeout.
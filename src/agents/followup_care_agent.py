@@ -16,7 +16,6 @@ class FollowupCareAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]            
 
     def act(self) -> bool:
         # If the conversation history is not empty, add the last human input to the conversation history
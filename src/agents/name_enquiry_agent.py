@@ -11,7 +11,6 @@ class NameEnquiryAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         # check if patient name is already captured, then just greet patient and call next agent
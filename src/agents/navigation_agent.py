@@ -45,14 +45,13 @@ class NavigationAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
         self.tools = [
             CaptureIntentTool()
         ]
-        if len(self.conv_hist) == 0 \
-                and len(self.state.conv_hist[agents.ChiefComplaintAgent.name]) == 0 \
-                and len(self.state.conv_hist[agents.QuestionAgent.name]) == 0 \
-                and len(self.state.conv_hist[agents.ExistingDiagnosisAgent.name]) == 0:
+        if self.state.count_messages(self.name) == 0 \
+                and self.state.count_messages(agents.ChiefComplaintAgent.name) == 0 \
+                and self.state.count_messages(agents.QuestionAgent.name) == 0 \
+                and self.state.count_messages(agents.ExistingDiagnosisAgent.name) == 0:
 
             care_state = FollowupCare.get_latest_followup_care_state(profile)
             if care_state and care_state.is_followup_eligible() and care_state.state != FollowupState.NEW:
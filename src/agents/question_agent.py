@@ -31,7 +31,6 @@ class QuestionAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None) -> None:
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
         self.tools = [
             CaptureFeedbackTool()
         ]
@@ -17,7 +17,6 @@ class RouterAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def _categorize(self, schema: dict) -> str:
         system_prompt = textwrap.dedent(
@@ -46,7 +46,6 @@ class TreatmentAgent(agents.Agent):
     def __init__(self, state: BotState, llm: StreamChatOpenAI, profile: dict = None):
         self.state = state
         self.llm = llm
-        self.conv_hist = self.state.conv_hist[self.name]
 
     def act(self) -> bool:
         # Checking if the flow comes from the existing diagnosis agent.
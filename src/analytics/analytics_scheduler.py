@@ -2,39 +2,105 @@ import logging
 import os
 from datetime import datetime, timedelta
 
-from geopy import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-from pydantic import ValidationError
+from pymongo import UpdateOne
 
 from src.agents import FindCareAgent, EndAgent, FeedbackAgent, TxConversationAgent, TreatmentAgent, \
     DxConversationAgent, DiagnosisAgent, ExistingDiagnosisAgent, QuestionAgent
-from src.bot_state import BotState
-from src.followup.followup_care_state import FollowUpCareState
-from src.user.users_account import find_user_session
+from src.analytics.reverse_geocoder import ReverseGeocoder
+from src.specialist import Specialist
 from src.utils import MongoDBClient
 
+reverse_geocoder = ReverseGeocoder()
 
-def _farthest_agent_reached(state) -> str:
-    agent_name = state.current_agent_name if state.current_agent_name and state.current_agent_name != '' else state.agent_names[state.current_agent_index],
+BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', '500'))
+
+# Agents checked for the farthest agent reached, from the farthest one.
+FARTHEST_AGENTS = [FindCareAgent.name, TxConversationAgent.name, TreatmentAgent.name, DxConversationAgent.name,
+                   DiagnosisAgent.name, ExistingDiagnosisAgent.name, QuestionAgent.name]
+
+# Only the fields analytics are extracted from. Of the conversation histories, only the roles are needed.
+PROJECTION = {
+    'username': 1,
+    'created': 1,
+    'current_agent_name': 1,
+    'current_agent_index': 1,
+    'agent_names': 1,
+    'chief_complaint': 1,
+    'address': 1,
+    'location': 1,
+    'specialist': 1,
+    'diagnosis_list': 1,
+    **{f'conv_hist.{agent_name}.role': 1 for agent_name in FARTHEST_AGENTS},
+}
+
+
+def _agent_reached(record: dict) -> str:
+    if record.get('current_agent_name'):
+        return record['current_agent_name']
+    return record['agent_names'][record.get('current_agent_index', 0)]
+
+
+def _farthest_agent_reached(record: dict) -> str:
+    agent_name = _agent_reached(record)
 
     if agent_name in [EndAgent.name, FeedbackAgent.name]:
         return agent_name
-    elif len(state.conv_hist.get(FindCareAgent.name, [])) > 0 or agent_name == FindCareAgent.name:
-        return FindCareAgent.name
-    elif len(state.conv_hist.get(TxConversationAgent.name, [])) > 0 or agent_name == TxConversationAgent.name:
-        return TxConversationAgent.name
-    elif len(state.conv_hist.get(TreatmentAgent.name, [])) > 0 or agent_name == TreatmentAgent.name:
-        return TreatmentAgent.name
-    elif len(state.conv_hist.get(DxConversationAgent.name, [])) > 0 or agent_name == DxConversationAgent.name:
-        return DxConversationAgent.name
-    elif len(state.conv_hist.get(DiagnosisAgent.name, [])) > 0 or agent_name == DiagnosisAgent.name:
-        return DiagnosisAgent.name
-    elif len(state.conv_hist.get(ExistingDiagnosisAgent.name, [])) > 0 or agent_name == ExistingDiagnosisAgent.name:
-        return ExistingDiagnosisAgent.name
-    elif len(state.conv_hist.get(QuestionAgent.name, [])) > 0 or agent_name == QuestionAgent.name:
-        return QuestionAgent.name
-    else:
-        return agent_name
+
+    conv_hist = record.get('conv_hist', {})
+    for farthest_agent in FARTHEST_AGENTS:
+        if len(conv_hist.get(farthest_agent, [])) > 0 or agent_name == farthest_agent:
+            return farthest_agent
+
+    return agent_name
+
+
+def _claim_batch(limit: int) -> list[dict]:
+    yesterday = datetime.today() - timedelta(days=1)
+    records = list(MongoDBClient.get_botstate().find(
+        filter={
+            'analytics_state': {'$ne': 'PROCESSED'},
+            'created': {'$lte': yesterday.isoformat()}
+        },
+        projection=PROJECTION).limit(limit))
+
+    if len(records) > 0:
+        MongoDBClient.get_botstate().update_many({'_id': {'$in': [record['_id'] for record in records]}},
+                                                 {'$set': {'analytics_state': 'PROCESSED'}})
+    return records
+
+
+def _extract_analytics(record: dict, user_session: dict, followup: dict) -> dict:
+    analytics = {
+        'updated': datetime.now().isoformat(),
+        'convo_created': record.get('created'),
+        'agent_reached': _agent_reached(record),
+        'farthest_agent_reached': _farthest_agent_reached(record),
+        'user_id': user_session['userName'] if user_session else '',
+        'chief_complaint': record.get('chief_complaint'),
+        'find_care_address': record.get('address'),
+        'location': record.get('location'),
+        'specialist': Specialist.from_inventory_name(record['specialist']).inventory_name
+        if record.get('specialist') else Specialist.Generalist.inventory_name,
+        'find_care_used': any(message.get('role') == 'function'
+                              for message in record.get('conv_hist', {}).get(FindCareAgent.name, [])),
+    }
+
+    for i, dx in enumerate(record.get('diagnosis_list') or []):
+        analytics[f'dx_{i + 1}'] = dx
+
+    if followup and followup.get('last_followup_outcome'):
+        analytics['last_followup_outcome'] = followup['last_followup_outcome']
+
+    location = record.get('location')
+    if location:
+        city, state, country, country_code = get_location_by_coordinates(location['coordinates'][1],
+                                                                         location['coordinates'][0])
+        analytics['city'] = city
+        analytics['state'] = state
+        analytics['country'] = country
+        analytics['country_code'] = country_code.upper()
+
+    return analytics
 
 
 def process_conversations():
@@ -44,82 +110,47 @@ def process_conversations():
         logging.info(f'Not processing analytics in {os.getenv("ENVIRONMENT", "dev")} environment.')
         return
 
-    for _ in range(50):
-        yesterday = datetime.today() - timedelta(days=1)
-
-        record = MongoDBClient.get_botstate().find_one_and_update(
-            filter={
-                'analytics_state': {'$ne': 'PROCESSED'},
-                'created': {'$lte': yesterday.isoformat()}
-            },
-            update={'$set': {'analytics_state': 'PROCESSED'}},
-            return_document=True)
+    while True:
+        records = _claim_batch(BATCH_SIZE)
 
-        if record is None:
+        if len(records) == 0:
             logging.info('No more conversations to process. Exiting.')
             break
 
-        try:
-            state = BotState(username=record['username'])
-        except ValidationError as e:
-            logging.warning(
-                f'Error processing conversation {record["username"]}. Probably bot state is not compatible.',
-                exc_info=e)
-            continue
-
-        # TODO more fields and data to be extracted. This is just a start
-
-        # check if convo belongs to a user session
-        user_session = find_user_session(record['username'])
-
-        analytics = {
-            'updated': datetime.now().isoformat(),
-            'convo_created': state.created,
-            'agent_reached': state.current_agent_name if state.current_agent_name and state.current_agent_name != '' else state.agent_names[state.current_agent_index],
-            'farthest_agent_reached': _farthest_agent_reached(state),
-            'user_id': user_session['userName'] if user_session else '',
-            'chief_complaint': state.chief_complaint,
-            'find_care_address': state.address,
-            'location': state.location,
-            'specialist': state.specialist.inventory_name,
-            'find_care_used':  any(message.type == 'function' for message in state.conv_hist.get(FindCareAgent.name, [])),
-        }
-
-        for i, dx in enumerate(state.diagnosis_list):
-            analytics[f'dx_{i + 1}'] = dx
-
-        care_state = FollowUpCareState(convo_id=state.username)
-
-        if care_state.last_followup_outcome:
-            analytics['last_followup_outcome'] = care_state.last_followup_outcome
-
-        if state.location:
-            city, state, country, country_code = get_location_by_coordinates(state.location['coordinates'][1],
-                                                                             state.location['coordinates'][0])
-            analytics['city'] = city
-            analytics['state'] = state
-            analytics['country'] = country
-            analytics['country_code'] = country_code.upper()
-
-        MongoDBClient.get_convo_analytics().update_one(
-            filter={'convo_id': record['username']},
-            update={'$set': analytics,
-                    '$setOnInsert': {
-                        'created': datetime.now().isoformat()
-                    }
-                    },
-            upsert=True)
+        convo_ids = [record['username'] for record in records]
+
+        # One query per batch for the user sessions and followups of all the conversations
+        user_sessions = {session['ai_session']: session for session in
+                         MongoDBClient.get_sessions().find({'ai_session': {'$in': convo_ids}},
+                                                           projection={'ai_session': 1, 'userName': 1})}
+        followups = {followup['convo_id']: followup for followup in
+                     MongoDBClient.get_followup_care().find({'convo_id': {'$in': convo_ids}},
+                                                            projection={'convo_id': 1, 'last_followup_outcome': 1})}
+
+        operations = []
+        for record in records:
+            convo_id = record['username']
+            try:
+                analytics = _extract_analytics(record, user_sessions.get(convo_id), followups.get(convo_id))
+            except Exception as e:
+                logging.warning(f'Error processing conversation {convo_id}. Probably bot state is not compatible.',
+                                exc_info=e)
+                continue
+
+            operations.append(UpdateOne(filter={'convo_id': convo_id},
+                                        update={'$set': analytics,
+                                                '$setOnInsert': {
+                                                    'created': datetime.now().isoformat()
+                                                }},
+                                        upsert=True))
+
+        if len(operations) > 0:
+            MongoDBClient.get_convo_analytics().bulk_write(operations, ordered=False)
+
+        logging.info(f'Extracted analytics of {len(operations)} conversations')
 
 
 def get_location_by_coordinates(lat, lon) -> tuple:
-    geolocator = Nominatim(user_agent="cody_reverse_geocode")
-    geocode = RateLimiter(geolocator.reverse, min_delay_seconds=1)  # adding 1 second padding between calls
-    location = geocode([lat, lon])
-    address = location.raw['address']
-    city = address.get('city', '')
-    state = address.get('state', '')
-    country = address.get('country', '')
-    country_code = address.get('country_code', '')
-    return city, state, country, country_code
+    return reverse_geocoder.reverse(lat, lon)
 
 # process_conversations()
@@ -0,0 +1,150 @@
+import json
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+from typing import Optional
+
+import cachetools
+
+from src.utils import haversine_km, KM_PER_DEGREE
+
+# City, state, country and country code of a coordinate. Unknown parts are empty strings.
+Place = tuple[str, str, str, str]
+
+UNKNOWN_PLACE: Place = ('', '', '', '')
+
+
+class OfflineGazetteer:
+    """
+    Offline reverse geocoder backed by a local dataset of populated places.
+
+    The dataset is a JSON list of places, each with name, admin1 (the state or region), country, country_code,
+    latitude and longitude, e.g. as extracted from the GeoNames cities dump. It is loaded once into a grid based
+    spatial index, so a lookup only visits the cells around the coordinate.
+    """
+
+    # Size of a spatial grid cell in degrees
+    CELL_SIZE = 1.0
+
+    def __init__(self, dataset_path: str = None, max_distance_km: float = 100.0):
+        self.dataset_path = dataset_path or os.getenv('GAZETTEER_PATH')
+        self.max_distance_km = max_distance_km
+        self.places: list[dict] = []
+        self.grid: dict[tuple[int, int], list[int]] = defaultdict(list)
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+
+            if self.dataset_path is None or not os.path.exists(self.dataset_path):
+                logging.warning(f'Gazetteer dataset not found at {self.dataset_path}')
+                self._loaded = True
+                return
+
+            with open(self.dataset_path, 'r', encoding='utf-8') as file:
+                places = json.load(file)
+
+            for place in places:
+                self.add(place)
+
+            logging.info(f'Loaded {len(self.places)} places into the gazetteer')
+            self._loaded = True
+
+    def add(self, place: dict):
+        index = len(self.places)
+        self.places.append(place)
+        self.grid[self._cell(place['latitude'], place['longitude'])].append(index)
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.CELL_SIZE), math.floor(lon / self.CELL_SIZE)
+
+    def nearest(self, lat: float, lon: float) -> Optional[dict]:
+        """
+        The place nearest to the coordinate within max_distance_km, if any.
+        """
+        self._load()
+
+        lat_rings = math.ceil(self.max_distance_km / (KM_PER_DEGREE * self.CELL_SIZE))
+        lon_km_per_degree = max(KM_PER_DEGREE * math.cos(math.radians(lat)), 1.0)
+        lon_rings = math.ceil(self.max_distance_km / (lon_km_per_degree * self.CELL_SIZE))
+
+        cell_lat, cell_lon = self._cell(lat, lon)
+        best, best_distance = None, self.max_distance_km
+        for i in range(cell_lat - lat_rings, cell_lat + lat_rings + 1):
+            for j in range(cell_lon - lon_rings, cell_lon + lon_rings + 1):
+                for index in self.grid.get((i, j), []):
+                    place = self.places[index]
+                    distance = haversine_km(lat, lon, place['latitude'], place['longitude'])
+                    if distance <= best_distance:
+                        best, best_distance = place, distance
+
+        return best
+
+
+class ReverseGeocoder:
+    """
+    Resolves coordinates to a place, through a cache keyed by the coordinate rounded to PRECISION decimals
+    (about a kilometer), then the offline gazetteer. Nominatim, rate limited to a call per second, is asked when the
+    gazetteer has no place nearby, if GEOCODE_NOMINATIM_FALLBACK is enabled. It is by default when no gazetteer
+    dataset is configured, as nothing would resolve otherwise. Nominatim errors are not cached, so that the
+    coordinate is retried by the next run.
+    """
+
+    PRECISION = 2
+
+    def __init__(self, gazetteer: OfflineGazetteer = None, nominatim_fallback: bool = None, cache_size: int = 100_000):
+        self.gazetteer = gazetteer or OfflineGazetteer()
+        if nominatim_fallback is None:
+            default = 'false' if self.gazetteer.dataset_path else 'true'
+            nominatim_fallback = os.getenv('GEOCODE_NOMINATIM_FALLBACK', default).lower() == 'true'
+        self.nominatim_fallback = nominatim_fallback
+        self.cache = cachetools.LRUCache(maxsize=cache_size)
+        self._nominatim = None
+
+    def reverse(self, lat: float, lon: float) -> Place:
+        key = (round(lat, self.PRECISION), round(lon, self.PRECISION))
+        place = self.cache.get(key)
+        if place is None:
+            place = self._resolve(lat, lon)
+            if place is None:
+                return UNKNOWN_PLACE
+            self.cache[key] = place
+        return place
+
+    def _resolve(self, lat: float, lon: float) -> Optional[Place]:
+        """
+        The place of the coordinate, or None if it could not be resolved for now.
+        """
+        place = self.gazetteer.nearest(lat, lon)
+        if place is not None:
+            return place['name'], place.get('admin1', ''), place.get('country', ''), place.get('country_code', '')
+
+        if self.nominatim_fallback:
+            try:
+                return self._reverse_nominatim(lat, lon)
+            except Exception as e:
+                logging.warning(f'Error reverse geocoding {lat}, {lon} with Nominatim', exc_info=e)
+                return None
+
+        return UNKNOWN_PLACE
+
+    def _reverse_nominatim(self, lat: float, lon: float) -> Place:
+        from geopy import Nominatim
+        from geopy.extra.rate_limiter import RateLimiter
+
+        if self._nominatim is None:
+            geolocator = Nominatim(user_agent="cody_reverse_geocode")
+            self._nominatim = RateLimiter(geolocator.reverse, min_delay_seconds=1)  # adding 1 second padding between calls
+
+        location = self._nominatim([lat, lon])
+        if location is None:
+            return UNKNOWN_PLACE
+
+        address = location.raw['address']
+        return address.get('city', ''), address.get('state', ''), address.get('country', ''), \
+            address.get('country_code', '')
@@ -1,48 +1,175 @@
+"""
+Batch runner of ATS over all conversations with a magic minute summary.
+
+A run resumes from a watermark on the conversation created date, kept in the job_watermarks collection. It pages
+through the conversations created since then (minus a lookback, for conversations which reach the magic minute
+after the run saw them), skips those already scored with an anti-join against the ATS collection, scores a page
+with at most ATS_CONCURRENCY LLM calls in flight, and upserts the scores of the page with a single bulk write.
+
+The watermark moves past conversations which failed to score, or whose specialist is not supported yet. They are
+kept in a retry list of the watermark instead, and retried at the start of every run, whatever their created date,
+until they are scored or fail ATS_MAX_ATTEMPTS times.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import UpdateOne
+
+from src.agents.utils import get_supported_sps
 from src.ats.runner import ats_run
 from src.specialist import Specialist
 from src.sub_specialist import SubSpecialtyDxGroup
 from src.utils import MongoDBClient
-from src.agents.utils import get_supported_sps
-import logging
 
-def run_ats_on_recent_convs():
-    # Get recent conversations from collection
-    convs = MongoDBClient.get_botstate().find(
-        {"conv_hist.magic_minute_agent": {"$exists": True, "$ne": []},
-         "priority_fields_asked": {"$exists": True, "$ne": []}}
-    ).sort(
-        "created", -1
-    ).limit(5)
-
-    for data in convs:
-        # If ATS has already been run on this conversation, stop the operation.
-        if MongoDBClient.get_ats().find_one({"username": data["username"]}):
-            logging.info(
-                f'ATS has already been run on {data["username"]}. Hence, skipping the process.')
-            return
-
-        logging.info(f'Running ATS on {data["username"]}')
-        sp = Specialist.from_inventory_name(data['specialist'])
-        subsp = SubSpecialtyDxGroup.from_inventory_name(data['subSpecialty'])
-
-        # Magic Minute conversation
-        summary = data["conv_hist"]["magic_minute_agent"][0]['content']
-
-        if sp not in get_supported_sps() and subsp not in get_supported_sps():
-            logging.warning(
-                f'Unsupported specialist {sp} or sub-specialist {subsp}')
-            continue
-
-        score, unfilled_fields, args = ats_run(sp, subsp, summary)
-        ats_data = {
-            "score": score,
-            "unfilled_fields": unfilled_fields,
-            "args": args,
-            "date": data["created"][:10],
-            "specialist": data["specialist"],
-            "subSpecialty": data["subSpecialty"],
-            "dxg_version": data["dxg_version"]
-        }
-        MongoDBClient.get_ats().update_one(filter={'username': data['username']},
-                                           update={'$set': ats_data},
-                                           upsert=True)
\ No newline at end of file
+WATERMARK_ID = 'ats'
+
+BATCH_SIZE = int(os.getenv('ATS_BATCH_SIZE', '100'))
+CONCURRENCY = int(os.getenv('ATS_CONCURRENCY', '4'))
+LOOKBACK = timedelta(hours=int(os.getenv('ATS_WATERMARK_LOOKBACK_HOURS', '24')))
+MAX_ATTEMPTS = int(os.getenv('ATS_MAX_ATTEMPTS', '5'))
+
+
+def _unscored_batch(since: Optional[str], after: Optional[dict], limit: int,
+                    usernames: list[str] = None) -> list[dict]:
+    """
+    Unscored conversations with a magic minute summary, created since the watermark, ordered by (created, _id)
+    and starting after the last conversation of the previous page. `usernames` restricts them to the given ones.
+    """
+    match = {"conv_hist.magic_minute_agent": {"$exists": True, "$ne": []},
+             "priority_fields_asked": {"$exists": True, "$ne": []}}
+    if usernames is not None:
+        match['username'] = {'$in': usernames}
+    if since is not None:
+        match['created'] = {'$gte': since}
+    if after is not None:
+        match['$or'] = [{'created': {'$gt': after['created']}},
+                        {'created': after['created'], '_id': {'$gt': after['_id']}}]
+
+    return list(MongoDBClient.get_botstate().aggregate([
+        {'$match': match},
+        {'$sort': {'created': 1, '_id': 1}},
+        {'$lookup': {'from': 'ATS', 'localField': 'username', 'foreignField': 'username', 'as': 'ats'}},
+        {'$match': {'ats': {'$size': 0}}},
+        {'$limit': limit},
+        {'$project': {'username': 1, 'created': 1, 'specialist': 1, 'subSpecialty': 1, 'dxg_version': 1,
+                      'conv_hist.magic_minute_agent': 1}},
+    ]))
+
+
+def _score(data: dict, supported_sps: list) -> Optional[UpdateOne]:
+    sp = Specialist.from_inventory_name(data['specialist'])
+    subsp = SubSpecialtyDxGroup.from_inventory_name(data['subSpecialty'])
+
+    if sp not in supported_sps and subsp not in supported_sps:
+        logging.warning(f'Unsupported specialist {sp} or sub-specialist {subsp}')
+        return None
+
+    # Magic Minute conversation
+    summary = data["conv_hist"]["magic_minute_agent"][0]['content']
+
+    logging.info(f'Running ATS on {data["username"]}')
+    score, unfilled_fields, args = ats_run(sp, subsp, summary)
+    ats_data = {
+        "score": score,
+        "unfilled_fields": unfilled_fields,
+        "args": args,
+        "date": data["created"][:10],
+        "specialist": data["specialist"],
+        "subSpecialty": data["subSpecialty"],
+        "dxg_version": data.get("dxg_version")
+    }
+    return UpdateOne(filter={'username': data['username']}, update={'$set': ats_data}, upsert=True)
+
+
+def _score_or_log(data: dict, supported_sps: list) -> Optional[UpdateOne]:
+    try:
+        return _score(data, supported_sps)
+    except Exception as e:
+        logging.error(f'Error running ATS on {data["username"]}', exc_info=e)
+        return None
+
+
+def _score_batch(pool: ThreadPoolExecutor, batch: list[dict], supported_sps: list) -> list[str]:
+    """
+    Scores a page of conversations, and returns the usernames of those which were not scored.
+    """
+    operations = list(pool.map(lambda data: _score_or_log(data, supported_sps), batch))
+    scored = [operation for operation in operations if operation is not None]
+    if len(scored) > 0:
+        MongoDBClient.get_ats().bulk_write(scored, ordered=False)
+    return [data['username'] for data, operation in zip(batch, operations) if operation is None]
+
+
+def run_ats_on_recent_convs(batch_size: int = None, concurrency: int = None) -> dict:
+    """
+    Scores the conversations created since the watermark, and returns the metrics of the run.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    concurrency = concurrency or CONCURRENCY
+    started = time.monotonic()
+
+    watermark = MongoDBClient.get_job_watermarks().find_one({'_id': WATERMARK_ID}) or {}
+    since = None
+    if watermark.get('created'):
+        since = (datetime.fromisoformat(watermark['created']) - LOOKBACK).isoformat()
+
+    supported_sps = get_supported_sps()
+    scanned = 0
+    latest = watermark.get('created')
+    after = None
+    # Attempts of the conversations to retry, by username
+    attempts = {retry['username']: retry['attempts'] for retry in watermark.get('retry', [])}
+    unscored = []
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ats') as pool:
+        # Retried conversations which were scored since are not returned, and leave the list
+        retries = list(attempts)
+        for start in range(0, len(retries), batch_size):
+            batch = _unscored_batch(None, None, batch_size, usernames=retries[start:start + batch_size])
+            unscored += _score_batch(pool, batch, supported_sps)
+            scanned += len(batch)
+
+        while True:
+            page = _unscored_batch(since, after, batch_size)
+            if len(page) == 0:
+                break
+
+            # The lookback may cover conversations which were just retried
+            batch = [data for data in page if data['username'] not in attempts]
+            unscored += _score_batch(pool, batch, supported_sps)
+            scanned += len(batch)
+            after = page[-1]
+            latest = max(latest or after['created'], after['created'])
+
+            if len(page) < batch_size:
+                break
+
+    retry = []
+    for username in unscored:
+        attempt = attempts.get(username, 0) + 1
+        if attempt >= MAX_ATTEMPTS:
+            logging.error(f'Giving up ATS on {username} after {attempt} attempts')
+        else:
+            retry.append({'username': username, 'attempts': attempt})
+
+    scored = scanned - len(unscored)
+    duration = time.monotonic() - started
+    metrics = {
+        'scanned': scanned,
+        'scored': scored,
+        'duration_seconds': round(duration, 3),
+        'throughput_per_minute': round(scored / duration * 60, 1) if duration > 0 else 0.0,
+        'finished_at': datetime.now(),
+    }
+    MongoDBClient.get_job_watermarks().update_one({'_id': WATERMARK_ID},
+                                                  {'$set': {'created': latest, 'retry': retry, 'last_run': metrics}},
+                                                  upsert=True)
+
+    logging.info(f'ATS scored {scored} of {scanned} conversations in {metrics["duration_seconds"]}s '
+                 f'({metrics["throughput_per_minute"]} per minute)')
+    return metrics
@@ -0,0 +1,21 @@
+"""
+Bounded pool for fire and forget background tasks, like pushing an offer to the EHR.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable
+
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('BACKGROUND_MAX_WORKERS', '4')),
+                              thread_name_prefix='background')
+
+
+def run_in_background(fn: Callable, *args, **kwargs) -> Future:
+    def run():
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logging.error(f'Background task {fn.__name__} failed: {e}', exc_info=e)
+
+    return executor.submit(run)
@@ -1,6 +1,5 @@
 import logging
 import re
-import threading
 import traceback
 from typing import List, Type
 
@@ -8,10 +7,14 @@ from openai.error import Timeout as OpenAITimeout
 
 from src import agents
 from src.bot_conv_hist import BotConvHist
-from src.bot_state import BotState
-from src.bot_stream_llm import ThreadedGenerator, StreamChatOpenAI
+from src.bot_executor import TurnExecutor, TurnReservation
+from src.bot_lease import ConversationLease
+from src.bot_state import BotState, StaleBotStateError
+from src.bot_stream_llm import ThreadedGenerator, StreamChatOpenAI, StreamWriter, TurnCancelled
+from src.bot_stream_replay import StreamReplayBuffer
 from src.followup.followup_care import FollowupCare
 from src.specialist import Specialist
+from src.stats import counts_as_dx, increment_dx_count
 from src.sub_specialist import SubSpecialtyDxGroup
 from src.utils import map_url_name, demo_mode
 from src.agents.cody_care_agent import FORCE_LOGIN_MSG
@@ -21,8 +24,13 @@ class Bot:
     def __init__(self,
                  username: str,
                  profile: dict = None,
-                 ip_address: str = None):
-        
+                 ip_address: str = None,
+                 read_only: bool = False):
+        """
+        Loads the bot of a conversation. Loading may write the conversation, callers which do so must hold its
+        ConversationLease. read_only loads it without any write, e.g. to only display it.
+        """
+
         # Initializing the bot state.
         self.state = BotState(username=username)
 
@@ -32,7 +40,8 @@ class Bot:
 
         # Initializing stream and llm for the bot.
         self.stream = ThreadedGenerator()
-        self.llm = StreamChatOpenAI(gen=self.stream, state=self.state, full_conv_hist=self.full_conv_hist)
+        self.stream_writer = StreamWriter(gen=self.stream)
+        self.llm = StreamChatOpenAI(writer=self.stream_writer, state=self.state, full_conv_hist=self.full_conv_hist)
 
         # Eventually we might want to have this profile itself to be persisted on bot state but YAGNI for now.
         # Since only thing we need now is name to profile which is already persisted on bot state.
@@ -75,12 +84,17 @@ class Bot:
 
         # This covers cases when the user had previously started a conversation using 
         # an earlier version of bot, but history is not yet persisted in the full_conv_hist.
-        if len(self.state.get_conv_hist()) > 1 and self.full_conv_hist.full_conv_hist == []:
+        # Checked first, as get_conv_hist converts the messages of every agent.
+        if self.full_conv_hist.full_conv_hist == [] and len(self.state.get_conv_hist()) > 1:
             self.full_conv_hist.full_conv_hist = self.state.get_conv_hist()
-            self.update_conv()
+            if not read_only:
+                self.update_conv()
 
         assert len(self.agents) == len(set(self.state.agent_names)), 'Number of agents and agent names do not match.'
 
+        if read_only:
+            return
+
         # If convo is eligible
         if FollowupCare.is_profile_followup_eligible(state=self.state, profile=profile):
             # Clear up the convo history for followup care
@@ -115,7 +129,8 @@ class Bot:
     def _ask(self,
              user_input: str = None,
              update_db: bool = True,
-             raise_exception: bool = True) -> None:
+             raise_exception: bool = True,
+             lease: ConversationLease = None) -> None:
         try:
             # Update the conversation history after the human input.
             self.update_conv(update_db, user_input)
@@ -125,13 +140,17 @@ class Bot:
                 self.llm.stream_callback.on_llm_new_token(
                     f'Received your request for {user_input}. Please continue with the convo.')
                 self.update_conv(update_db)  # Update the conversation history
-                self.stream.close()  # Close the stream.
+                self.stream_writer.close()  # Close the stream.
                 return
 
             counter: int = 0
 
             while True:
+                self.stream_writer.cancellation.raise_if_cancelled()
+                if lease is not None:
+                    lease.renew()
                 input_req = self.agents[self.state.current_agent_index].act()
+                self.stream_writer.flush()  # Always flush whatever the agent streamed, before moving on.
                 self.update_conv(update_db)
                 if input_req is not False:  # continue only if input_req is False
                     break
@@ -140,20 +159,32 @@ class Bot:
                 if counter > 5:
                     logging.error("Looping too much, exiting")
                     break
-            self.stream.close()
+            self.stream_writer.close()
+
+        except TurnCancelled as e:
+            # The client is gone. Persist what the turn has done so far, like for timeouts, and stop.
+            logging.info(f'Turn cancelled for convo id {self.state.username}: {e}')
+            self.state.cancellations += 1
+            self.update_conv(update_db)
+            self.stream_writer.close()
+
+        except StaleBotStateError as e:
+            # Another turn of the conversation wrote in between. Its state wins, this turn's writes are dropped.
+            logging.error(f'Dropped the state of a concurrent turn: {e}')
+            self.stream_writer.close()
 
         except OpenAITimeout as e:
             logging.warning("Timeout error captured:" + re.escape(str(e)), exc_info=e)
-            self.llm.stream_callback.on_llm_new_token(
+            self.llm.stream_callback.write_message(
                 '\n\n\nSorry, that took too long to process for us. Can you please type that again?')
             self.state.timeouts += 1
             self.update_conv(update_db)
-            self.stream.close()
+            self.stream_writer.close()
 
         except Exception as e:
             extra_info = {'username': self.state.username}
             logging.error("Unknown error captured: " + re.escape(str(e)), exc_info=e, extra=extra_info)
-            self.llm.stream_callback.on_llm_new_token('\n\n\nSorry, there was an issue on our end. Can you please type '
+            self.llm.stream_callback.write_message('\n\n\nSorry, there was an issue on our end. Can you please type '
                                                       'that again?')
             # We are trying to capture the traceback here and add it to mongo state. This will help us debug the issue better.
             # Later, we can fix the issues and backfill the state.
@@ -163,10 +194,14 @@ class Bot:
             self.state.errors.append(trace)
             self.state.error_types.append(trace[0].split(':')[0])
             self.update_conv(update_db)
-            self.stream.close()
+            self.stream_writer.close()
             if raise_exception:
                 raise e
 
+        finally:
+            if lease is not None:
+                lease.release()
+
     def _profile_bot(self, profile):
         if profile:
             name = profile.get('name', None)
@@ -186,11 +221,25 @@ class Bot:
             if profile.get('longitude', None) and profile.get('latitude', None):
                 self.state.set_location(profile['longitude'], profile['latitude'])
 
-    def ask(self, *args, **kwargs):
+    def ask(self, *args, event_stream: bool = False, reservation: TurnReservation = None, **kwargs):
+        # Turns run on a bounded pool. When it is saturated, TurnRejected reaches the caller right away, before
+        # anything is done for the turn. Callers may reserve the slot of the turn earlier, before loading the bot.
+        if reservation is None:
+            reservation = TurnExecutor.get().reserve()
+        # Clients asking for text/event-stream get every chunk with SSE `data:` framing and an event id,
+        # so that they can resume the stream with Last-Event-ID after a disconnect.
+        self.stream_writer.event_stream = event_stream
+        try:
+            if event_stream:
+                self.stream_writer.start_replay(StreamReplayBuffer.get(), self.state.username)
+        except Exception:
+            reservation.release()
+            raise
         # We dont want unhandled exceptions to crash the server.
         # Hence, we will log exceptions on the server, but not raise them.
         kwargs['raise_exception'] = False
-        threading.Thread(target=self._ask, args=args, kwargs=kwargs).start()
+        self.stream.has_consumer = True
+        reservation.submit(self._ask, *args, **kwargs)
         return self.stream
 
     def get_conv_hist(self) -> List[dict]:
@@ -209,5 +258,13 @@ class Bot:
             self.state.last_human_input = user_input
 
         if update_db:
+            dx_transition = not self.state.dx_counted and counts_as_dx(self.state.current_agent_name)
+            if dx_transition:
+                self.state.dx_counted = True
+
             self.state.upsert_to_db()
             self.full_conv_hist.upsert_to_db()
+
+            # Only counted once the state is saved, so that a stale write does not count the conversation twice
+            if dx_transition:
+                increment_dx_count()
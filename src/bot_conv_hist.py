@@ -5,6 +5,7 @@ To be used for keeping track of the conversation history visible to the user.
 from typing import List
 from pydantic import BaseModel
 import logging
+from src.conversation_archive import ConversationArchive
 from src.utils import MongoDBClient
 
 class BotConvHist(BaseModel):
@@ -22,6 +23,9 @@ class BotConvHist(BaseModel):
         data: dict = MongoDBClient.get_full_conv_hist().find_one(
             {'conversation_id': conversation_id})
 
+        if data is None and ConversationArchive.rehydrate(conversation_id):
+            data = MongoDBClient.get_full_conv_hist().find_one({'conversation_id': conversation_id})
+
         # Only if you have data in the database, load it.
         if data is not None:
             for key, value in data.items():
@@ -0,0 +1,147 @@
+"""
+Bounded execution of bot turns.
+
+Every /ask runs its turn on a shared pool with at most max_workers turns in flight, so a burst of traffic cannot
+create an unbounded number of concurrent OpenAI calls and mongo writers. Turns beyond that wait in a bounded queue,
+and once the queue is full new turns are rejected right away, with a hint of when to retry. A request reserves its
+slot before doing any work for its turn, so that a rejected request costs nothing.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable
+
+
+class TurnRejected(Exception):
+    """
+    Raised when a turn cannot be admitted, because all workers are busy and the wait queue is full.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'Too many turns in flight, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class TurnExecutor:
+    _instance = None
+
+    # Number of recent turns the wait and run time gauges are computed from
+    WINDOW = 256
+
+    def __init__(self, max_workers: int = None, max_queue: int = None):
+        self.max_workers = max_workers if max_workers is not None else int(os.getenv('TURN_MAX_WORKERS', '32'))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('TURN_MAX_QUEUE', '64'))
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='turn')
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_times: deque[float] = deque(maxlen=TurnExecutor.WINDOW)
+        self.run_times: deque[float] = deque(maxlen=TurnExecutor.WINDOW)
+
+    @classmethod
+    def get(cls) -> 'TurnExecutor':
+        """
+        Returns the turn executor of the process, sized by TURN_MAX_WORKERS and TURN_MAX_QUEUE.
+        """
+        if cls._instance is None:
+            cls._instance = TurnExecutor()
+        return cls._instance
+
+    def reserve(self) -> 'TurnReservation':
+        """
+        Reserves a slot for a turn, or raises TurnRejected if the wait queue is full. The slot counts as queued until
+        the turn is submitted on it, or the reservation is released.
+        """
+        with self.lock:
+            if self.queued + self.active >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                retry_after = self._retry_after()
+                logging.warning(f'Rejected turn, {self.active} active and {self.queued} queued')
+                raise TurnRejected(retry_after)
+            self.queued += 1
+        return TurnReservation(self)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Schedules a turn, or raises TurnRejected if the wait queue is full.
+        """
+        return self.reserve().submit(fn, *args, **kwargs)
+
+    def _run(self, fn: Callable, *args, **kwargs) -> Future:
+        enqueued = time.monotonic()
+
+        def run():
+            started = time.monotonic()
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+                self.wait_times.append(started - enqueued)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                logging.error(f'Unhandled error in turn: {e}', exc_info=e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self.run_times.append(time.monotonic() - started)
+
+        return self.pool.submit(run)
+
+    def _unreserve(self) -> None:
+        with self.lock:
+            self.queued -= 1
+
+    def _retry_after(self) -> int:
+        """
+        Seconds until a queue slot is expected to free up, from the average run time of recent turns.
+        """
+        if len(self.run_times) == 0:
+            return 1
+        average_run_time = sum(self.run_times) / len(self.run_times)
+        return max(1, math.ceil(average_run_time * (self.queued + 1) / self.max_workers))
+
+    def gauges(self) -> dict:
+        with self.lock:
+            wait_times = sorted(self.wait_times)
+            return {
+                'active_turns': self.active,
+                'queue_depth': self.queued,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_ms_avg': round(1000 * sum(wait_times) / len(wait_times)) if wait_times else 0,
+                'wait_ms_p95': round(1000 * wait_times[int(0.95 * (len(wait_times) - 1))]) if wait_times else 0,
+            }
+
+
+class TurnReservation:
+    """
+    Slot of the executor reserved for a turn, used by submitting the turn, or given back with release.
+    """
+
+    def __init__(self, executor: TurnExecutor):
+        self.executor = executor
+        self.done = False
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if self.done:
+            raise RuntimeError('Turn reservation already used')
+        self.done = True
+        return self.executor._run(fn, *args, **kwargs)
+
+    def release(self) -> None:
+        """
+        Gives the slot back, unless a turn was submitted on it. Safe to call more than once.
+        """
+        if not self.done:
+            self.done = True
+            self.executor._unreserve()
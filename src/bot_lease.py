@@ -0,0 +1,71 @@
+"""
+Per-conversation leases, so that a single turn at a time runs for a conversation across all workers and nodes.
+
+A lease is a document of the conversation_leases collection keyed by the conversation id. It expires on its own,
+so a worker which dies mid turn only blocks its conversation for CONVO_LEASE_SECONDS.
+"""
+
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from src.utils import MongoDBClient
+
+
+class ConversationLease:
+    TTL = int(os.getenv('CONVO_LEASE_SECONDS', '120'))
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, convo_id: str, owner: str):
+        self.convo_id = convo_id
+        self.owner = owner
+
+    @classmethod
+    def try_acquire(cls, convo_id: str) -> Optional['ConversationLease']:
+        owner = uuid.uuid4().hex
+        now = datetime.now()
+        try:
+            # Matches only a missing or expired lease. A live lease makes the upsert collide on _id.
+            MongoDBClient.get_conversation_leases().update_one(
+                filter={'_id': convo_id, 'expires_at': {'$lt': now}},
+                update={'$set': {'owner': owner, 'acquired_at': now, 'expires_at': now + timedelta(seconds=cls.TTL)}},
+                upsert=True)
+        except DuplicateKeyError:
+            return None
+        return cls(convo_id, owner)
+
+    @classmethod
+    def acquire(cls, convo_id: str, wait: float = None) -> Optional['ConversationLease']:
+        """
+        Acquires the lease of the conversation, waiting up to `wait` seconds (CONVO_LEASE_WAIT) for the turn
+        holding it to finish. Returns None if it is still held after that.
+        """
+        if wait is None:
+            wait = float(os.getenv('CONVO_LEASE_WAIT', '10'))
+
+        deadline = time.monotonic() + wait
+        while True:
+            lease = cls.try_acquire(convo_id)
+            if lease is not None or time.monotonic() >= deadline:
+                return lease
+            time.sleep(cls.POLL_INTERVAL)
+
+    def renew(self) -> bool:
+        """
+        Extends the lease. Returns False if it expired and was taken over by another turn.
+        """
+        result = MongoDBClient.get_conversation_leases().update_one(
+            filter={'_id': self.convo_id, 'owner': self.owner},
+            update={'$set': {'expires_at': datetime.now() + timedelta(seconds=ConversationLease.TTL)}})
+        if result.matched_count == 0:
+            logging.warning(f'Lost the lease of convo id {self.convo_id}')
+            return False
+        return True
+
+    def release(self) -> None:
+        MongoDBClient.get_conversation_leases().delete_one({'_id': self.convo_id, 'owner': self.owner})
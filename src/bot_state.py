@@ -8,12 +8,87 @@ from typing import List, Any
 
 from langchain.adapters.openai import convert_message_to_dict, convert_dict_to_message
 from langchain.schema import BaseMessage, AIMessage, HumanMessage
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
+from src.conversation_archive import ConversationArchive
 from src.utils import Specialist, SubSpecialtyDxGroup, MongoDBClient
 
 VERSION = '0.16.0-alpha'
 
+
+class StaleBotStateError(Exception):
+    """
+    Raised when the bot state was written by another turn since it was loaded.
+    """
+    pass
+
+
+class _StoredMessages(list):
+    """
+    Messages of an agent as stored in the database, not converted yet.
+    """
+    pass
+
+
+class LazyConvHist(dict):
+    """
+    conv_hist of a loaded bot state. The messages of an agent are converted to LangChain messages on first access,
+    and agents which are never accessed are written back as they were read, so that a turn only converts the agents
+    it uses, however long the conversation is.
+    """
+
+    @classmethod
+    def from_db(cls, conv_hist: dict) -> 'LazyConvHist':
+        lazy = cls()
+        for agent_name, messages in conv_hist.items():
+            dict.__setitem__(lazy, agent_name, _StoredMessages(messages))
+        return lazy
+
+    def __getitem__(self, agent_name: str) -> List[BaseMessage]:
+        messages = super().__getitem__(agent_name)
+        if isinstance(messages, _StoredMessages):
+            messages = [convert_dict_to_message(message) for message in messages]
+            super().__setitem__(agent_name, messages)
+        return messages
+
+    def get(self, agent_name: str, default=None):
+        return self[agent_name] if agent_name in self else default
+
+    def setdefault(self, agent_name: str, default=None):
+        if agent_name not in self:
+            self[agent_name] = default
+        return self[agent_name]
+
+    def pop(self, agent_name: str, *default):
+        if agent_name not in self:
+            return super().pop(agent_name, *default)
+        messages = self[agent_name]
+        del self[agent_name]
+        return messages
+
+    def items(self):
+        return [(agent_name, self[agent_name]) for agent_name in self]
+
+    def values(self):
+        return [self[agent_name] for agent_name in self]
+
+    def copy(self) -> 'LazyConvHist':
+        copy = LazyConvHist()
+        dict.update(copy, self)
+        return copy
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, dict) and dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    def to_db(self) -> dict:
+        return {agent_name: list(messages) if isinstance(messages, _StoredMessages)
+                else [convert_message_to_dict(message) for message in messages]
+                for agent_name, messages in dict.items(self)}
+
+
 class BotState(BaseModel):
     ip_address: str = None
     deployed: str = datetime.now().isoformat()
@@ -37,6 +112,8 @@ class BotState(BaseModel):
     total_cost: float = 0.0
     max_token_count: int = 0
     version: str = VERSION
+    # Incremented on every write, for compare and swap updates. Not to be confused with the bot version.
+    revision: int = 0
     treatment_plans_seen: list = []
     treatment_plans: dict[str, str] = {}
     specialist: Specialist = Specialist.Generalist
@@ -51,6 +128,8 @@ class BotState(BaseModel):
     errors: List[Any] = []
     error_types: List[str] = []
     timeouts: int = 0
+    cancellations: int = 0
+    dx_counted: bool = False
 
     # Followup agent fields
     priority_fields_asked: List[str] = []
@@ -77,6 +156,9 @@ class BotState(BaseModel):
     existing_dx_tx: str = ''
     analytics_state: str = None
 
+    # Whether the state has a document in the database yet.
+    _persisted: bool = PrivateAttr(default=False)
+
     class Config:
         validate_assignment = True
         extra = 'allow'
@@ -87,16 +169,19 @@ class BotState(BaseModel):
         self.username = username
         data: dict = MongoDBClient.get_botstate().find_one({'username': username})
 
+        if data is None and ConversationArchive.rehydrate(username):
+            data = MongoDBClient.get_botstate().find_one({'username': username})
+
         # Only if you have data in the database, load it.
         if data is not None:
+            self._persisted = True
             for key, value in data.items():
                 if key == '_id':
                     continue
                 if key == 'conv_hist':
-                    # Converting conv_hist dict messages to BaseMessage format after loading
-                    for agent_name, messages in value.items():
-                        value[agent_name] = [
-                            convert_dict_to_message(message) for message in messages]
+                    # Converted to BaseMessage format on access. Set without validation, which would convert them all.
+                    object.__setattr__(self, key, LazyConvHist.from_db(value))
+                    continue
                 if key == 'specialist':
                     value = Specialist.from_inventory_name(value)
                 if key == 'subSpecialty':
@@ -121,14 +206,11 @@ class BotState(BaseModel):
         d2 = datetime.strptime(self.created, regex)
         self.engagement_minutes = (d1 - d2).total_seconds() / 60
 
-        data_dict: dict = self.dict(by_alias=True)
+        data_dict: dict = self.dict(by_alias=True, exclude={'conv_hist'})
 
-        # Converting conv_hist messages to proper dict message format before saving
-        temp_conv_dist = {}
-        for agent_name, messages in self.conv_hist.items():
-            temp_conv_dist[agent_name] = [
-                convert_message_to_dict(message) for message in messages]
-        data_dict['conv_hist'] = temp_conv_dist
+        # Converting conv_hist messages to proper dict message format before saving, for the agents accessed only
+        conv_hist = self.conv_hist if isinstance(self.conv_hist, LazyConvHist) else LazyConvHist(self.conv_hist)
+        data_dict['conv_hist'] = conv_hist.to_db()
         data_dict['specialist'] = self.specialist.inventory_name
         data_dict['subSpecialty'] = self.subSpecialty.inventory_name
 
@@ -136,10 +218,26 @@ class BotState(BaseModel):
         data_dict['dx_specialist_list'] = [spc.inventory_name for spc in self.dx_specialist_list]
 
         logging.debug(f'Upsert to database..')
-        # Inserting or updating the data to the database
-        MongoDBClient.get_botstate().update_one(filter={'username': self.username},
-                                                update={'$set': data_dict},
-                                                upsert=True)
+        # Compare and swap on the revision, so that concurrent turns do not silently overwrite each other.
+        data_dict['revision'] = self.revision + 1
+        if not self._persisted:
+            # First write of a new conversation. Only insert, if another turn created it meanwhile that is a conflict.
+            result = MongoDBClient.get_botstate().update_one(filter={'username': self.username},
+                                                             update={'$setOnInsert': data_dict},
+                                                             upsert=True)
+            written = result.upserted_id is not None
+        else:
+            # Documents written before revisions were introduced have none.
+            revision = self.revision if self.revision > 0 else {'$in': [0, None]}
+            result = MongoDBClient.get_botstate().update_one(filter={'username': self.username, 'revision': revision},
+                                                             update={'$set': data_dict})
+            written = result.matched_count > 0
+
+        if not written:
+            raise StaleBotStateError(f'Bot state of {self.username} was updated concurrently, '
+                                     f'revision {self.revision} is stale')
+        self.revision += 1
+        self._persisted = True
 
     def next_agent(self, name: str = None, reset_hist=False):
         if name is None:
@@ -156,6 +254,12 @@ class BotState(BaseModel):
             self.conv_hist[self.current_agent_name][:] = []
         logging.debug(f'Next agent activated: {self.current_agent_name}')
 
+    def count_messages(self, agent_name: str) -> int:
+        """
+        Returns the number of messages of the agent, without converting them.
+        """
+        return len(dict.get(self.conv_hist, agent_name, []))
+
     def get_conv_hist(self) -> List[dict]:
         conv_hist = []
         for agent_name in self.agent_names:
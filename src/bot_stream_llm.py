@@ -1,8 +1,9 @@
 import logging
 import os
 import queue
-import re
-from typing import Any
+import threading
+import time
+from typing import Any, Callable, Optional
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.openai_info import standardize_model_name, get_openai_token_cost_for_model
@@ -12,40 +13,296 @@ from langchain.schema.messages import BaseMessage, AIMessage
 
 from src.bot_conv_hist import BotConvHist
 from src.bot_state import BotState
+from src.bot_stream_replay import StreamReplayBuffer, sse_frame
 from src.utils import fake_llm
 
 
-class ThreadedGenerator:
+class TurnCancelled(BaseException):
+    """
+    Raised inside a turn once its client has gone away, to stop spending tokens on it.
+    It is a BaseException, so that the `except Exception` handlers of agents and of the langchain callback manager
+    do not mistake it for an error.
+    """
+    pass
+
+
+class CancellationToken:
     def __init__(self):
-        self.queue = queue.Queue()
+        self.event = threading.Event()
+        self.reason: str = None
+
+    def cancel(self, reason: str) -> None:
+        self.reason = reason
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise TurnCancelled(self.reason)
+
+
+class ThreadedGenerator:
+    """
+    Bounded channel between the thread running a turn and the response iterator.
+
+    Once a consumer is attached, a full queue blocks the producer, so a slow client applies backpressure.
+    The WSGI server calls close when the response ends. If that happens before the turn has finished,
+    the client has disconnected and the turn is cancelled. A turn which can be resumed from the replay buffer
+    carries on without the live channel, and is only cancelled if nobody resumes it within RESUME_GRACE seconds.
+    """
+    # How often a blocked producer or consumer checks the state of the other side.
+    PUT_TIMEOUT = 0.1
+    RESUME_GRACE = float(os.getenv('STREAM_RESUME_GRACE', '10'))
+
+    def __init__(self, maxsize: int = None):
+        self.queue = queue.Queue(maxsize if maxsize is not None else int(os.getenv('STREAM_QUEUE_SIZE', '256')))
+        self.cancellation = CancellationToken()
+        # Set when a response iterator will consume the stream. Until then, a full queue drops data instead of blocking.
+        self.has_consumer = False
+        # Set for streams which can be resumed, so that a disconnect detaches the channel instead of cancelling the turn.
+        self.resumable = False
+        # Returns when the stream was last resumed from the replay buffer, if ever.
+        self.resumed_at: Callable[[], Optional[float]] = lambda: None
+        self.detached = False
+        self.disconnected_at: float = None
+        # Set by the producer once the turn is done, and by the consumer once it has seen the end.
+        self.ended = False
+        self.finished = False
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        item = self.queue.get()
+        while True:
+            try:
+                item = self.queue.get(timeout=ThreadedGenerator.PUT_TIMEOUT)
+                break
+            except queue.Empty:
+                # The end of stream marker can be lost, when it was dropped from a full queue without a consumer.
+                if self.ended:
+                    item = StopIteration
+                    break
+
         if item is StopIteration:
+            self.finished = True
             raise item
         return item
 
     def send(self, data):
-        self.queue.put(data)
+        while not self.cancellation.cancelled and not self.detached:
+            try:
+                self.queue.put(data, timeout=ThreadedGenerator.PUT_TIMEOUT)
+                return
+            except queue.Full:
+                if not self.has_consumer:
+                    return
+
+    def end(self):
+        """
+        Called by the producer once the turn is done.
+        """
+        self.ended = True
+        self.send(StopIteration)
 
     def close(self):
-        self.queue.put(StopIteration)
+        """
+        Called by the WSGI server once the response is done, or when the client disconnects.
+        """
+        if self.finished:
+            return
+
+        if self.resumable:
+            logging.info('Client disconnected from a resumable stream, detaching it')
+            self.detached = True
+            self.disconnected_at = time.time()
+            timer = threading.Timer(ThreadedGenerator.RESUME_GRACE, self._cancel_if_abandoned)
+            timer.daemon = True
+            timer.start()
+        else:
+            self.cancellation.cancel('Client disconnected')
 
+    def _cancel_if_abandoned(self):
+        if self.ended:
+            return
 
-class StreamCallback(BaseCallbackHandler):
-    def __init__(self, gen: ThreadedGenerator, full_conv_hist: BotConvHist):
+        resumed_at = self.resumed_at()
+        if resumed_at is None or resumed_at < self.disconnected_at:
+            self.cancellation.cancel('Client disconnected and did not resume')
+
+
+class StreamWriter:
+    """
+    Coalesces streamed fragments into fewer, larger writes on the ThreadedGenerator.
+    Fragments are buffered and flushed once the buffer grows past flush_bytes, or at the latest flush_interval
+    seconds after the first buffered fragment, even if no other fragment follows it. The deadline is watched by a
+    single flusher thread per writer, started by the first buffered write, and which exits after FLUSHER_IDLE_TIMEOUT
+    seconds without any. Callers flush explicitly at agent boundaries, and close always flushes.
+
+    Sending to the generator blocks while the client applies backpressure. It is done outside of the buffer lock,
+    so that a blocked send never holds up writes and the deadline.
+    """
+
+    FLUSHER_IDLE_TIMEOUT = 30
+
+    def __init__(self,
+                 gen: ThreadedGenerator,
+                 flush_interval: float = None,
+                 flush_bytes: int = None,
+                 event_stream: bool = False):
         self.gen = gen
+        self.flush_interval = flush_interval if flush_interval is not None else \
+            int(os.getenv('STREAM_FLUSH_INTERVAL_MS', '20')) / 1000
+        self.flush_bytes = flush_bytes if flush_bytes is not None else int(os.getenv('STREAM_FLUSH_BYTES', '64'))
+        # When enabled, every flush is sent as a server sent event with `data:` framing.
+        self.event_stream = event_stream
+        # When replay is set, every event gets an id and is kept in the replay buffer for resuming the stream.
+        self.replay: StreamReplayBuffer = None
+        self.convo_id: str = None
+        self.turn: int = None
+        self.seq = 0
+        self.buffer: list[str] = []
+        self.buffered_bytes = 0
+        self.last_flush = time.monotonic()
+        # Deadline of the buffered fragments, if any, watched by the flusher thread.
+        self.deadline: float = None
+        self.flusher: threading.Thread = None
+        self.closed = False
+        # Guards the buffer and the deadline.
+        self.lock = threading.Lock()
+        self.deadline_changed = threading.Condition(self.lock)
+        # Serializes the sends, so that chunks reach the generator in the order they were buffered.
+        self.send_lock = threading.Lock()
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+
+        with self.lock:
+            if len(self.buffer) == 0:
+                self._arm_deadline()
+
+            self.buffer.append(text)
+            self.buffered_bytes += len(text.encode('utf-8'))
+
+            due = self.buffered_bytes >= self.flush_bytes or time.monotonic() - self.last_flush >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.send_lock:
+            with self.lock:
+                data = self._take()
+            if data is not None:
+                self.gen.send(self.frame(data))
+
+    def start_replay(self, replay: StreamReplayBuffer, convo_id: str) -> None:
+        self.replay = replay
+        self.convo_id = convo_id
+        self.turn = replay.start_turn(convo_id)
+        self.seq = 0
+        self.gen.resumable = True
+        self.gen.resumed_at = lambda: replay.resumed_at(convo_id, self.turn)
+
+    @property
+    def cancellation(self) -> CancellationToken:
+        return self.gen.cancellation
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.deadline_changed.notify()
+        if self.replay is not None:
+            self.replay.close(self.convo_id, self.turn)
+        self.gen.end()
+
+    def frame(self, data: str) -> str:
+        if not self.event_stream:
+            return data
+
+        if self.replay is None:
+            return sse_frame(data)
+
+        self.seq += 1
+        self.replay.append(self.convo_id, self.turn, self.seq, data)
+        return sse_frame(data, event_id=f'{self.turn}-{self.seq}')
+
+    def _arm_deadline(self) -> None:
+        """
+        Sets the deadline of the first buffered fragment. Called with the lock held.
+        """
+        self.deadline = time.monotonic() + self.flush_interval
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_on_deadline, name='stream-flusher', daemon=True)
+            self.flusher.start()
+        else:
+            self.deadline_changed.notify()
+
+    def _flush_on_deadline(self) -> None:
+        while True:
+            with self.lock:
+                while True:
+                    if self.closed:
+                        self.flusher = None
+                        return
+                    if self.deadline is None:
+                        if not self.deadline_changed.wait(StreamWriter.FLUSHER_IDLE_TIMEOUT) and self.deadline is None:
+                            self.flusher = None
+                            return
+                    elif time.monotonic() >= self.deadline:
+                        break
+                    else:
+                        self.deadline_changed.wait(self.deadline - time.monotonic())
+            self.flush()
+
+    def _take(self) -> Optional[str]:
+        """
+        Empties the buffer, and returns its content if any. Called with the lock held.
+        """
+        self.last_flush = time.monotonic()
+        self.deadline = None
+
+        if len(self.buffer) == 0:
+            return None
+
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+        return data
+
+
+class StreamCallback(BaseCallbackHandler):
+    def __init__(self, writer: StreamWriter, full_conv_hist: BotConvHist):
+        self.writer = writer
         self.full_conv_hist = full_conv_hist
 
     def on_llm_new_token(self, token: str, **kwargs) -> None:
+        # Tokens from an llm run carry a run_id. TurnCancelled is not swallowed by the callback manager, so it aborts
+        # the llm call before the agent records its response. Anything else is a message the agent has already
+        # added to its history, which must reach the full history too, so it is written even if cancelled. The turn
+        # stops before the next agent acts.
+        if kwargs.get('run_id') is not None:
+            self.writer.cancellation.raise_if_cancelled()
+        self.write_message(token, **kwargs)
+
+    def write_message(self, token: str, **kwargs) -> None:
+        """
+        Writes to the stream without checking for cancellation. Used for the error messages of a turn,
+        which must be persisted even if the client is gone.
+        """
         self.full_conv_hist.append_token(token)
-        # Splitting the token on spaces to ensure better streaming effect.
-        chunks = re.split(r'(\s+)', token)
-        for chunk in chunks:
-            self.gen.send(chunk)
+        self.writer.write(token)
+        # Tokens from an llm run carry a run_id. Anything else is a complete message written by an agent,
+        # which should reach the user right away.
+        if kwargs.get('run_id') is None:
+            self.writer.flush()
+
+    def on_llm_end(self, *args, **kwargs) -> None:
+        self.writer.flush()
 
     @property
     def ignore_retry(self) -> bool:
@@ -138,16 +395,20 @@ class CustomChatOpenAI:
 class StreamChatOpenAI:
     def __init__(self,
                  state: BotState = None,
-                 gen: ThreadedGenerator = ThreadedGenerator(),
+                 writer: StreamWriter = None,
                  full_conv_hist: BotConvHist = None,
                  **kwargs):
         self.streaming = os.getenv('STREAMING', 'True').lower() == 'true'
+        if writer is None:
+            writer = StreamWriter(gen=ThreadedGenerator())
         self.stream_callback = StreamCallback(
-            gen=gen, full_conv_hist=full_conv_hist)
+            writer=writer, full_conv_hist=full_conv_hist)
         self.llm = CustomChatOpenAI(state=state, callbacks=[
                                     self.stream_callback], streaming=self.streaming, **kwargs)
 
     def __call__(self, *args, **kwargs: Any) -> BaseMessage:
+        # No point in calling the llm for a client which is gone.
+        self.stream_callback.writer.cancellation.raise_if_cancelled()
         response = self.llm.__call__(*args, **kwargs)
         if not self.streaming:
             logging.info("Switching to non streaming mode temporarily")
@@ -0,0 +1,362 @@
+"""
+Replay buffer for streamed /ask responses.
+
+Every chunk flushed to an event stream client is tagged with a monotonic event id of the form `<turn>-<seq>`,
+where turn is the start time of the turn in milliseconds and seq is the position of the chunk in the turn.
+The chunks of the latest turn of every conversation are kept, so that a client reconnecting with
+`Last-Event-ID` resumes exactly after the last chunk it has seen, without re-running the agents.
+When the chunks it has missed are no longer buffered, the stream cannot be resumed, and the client has to reload
+the conversation instead.
+"""
+
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Iterator, Optional
+
+import cachetools
+
+from src.utils import MongoDBClient
+
+
+def sse_frame(data: str, event_id: str = None) -> str:
+    """
+    Frames data as a server sent event. Multi line data is sent as multiple `data:` lines.
+    """
+    frame = f'id: {event_id}\n' if event_id is not None else ''
+    return frame + ''.join(f'data: {line}\n' for line in data.split('\n')) + '\n'
+
+
+def parse_event_id(event_id: Optional[str]) -> tuple[Optional[int], int]:
+    if not event_id:
+        return None, 0
+
+    try:
+        turn, seq = event_id.split('-')
+        return int(turn), int(seq)
+    except ValueError:
+        logging.warning(f'Invalid stream event id: {event_id}')
+        return None, 0
+
+
+class StreamReplayBuffer(ABC):
+    _instance = None
+
+    # How long a resumed stream waits for new chunks before giving up
+    REPLAY_TIMEOUT = 60.0
+    POLL_INTERVAL = 0.1
+
+    @classmethod
+    def get(cls) -> 'StreamReplayBuffer':
+        """
+        Returns the replay buffer of the process. STREAM_REPLAY_BACKEND=mongo shares it across workers and nodes.
+        """
+        if cls._instance is None:
+            if os.getenv('STREAM_REPLAY_BACKEND', 'memory') == 'mongo':
+                cls._instance = MongoStreamReplayBuffer()
+            else:
+                cls._instance = InMemoryStreamReplayBuffer()
+        return cls._instance
+
+    @abstractmethod
+    def start_turn(self, convo_id: str) -> int:
+        """
+        Starts buffering a new turn for the conversation, dropping the previous one.
+        """
+        pass
+
+    @abstractmethod
+    def append(self, convo_id: str, turn: int, seq: int, data: str) -> None:
+        pass
+
+    @abstractmethod
+    def close(self, convo_id: str, turn: int) -> None:
+        """
+        Marks the turn as complete. Resumed streams end once they reach this point.
+        """
+        pass
+
+    @abstractmethod
+    def latest_turn(self, convo_id: str) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def events_since(self, convo_id: str, turn: int, seq: int) -> tuple[list[tuple[int, str]], bool]:
+        """
+        Returns the (seq, data) chunks of the turn after seq, and whether the turn is complete.
+        """
+        pass
+
+    @abstractmethod
+    def has_gap(self, convo_id: str, turn: int, seq: int) -> bool:
+        """
+        Whether some chunks of the turn after seq were dropped from the buffer, so it cannot be replayed from seq.
+        """
+        pass
+
+    def can_resume(self, convo_id: str, last_event_id: str = None) -> bool:
+        turn, seq = parse_event_id(last_event_id)
+        current_turn = self.latest_turn(convo_id)
+
+        if current_turn is None:
+            return False
+
+        return not self.has_gap(convo_id, current_turn, seq if turn == current_turn else 0)
+
+    @abstractmethod
+    def mark_resumed(self, convo_id: str, turn: int) -> None:
+        """
+        Records that a client resumed the turn, so that its producer is not cancelled as abandoned.
+        """
+        pass
+
+    @abstractmethod
+    def resumed_at(self, convo_id: str, turn: int) -> Optional[float]:
+        pass
+
+    def wait(self, convo_id: str, timeout: float) -> None:
+        time.sleep(timeout)
+
+    def replay(self, convo_id: str, last_event_id: str = None) -> Iterator[tuple[str, str]]:
+        """
+        Yields (event_id, data) of the latest turn after last_event_id, following the turn until it completes.
+        If last_event_id belongs to an older turn, the latest turn is replayed from its start.
+        """
+        turn, seq = parse_event_id(last_event_id)
+        current_turn = self.latest_turn(convo_id)
+
+        if current_turn is None:
+            return
+
+        if turn != current_turn:
+            seq = 0
+
+        self.mark_resumed(convo_id, current_turn)
+
+        deadline = time.monotonic() + self.REPLAY_TIMEOUT
+        while True:
+            events, closed = self.events_since(convo_id, current_turn, seq)
+
+            # Never skip over dropped chunks silently. Ending the stream makes the client reconnect,
+            # and can_resume then tells it to reload the conversation.
+            if (len(events) > 0 and events[0][0] > seq + 1) or \
+                    (len(events) == 0 and self.has_gap(convo_id, current_turn, seq)):
+                logging.warning(f'Stream for convo id {convo_id} fell behind the replay buffer')
+                return
+
+            for seq, data in events:
+                yield f'{current_turn}-{seq}', data
+
+            if closed:
+                return
+
+            if len(events) > 0:
+                deadline = time.monotonic() + self.REPLAY_TIMEOUT
+            elif time.monotonic() > deadline:
+                logging.warning(f'Timed out resuming stream for convo id {convo_id}')
+                return
+
+            self.wait(convo_id, self.POLL_INTERVAL)
+
+
+class InMemoryStreamReplayBuffer(StreamReplayBuffer):
+
+    def __init__(self, max_events: int = 1024, max_convos: int = 10000, ttl: int = 10 * 60):
+        self.max_events = max_events
+        self.turns = cachetools.TTLCache(maxsize=max_convos, ttl=ttl)
+        self.condition = threading.Condition()
+
+    def start_turn(self, convo_id: str) -> int:
+        turn = time.time_ns() // 1_000_000
+        with self.condition:
+            previous = self.turns.get(convo_id)
+            # Turns started within the same millisecond must still be ordered.
+            if previous is not None and previous['turn'] >= turn:
+                turn = previous['turn'] + 1
+            self.turns[convo_id] = {'turn': turn, 'events': deque(maxlen=self.max_events), 'closed': False,
+                                    'resumed_at': None}
+        return turn
+
+    def append(self, convo_id: str, turn: int, seq: int, data: str) -> None:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            if buffered is None or buffered['turn'] != turn:
+                return
+            buffered['events'].append((seq, data))
+            self.condition.notify_all()
+
+    def close(self, convo_id: str, turn: int) -> None:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            if buffered is None or buffered['turn'] != turn:
+                return
+            buffered['closed'] = True
+            self.condition.notify_all()
+
+    def has_gap(self, convo_id: str, turn: int, seq: int) -> bool:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            if buffered is None or buffered['turn'] != turn or len(buffered['events']) == 0:
+                return False
+            return buffered['events'][0][0] > seq + 1
+
+    def mark_resumed(self, convo_id: str, turn: int) -> None:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            if buffered is not None and buffered['turn'] == turn:
+                buffered['resumed_at'] = time.time()
+
+    def resumed_at(self, convo_id: str, turn: int) -> Optional[float]:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            return buffered['resumed_at'] if buffered is not None and buffered['turn'] == turn else None
+
+    def latest_turn(self, convo_id: str) -> Optional[int]:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            return buffered['turn'] if buffered is not None else None
+
+    def events_since(self, convo_id: str, turn: int, seq: int) -> tuple[list[tuple[int, str]], bool]:
+        with self.condition:
+            buffered = self.turns.get(convo_id)
+            if buffered is None or buffered['turn'] != turn:
+                # The turn was replaced or expired, nothing more will come for it.
+                return [], True
+            return [event for event in buffered['events'] if event[0] > seq], buffered['closed']
+
+    def wait(self, convo_id: str, timeout: float) -> None:
+        with self.condition:
+            self.condition.wait(timeout)
+
+
+class MongoStreamReplayBuffer(StreamReplayBuffer):
+    """
+    Replay buffer shared by all workers through the stream_events collection.
+
+    Chunks are written in batches by a background thread, so that the thread streaming tokens never waits on mongo.
+    Every turn keeps at most max_events chunks, and the TTL index on created declared in MongoDBClient.INDEXES
+    drops turns nobody resumed after STREAM_REPLAY_TTL seconds.
+    Besides the chunks, a turn has a header document with seq 0, which records resumes and truncation,
+    and a done marker with DONE_SEQ, written when the turn completes.
+    """
+    # Sequence number of the marker written when a turn completes, so that it always sorts last.
+    DONE_SEQ = 2 ** 31 - 1
+    # How long the writer waits for more chunks before writing a batch
+    BATCH_INTERVAL = 0.05
+
+    def __init__(self, max_events: int = 1024):
+        self.max_events = max_events
+        self.pending: list[dict] = []
+        self.condition = threading.Condition()
+        # Held while a batch is taken and written, so that close never overtakes chunks in flight.
+        self.write_lock = threading.RLock()
+        self.writer: threading.Thread = None
+
+    def start_turn(self, convo_id: str) -> int:
+        turn = time.time_ns() // 1_000_000
+        previous = self.latest_turn(convo_id)
+        # Turns started within the same millisecond must still be ordered.
+        if previous is not None and previous >= turn:
+            turn = previous + 1
+        MongoDBClient.get_stream_events().delete_many({'convo_id': convo_id, 'turn': {'$lt': turn}})
+        # The header makes the turn visible to resuming clients before its first chunk is written.
+        self._update_header(convo_id, turn, {})
+        return turn
+
+    def append(self, convo_id: str, turn: int, seq: int, data: str) -> None:
+        if seq > self.max_events:
+            if seq == self.max_events + 1:
+                logging.warning(f'Stream for convo id {convo_id} exceeded {self.max_events} events, truncating replay')
+                self._update_header(convo_id, turn, {'truncated': True})
+            return
+
+        with self.condition:
+            self.pending.append({
+                'convo_id': convo_id,
+                'turn': turn,
+                'seq': seq,
+                'data': data,
+                'created': datetime.now()
+            })
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                self.writer.start()
+            self.condition.notify()
+
+    def _write_loop(self) -> None:
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+            time.sleep(self.BATCH_INTERVAL)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the pending chunks.
+        """
+        with self.write_lock:
+            with self.condition:
+                batch, self.pending = self.pending, []
+
+            if len(batch) == 0:
+                return
+
+            try:
+                MongoDBClient.get_stream_events().insert_many(batch, ordered=False)
+            except Exception as e:
+                logging.error(f'Failed to write {len(batch)} stream events: {e}')
+
+    def close(self, convo_id: str, turn: int) -> None:
+        with self.write_lock:
+            self.flush()
+            MongoDBClient.get_stream_events().insert_one({
+                'convo_id': convo_id,
+                'turn': turn,
+                'seq': MongoStreamReplayBuffer.DONE_SEQ,
+                'done': True,
+                'created': datetime.now()
+            })
+
+    def _update_header(self, convo_id: str, turn: int, fields: dict) -> None:
+        MongoDBClient.get_stream_events().update_one({'convo_id': convo_id, 'turn': turn, 'seq': 0},
+                                                     {'$set': {**fields, 'created': datetime.now()}},
+                                                     upsert=True)
+
+    def _header(self, convo_id: str, turn: int) -> dict:
+        return MongoDBClient.get_stream_events().find_one({'convo_id': convo_id, 'turn': turn, 'seq': 0}) or {}
+
+    def has_gap(self, convo_id: str, turn: int, seq: int) -> bool:
+        # Chunks are only ever dropped past max_events.
+        return seq >= self.max_events and self._header(convo_id, turn).get('truncated', False)
+
+    def mark_resumed(self, convo_id: str, turn: int) -> None:
+        self._update_header(convo_id, turn, {'resumed_at': time.time()})
+
+    def resumed_at(self, convo_id: str, turn: int) -> Optional[float]:
+        return self._header(convo_id, turn).get('resumed_at')
+
+    def latest_turn(self, convo_id: str) -> Optional[int]:
+        latest = MongoDBClient.get_stream_events().find_one({'convo_id': convo_id},
+                                                            projection={'turn': 1},
+                                                            sort=[('turn', -1)])
+        return latest['turn'] if latest is not None else None
+
+    def events_since(self, convo_id: str, turn: int, seq: int) -> tuple[list[tuple[int, str]], bool]:
+        records = MongoDBClient.get_stream_events().find({'convo_id': convo_id,
+                                                          'turn': turn,
+                                                          'seq': {'$gt': seq}}).sort('seq', 1)
+        events = []
+        for record in records:
+            if record.get('done'):
+                return events, True
+            events.append((record['seq'], record['data']))
+
+        if self.latest_turn(convo_id) != turn:
+            return events, True
+
+        return events, False
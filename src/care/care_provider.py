@@ -2,8 +2,10 @@ from abc import abstractmethod, ABC
 
 
 class CareSearch:
-    def __init__(self, search_terms: list[str]):
+    def __init__(self, search_terms: list[str], location: dict = None):
         self.search_terms = search_terms
+        # GeoJSON point of the user, as captured on the bot state.
+        self.location = location
 
 
 class CareResult:
@@ -1,7 +1,11 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
-from src.care.care_provider import CareSearch
+from src.care.care_provider import CareSearch, CareResult, CareProvider
 from src.care.google_place_care_provider import GooglePlaceCareProvider
+from src.care.local_index_care_provider import LocalIndexCareProvider
 
 
 # This is the interface between the care provider and the agent to reach find care
@@ -19,12 +23,26 @@ class CareProviderRenderer:
         </div>
         """)
 
-    def __init__(self):
-        self.care_provider = GooglePlaceCareProvider()
+    # Shared across renderers, so that the specialist and fallback searches can be issued side by side.
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='care-search')
 
-    def render(self, search_obj: CareSearch) -> str:
+    def __init__(self, care_provider: CareProvider = None, fallback_provider: CareProvider = None):
+        # CARE_PROVIDER=local serves find care entirely from the local index, e.g. for load tests.
+        # LOCAL_CARE_FALLBACK=true keeps google as primary, and answers from the local index when it fails or is empty.
+        if care_provider is None:
+            care_provider = LocalIndexCareProvider() if os.getenv('CARE_PROVIDER', 'google') == 'local' \
+                else GooglePlaceCareProvider()
 
-        results = self.care_provider.find(search_obj)
+        if fallback_provider is None and not isinstance(care_provider, LocalIndexCareProvider) and \
+                os.getenv('LOCAL_CARE_FALLBACK', 'false').lower() == 'true':
+            fallback_provider = LocalIndexCareProvider()
+
+        self.care_provider = care_provider
+        self.fallback_provider = fallback_provider
+
+    def render(self, search_obj: CareSearch, fallback: CareSearch = None) -> str:
+
+        results = self._find(search_obj, fallback)
 
         if results.__len__() == 0:
             return ""
@@ -49,3 +67,40 @@ class CareProviderRenderer:
                                                           phone=phone, rating=rating, index=i+1)
         return html_response
 
+    def _find(self, search_obj: CareSearch, fallback: CareSearch = None) -> list[CareResult]:
+        """
+        Finds care for the search, and for the fallback search concurrently if one is given.
+        The first non-empty result is returned in priority order, i.e. the fallback is only used
+        when the primary search finds nothing.
+        """
+        if fallback is None:
+            return self._find_from_providers(search_obj)
+
+        primary = CareProviderRenderer.executor.submit(self._find_from_providers, search_obj)
+        secondary = CareProviderRenderer.executor.submit(self._find_from_providers, fallback)
+
+        results = primary.result()
+
+        if results.__len__() > 0:
+            return results
+
+        return secondary.result()
+
+    def _find_from_providers(self, search_obj: CareSearch) -> list[CareResult]:
+        """
+        Finds care with the primary provider, and with the fallback provider if the primary fails or finds nothing.
+        """
+        if self.fallback_provider is None:
+            return self.care_provider.find(search_obj)
+
+        try:
+            results = self.care_provider.find(search_obj)
+        except Exception as e:
+            logging.warning(f'Primary care provider failed for {search_obj.search_terms}, using fallback provider',
+                            exc_info=e)
+            return self.fallback_provider.find(search_obj)
+
+        if results.__len__() == 0:
+            return self.fallback_provider.find(search_obj)
+
+        return results
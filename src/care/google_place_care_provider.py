@@ -1,13 +1,54 @@
 import os
+import re
+import threading
 
+import cachetools
 import requests
+from requests.adapters import HTTPAdapter
 
 from src.care.care_provider import CareProvider, CareSearch, CareResult
 
 
+def _create_session() -> requests.Session:
+    # A single pooled session keeps the TLS connection to places.googleapis.com alive across find care turns.
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=16))
+    return session
+
+
 class GooglePlaceCareProvider(CareProvider):
+    REQUEST_TIMEOUT = 10
+
+    # Results are cached by the normalized query, which carries both the search terms and the address.
+    search_cache = cachetools.TTLCache(maxsize=1000, ttl=6 * 60 * 60)
+    cache_lock = threading.Lock()
+    session = _create_session()
+
+    @staticmethod
+    def cache_key(search_obj: CareSearch) -> str:
+        """
+        Normalizes the search terms so that "Dermatologist near Austin, TX" and "dermatologist near austin tx"
+        share the same cache entry.
+        """
+        return ' '.join(re.sub(r'\W+', ' ', term.lower()).strip() for term in search_obj.search_terms).strip()
 
     def find(self, search_obj: CareSearch) -> list[CareResult]:
+        key = GooglePlaceCareProvider.cache_key(search_obj)
+
+        with GooglePlaceCareProvider.cache_lock:
+            cached_results = GooglePlaceCareProvider.search_cache.get(key)
+
+        if cached_results is not None:
+            return cached_results
+
+        care_results = self._search(search_obj)
+
+        with GooglePlaceCareProvider.cache_lock:
+            GooglePlaceCareProvider.search_cache[key] = care_results
+
+        return care_results
+
+    def _search(self, search_obj: CareSearch) -> list[CareResult]:
         query = ' '.join(search_obj.search_terms)
 
         payload = {
@@ -22,7 +63,8 @@ class GooglePlaceCareProvider(CareProvider):
                    'X-Goog-Api-Key': os.getenv('GOOGLE_API_KEY'),
                    'X-Goog-FieldMask': 'places.displayName,places.websiteUri,places.rating,places.shortFormattedAddress,places.businessStatus,places.internationalPhoneNumber,places.userRatingCount'}
 
-        response = requests.post(url, json=payload, headers=headers)
+        response = GooglePlaceCareProvider.session.post(url, json=payload, headers=headers,
+                                                        timeout=GooglePlaceCareProvider.REQUEST_TIMEOUT)
 
         if response.status_code != 200:
             raise GooglePlaceCareProvider.GoogleFindCareException(f"Unable to find care: {search_obj.search_terms}",
@@ -54,4 +96,3 @@ class GooglePlaceCareProvider(CareProvider):
             self.message = message
             self.code = code
             super().__init__(self.message)
-
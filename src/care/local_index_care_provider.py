@@ -0,0 +1,175 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import defaultdict
+
+from src.care.care_provider import CareProvider, CareSearch, CareResult
+from src.utils import haversine_km, KM_PER_DEGREE
+
+
+class LocalIndexCareProvider(CareProvider):
+    """
+    Offline care provider backed by a local provider dataset.
+
+    The dataset is a JSON list of providers, each with name, specialties, address, phone, website,
+    latitude, longitude, rating and rating_count. It is loaded once into a grid based spatial index and a
+    specialty inverted index, so a search never leaves the process.
+    """
+
+    # Size of a spatial grid cell in degrees. 0.5 degrees is roughly 55 km of latitude.
+    CELL_SIZE = 0.5
+    # Generic search terms which are answered by primary care providers.
+    GENERIC_TERMS = {'doctor', 'generalist', 'primary care', 'primary care physician'}
+    # How many kilometers a single star of rating is worth when ranking by distance and rating.
+    RATING_WEIGHT_KM = 2.0
+
+    def __init__(self, dataset_path: str = None, k: int = 3, max_distance_km: float = 80.0):
+        self.dataset_path = dataset_path or os.getenv('LOCAL_CARE_INDEX_PATH')
+        self.k = k
+        self.max_distance_km = max_distance_km
+        self.providers: list[dict] = []
+        self.specialty_index: dict[str, set[int]] = defaultdict(set)
+        self.grid: dict[tuple[int, int], list[int]] = defaultdict(list)
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+
+            if self.dataset_path is None or not os.path.exists(self.dataset_path):
+                logging.warning(f'Local care index dataset not found at {self.dataset_path}')
+                self._loaded = True
+                return
+
+            with open(self.dataset_path, 'r', encoding='utf-8') as file:
+                providers = json.load(file)
+
+            for provider in providers:
+                self.add(provider)
+
+            logging.info(f'Loaded {len(self.providers)} care providers into the local index')
+            self._loaded = True
+
+    def add(self, provider: dict):
+        """
+        Adds a provider to the spatial and specialty indexes.
+        """
+        index = len(self.providers)
+        self.providers.append(provider)
+
+        for specialty in provider.get('specialties', []):
+            self.specialty_index[specialty.lower().strip()].add(index)
+
+        if provider.get('latitude') is not None and provider.get('longitude') is not None:
+            self.grid[self._cell(provider['latitude'], provider['longitude'])].append(index)
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.CELL_SIZE), math.floor(lon / self.CELL_SIZE)
+
+    def find(self, search_obj: CareSearch) -> list[CareResult]:
+        self._load()
+
+        specialty_terms = [term.lower().strip() for term in search_obj.search_terms if not term.startswith('near ')]
+        address = next((term[len('near '):] for term in search_obj.search_terms if term.startswith('near ')), None)
+
+        candidates = self._match_specialties(specialty_terms)
+
+        if len(candidates) == 0:
+            return []
+
+        by_address = self._by_address(candidates, address) if address else []
+
+        if search_obj.location:
+            lon, lat = search_obj.location['coordinates']
+            ranked = self._nearest(candidates, lat, lon)
+            # The user may be looking for care somewhere else than where they are. When the typed address
+            # is nowhere near the stored location, it wins.
+            if len(by_address) > 0 and not any(index in ranked for index in by_address):
+                ranked = by_address
+        else:
+            ranked = by_address
+
+        return [self._to_result(self.providers[index]) for index in ranked[:self.k]]
+
+    def _match_specialties(self, terms: list[str]) -> set[int]:
+        matched = set()
+        for term in terms:
+            if term in self.GENERIC_TERMS:
+                term = 'primary care'
+            matched |= self.specialty_index.get(term, set())
+        return matched
+
+    def _nearest(self, candidates: set[int], lat: float, lon: float) -> list[int]:
+        """
+        Ranks candidates within max_distance_km of the point by distance, with a bonus for rating.
+        Only the grid cells overlapping the search radius are visited.
+        """
+        lat_rings = math.ceil(self.max_distance_km / (KM_PER_DEGREE * self.CELL_SIZE))
+        lon_km_per_degree = max(KM_PER_DEGREE * math.cos(math.radians(lat)), 1.0)
+        lon_rings = math.ceil(self.max_distance_km / (lon_km_per_degree * self.CELL_SIZE))
+
+        cell_lat, cell_lon = self._cell(lat, lon)
+        scored = []
+        for i in range(cell_lat - lat_rings, cell_lat + lat_rings + 1):
+            for j in range(cell_lon - lon_rings, cell_lon + lon_rings + 1):
+                for index in self.grid.get((i, j), []):
+                    if index not in candidates:
+                        continue
+
+                    provider = self.providers[index]
+                    distance = haversine_km(lat, lon, provider['latitude'], provider['longitude'])
+                    if distance > self.max_distance_km:
+                        continue
+
+                    score = distance - self.RATING_WEIGHT_KM * float(provider.get('rating') or 0)
+                    scored.append((score, distance, index))
+
+        scored.sort()
+        return [index for _, _, index in scored]
+
+    @staticmethod
+    def _address_parts(address: str) -> list[str]:
+        """
+        Normalized comma separated parts of an address, without zip codes.
+        """
+        parts = [re.sub(r'\b\d{5}(-\d{4})?\b', ' ', part.lower()) for part in address.split(',')]
+        parts = [re.sub(r'\W+', ' ', part).strip() for part in parts]
+        return [part for part in parts if part != '']
+
+    def _by_address(self, candidates: set[int], address: str) -> list[int]:
+        """
+        Matches the providers on the city and state of the address, and ranks them by rating.
+        Addresses are expected in the usual "street, city, state zip" form, of which only the city is required.
+        """
+        parts = self._address_parts(address)
+
+        if len(parts) == 0:
+            return []
+
+        if len(parts) >= 2 and len(parts[-1]) == 2:
+            city, state = parts[-2], parts[-1]
+        else:
+            city, state = parts[-1], None
+
+        matched = []
+        for index in candidates:
+            provider_parts = self._address_parts(self.providers[index].get('address') or '')
+            if city in provider_parts and (state is None or state in provider_parts):
+                matched.append(index)
+
+        return sorted(matched, key=lambda index: (-float(self.providers[index].get('rating') or 0),
+                                                  -int(self.providers[index].get('rating_count') or 0)))
+
+    @staticmethod
+    def _to_result(provider: dict) -> CareResult:
+        return CareResult(provider.get('name'),
+                          provider.get('address'),
+                          provider.get('phone'),
+                          provider.get('website'),
+                          provider.get('rating'),
+                          provider.get('rating_count'))
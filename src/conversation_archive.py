@@ -0,0 +1,129 @@
+"""
+Archive of idle conversations, out of the collections every /ask turn reads.
+
+Conversations which have not been updated for ARCHIVE_IDLE_DAYS are moved, bot state and full conversation history
+together, into a single compressed BSON blob of the conversation_archive collection. Most of them are anonymous
+sessions which never come back. The ones which do are rehydrated as soon as their bot state or history is loaded,
+so archiving is transparent to the bot. A conversation is archived under its conversation lease, so that it never
+races with a turn. Legacy conversations, saved before last_updated was, are idle since they were created.
+
+Only BotState and BotConvHist rehydrate archived conversations. Code reading the collection directly, like reports,
+analytics, ATS or admin queries, does not see them anymore.
+"""
+
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+
+import bson
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+
+from src.bot_lease import ConversationLease
+from src.stats import counts_as_dx
+from src.utils import MongoDBClient
+
+
+class ConversationArchive:
+    IDLE = timedelta(days=int(os.getenv('ARCHIVE_IDLE_DAYS', '30')))
+    # Bounds the duration of an archival run, the next run picks up the rest
+    MAX_PER_RUN = int(os.getenv('ARCHIVE_MAX_PER_RUN', '5000'))
+    COMPRESSION_LEVEL = 6
+
+    @staticmethod
+    def pack(botstate: dict, full_conv_hist: dict | None) -> bytes:
+        return zlib.compress(bson.encode({'botstate': botstate, 'full_conv_hist': full_conv_hist}),
+                             ConversationArchive.COMPRESSION_LEVEL)
+
+    @staticmethod
+    def unpack(blob: bytes) -> dict:
+        return bson.decode(zlib.decompress(blob))
+
+    @staticmethod
+    def archive(record: dict) -> bool:
+        """
+        Archives the conversation of the bot state record, unless it is in use. Returns whether it was archived.
+        """
+        username = record['username']
+        lease = ConversationLease.try_acquire(username)
+        if lease is None:
+            return False
+
+        try:
+            full_conv_hist = MongoDBClient.get_full_conv_hist().find_one({'conversation_id': username})
+            blob = ConversationArchive.pack(record, full_conv_hist)
+            MongoDBClient.get_conversation_archive().replace_one(
+                {'_id': username},
+                {'blob': Binary(blob), 'size': len(blob), 'last_updated': record.get('last_updated') or record.get('created'),
+                 # Kept out of the blob, for reconcile_stats to count archived conversations
+                 'dx_counted': bool(record.get('dx_counted') or counts_as_dx(record.get('current_agent_name'))),
+                 'archived_at': datetime.now()},
+                upsert=True)
+
+            # Only the bot state as it was read is deleted. One written since is not idle anymore.
+            result = MongoDBClient.get_botstate().delete_one({'_id': record['_id'], 'revision': record.get('revision')})
+            if result.deleted_count == 0:
+                MongoDBClient.get_conversation_archive().delete_one({'_id': username})
+                return False
+
+            if full_conv_hist is not None:
+                MongoDBClient.get_full_conv_hist().delete_one({'_id': full_conv_hist['_id']})
+            return True
+        finally:
+            lease.release()
+
+    @staticmethod
+    def rehydrate(username: str) -> bool:
+        """
+        Restores an archived conversation. Returns whether it was archived.
+        """
+        archived = MongoDBClient.get_conversation_archive().find_one({'_id': username})
+        if archived is None:
+            return False
+
+        conversation = ConversationArchive.unpack(archived['blob'])
+        try:
+            # Inserts only, so that a conversation rehydrated concurrently is not overwritten
+            MongoDBClient.get_botstate().update_one({'username': username},
+                                                    {'$setOnInsert': conversation['botstate']}, upsert=True)
+            if conversation['full_conv_hist'] is not None:
+                MongoDBClient.get_full_conv_hist().update_one({'conversation_id': username},
+                                                              {'$setOnInsert': conversation['full_conv_hist']},
+                                                              upsert=True)
+        except DuplicateKeyError:
+            logging.info(f'Conversation {username} was rehydrated concurrently')
+
+        MongoDBClient.get_conversation_archive().delete_one({'_id': username})
+        logging.info(f'Rehydrated conversation {username}, archived at {archived["archived_at"]}')
+        return True
+
+
+def archive_idle_conversations(idle: timedelta = None, max_per_run: int = None) -> dict:
+    """
+    Archives the conversations idle for longer than `idle`, the oldest first.
+    """
+    idle = idle or ConversationArchive.IDLE
+    max_per_run = max_per_run or ConversationArchive.MAX_PER_RUN
+
+    # last_updated and created are ISO strings, which sort like the date
+    cutoff = (datetime.now() - idle).isoformat()
+    metrics = {'archived': 0, 'skipped': 0}
+    # Legacy conversations first, as they are the oldest
+    for query, sort in [({'last_updated': None, 'created': {'$lt': cutoff}}, 'created'),
+                        ({'last_updated': {'$lt': cutoff}}, 'last_updated')]:
+        limit = max_per_run - metrics['archived'] - metrics['skipped']
+        if limit <= 0:
+            break
+
+        records = MongoDBClient.get_botstate().find(query).sort(sort, 1).limit(limit).batch_size(100)
+        for record in records:
+            try:
+                archived = ConversationArchive.archive(record)
+            except Exception as e:
+                logging.error(f'Error archiving conversation {record.get("username")}', exc_info=e)
+                archived = False
+            metrics['archived' if archived else 'skipped'] += 1
+
+    logging.info(f'Archived idle conversations: {metrics}')
+    return metrics
@@ -0,0 +1,238 @@
+"""
+Diagnosis mappings, curated on the admin pages.
+
+Mappings are listed newest first, by created then _id, which are unique together. A page ends with an opaque cursor
+encoding the sort key of its last mapping, and the next page starts right after it, so paging costs the same at any
+depth and is not thrown off by mappings the LLM adds meanwhile. Exports iterate over the same order with a batched
+cursor, and are streamed, so that the memory they use does not grow with the collection.
+
+The diagnosis agent looks mappings up through an in-process cache. Admin edits are validated against the taxonomy,
+written in chunks of BULK_CHUNK_SIZE, and clear the cache of their process once per batch. Other processes see them
+once their cached mappings expire, after DX_MAPPING_CACHE_SECONDS.
+"""
+
+import base64
+import binascii
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Iterator, Optional, Tuple
+
+import cachetools
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.specialist import Specialist
+from src.sub_specialist import SubSpecialtyDxGroup
+from src.utils import MongoDBClient
+
+
+class DxMapping:
+    PROJECTION = {'diagnosis': 1, 'dx_group': 1, 'specialist': 1, 'created': 1, 'source': 1, 'bookmark': 1}
+    SORT = [('created', -1), ('_id', -1)]
+
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    EXPORT_BATCH_SIZE = 500
+
+    BULK_CHUNK_SIZE = 500
+    MAX_BULK_EDITS = 10_000
+
+    cache = cachetools.TTLCache(maxsize=10_000, ttl=int(os.getenv('DX_MAPPING_CACHE_SECONDS', '300')))
+    cache_lock = threading.Lock()
+
+    @staticmethod
+    def find(diagnosis: str) -> Optional[dict]:
+        with DxMapping.cache_lock:
+            mapping = DxMapping.cache.get(diagnosis)
+
+        # Misses are not cached, as the diagnosis agent maps them right after
+        if mapping is None:
+            mapping = MongoDBClient.get_dx_mapping().find_one({'diagnosis': diagnosis},
+                                                              projection=DxMapping.PROJECTION)
+            if mapping is not None:
+                with DxMapping.cache_lock:
+                    DxMapping.cache[diagnosis] = mapping
+
+        return mapping
+
+    @staticmethod
+    def invalidate() -> None:
+        with DxMapping.cache_lock:
+            DxMapping.cache.clear()
+
+    @staticmethod
+    def validate(edit) -> dict:
+        """
+        Returns the edit with the names of the taxonomy, raising ValueError for an edit which does not fit it.
+        """
+        if not isinstance(edit, dict):
+            raise ValueError('Edit must be an object')
+        if not isinstance(edit.get('diagnosis'), str) or not edit['diagnosis'].strip():
+            raise ValueError('diagnosis is required')
+
+        dx_group = SubSpecialtyDxGroup.from_inventory_name_no_default(str(edit.get('dx_group')))
+        if dx_group is None:
+            raise ValueError(f'Unknown dx_group {edit.get("dx_group")}')
+
+        specialist = next((specialist for specialist in Specialist
+                           if specialist.inventory_name.lower() == str(edit.get('specialist')).lower()), None)
+        if specialist is None:
+            raise ValueError(f'Unknown specialist {edit.get("specialist")}')
+        if dx_group.specialist != specialist:
+            raise ValueError(f'dx_group {dx_group.inventory_name} does not belong to {specialist.inventory_name}')
+
+        if edit.get('bookmark') is not None and not isinstance(edit['bookmark'], bool):
+            raise ValueError('bookmark must be a boolean')
+
+        return {'diagnosis': edit['diagnosis'], 'dx_group': dx_group.inventory_name,
+                'specialist': specialist.inventory_name, 'bookmark': edit.get('bookmark')}
+
+    @staticmethod
+    def update_operation(edit: dict, now: datetime) -> UpdateOne:
+        update_dict = {
+            'dx_group': edit['dx_group'],
+            'specialist': edit['specialist'],
+            'updated': now.isoformat(),
+        }
+        on_insert = {'created': now.isoformat()}
+
+        # we don't want to change source if bookmark is updated
+        if edit.get('bookmark') is not None:
+            update_dict['bookmark'] = edit['bookmark']
+            on_insert['source'] = 'admin'
+        else:
+            update_dict['source'] = 'admin'
+
+        return UpdateOne({'diagnosis': edit['diagnosis']}, {'$set': update_dict, '$setOnInsert': on_insert},
+                         upsert=True)
+
+    @staticmethod
+    def bulk_update(edits: list) -> list[dict]:
+        """
+        Applies the valid edits, and returns the result of every edit, in their order.
+        """
+        results = []
+        valid: list[Tuple[int, dict]] = []
+        diagnoses = set()
+
+        for index, edit in enumerate(edits):
+            try:
+                edit = DxMapping.validate(edit)
+                # The order of the writes is not guaranteed within a chunk
+                if edit['diagnosis'] in diagnoses:
+                    raise ValueError(f'diagnosis {edit["diagnosis"]} is edited more than once')
+                diagnoses.add(edit['diagnosis'])
+                valid.append((index, edit))
+                results.append({'index': index, 'diagnosis': edit['diagnosis'], 'status': 'pending'})
+            except ValueError as e:
+                results.append({'index': index, 'diagnosis': edit.get('diagnosis') if isinstance(edit, dict) else None,
+                                'status': 'invalid', 'error': str(e)})
+
+        now = datetime.now()
+        for start in range(0, len(valid), DxMapping.BULK_CHUNK_SIZE):
+            chunk = valid[start:start + DxMapping.BULK_CHUNK_SIZE]
+            existing = {record['diagnosis'] for record in MongoDBClient.get_dx_mapping().find(
+                {'diagnosis': {'$in': [edit['diagnosis'] for _, edit in chunk]}}, projection={'diagnosis': 1})}
+
+            errors = {}
+            try:
+                MongoDBClient.get_dx_mapping().bulk_write(
+                    [DxMapping.update_operation(edit, now) for _, edit in chunk], ordered=False)
+            except BulkWriteError as e:
+                errors = {error['index']: error['errmsg'] for error in e.details.get('writeErrors', [])}
+
+            for position, (index, edit) in enumerate(chunk):
+                if position in errors:
+                    results[index].update({'status': 'failed', 'error': errors[position]})
+                else:
+                    results[index]['status'] = 'updated' if edit['diagnosis'] in existing else 'created'
+
+        if len(valid) > 0:
+            DxMapping.invalidate()
+
+        return results
+
+    @staticmethod
+    def query(source: str = None, dx_group: str = None, bookmark: bool = None) -> dict:
+        query = {}
+        if source is not None:
+            query['source'] = source
+        if dx_group is not None:
+            query['dx_group'] = dx_group
+        if bookmark is not None:
+            query['bookmark'] = True if bookmark else {'$ne': True}
+        return query
+
+    @staticmethod
+    def encode_cursor(record: dict) -> str:
+        key = json.dumps([record.get('created'), str(record['_id'])])
+        return base64.urlsafe_b64encode(key.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> dict:
+        """
+        Returns the query of the mappings after the cursor, raising ValueError for a malformed cursor.
+        """
+        try:
+            created, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            _id = ObjectId(_id)
+        except (binascii.Error, UnicodeDecodeError, TypeError, InvalidId, ValueError) as e:
+            raise ValueError(f'Invalid cursor {cursor}') from e
+
+        if created is None:
+            # Mappings without created sort last
+            return {'created': None, '_id': {'$lt': _id}}
+        return {'$or': [{'created': {'$lt': created}},
+                        {'created': created, '_id': {'$lt': _id}},
+                        {'created': None}]}
+
+    @staticmethod
+    def page(query: dict, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> Tuple[list[dict], Optional[str]]:
+        """
+        Returns a page of mappings, and the cursor of the next page, if there is one.
+        """
+        if cursor is not None:
+            query = {'$and': [query, DxMapping.decode_cursor(cursor)]}
+
+        # One more than the page tells whether there is a next page
+        records = list(MongoDBClient.get_dx_mapping().find(query, projection=DxMapping.PROJECTION)
+                       .sort(DxMapping.SORT).limit(limit + 1))
+
+        next_cursor = DxMapping.encode_cursor(records[limit - 1]) if len(records) > limit else None
+        return [DxMapping.to_json(record) for record in records[:limit]], next_cursor
+
+    @staticmethod
+    def export(query: dict) -> Iterator[dict]:
+        records = MongoDBClient.get_dx_mapping().find(query, projection=DxMapping.PROJECTION) \
+            .sort(DxMapping.SORT).batch_size(DxMapping.EXPORT_BATCH_SIZE)
+        for record in records:
+            yield DxMapping.to_json(record)
+
+    @staticmethod
+    def to_json(record: dict) -> dict:
+        source_ = {
+            'diagnosis': record['diagnosis'],
+            'dx_group': record.get('dx_group'),
+            'specialist': record.get('specialist'),
+            'created': record.get('created'),
+            'source': record.get('source'),
+        }
+
+        if record.get('bookmark'):
+            source_['bookmark'] = record['bookmark']
+
+        return source_
+
+
+def json_array(items: Iterator[dict]) -> Iterator[str]:
+    """
+    Serializes the items as a JSON array, one item at a time.
+    """
+    yield '['
+    for index, item in enumerate(items):
+        yield (',' if index > 0 else '') + json.dumps(item)
+    yield ']'
@@ -1,5 +1,10 @@
+import logging
+import os
+import uuid
 from datetime import timedelta, datetime
 
+from pymongo import UpdateOne
+
 from src.bot_state import BotState
 from src.followup.followup_care_state import FollowUpCareState, FollowupState
 from src.utils import MongoDBClient
@@ -10,6 +15,9 @@ from src.utils import MongoDBClient
 
 
 class FollowupCare:
+    # Failed sends are retried RETRY_DELAY later, doubling on every attempt, until MAX_SEND_ATTEMPTS.
+    MAX_SEND_ATTEMPTS = int(os.getenv('FOLLOWUP_MAX_SEND_ATTEMPTS', '5'))
+    RETRY_DELAY = timedelta(hours=1)
 
     @staticmethod
     def enroll_convo(state: BotState, profile: dict):
@@ -55,19 +63,36 @@ class FollowupCare:
         return None
 
     @staticmethod
-    def eligible_convo_with_lock() -> FollowUpCareState:
-        today_date_time = datetime.today()
-        record = MongoDBClient.get_followup_care().find_one_and_update(
-            filter={
-                'state': {'$nin': FollowupState.state_not_eligible_for_followups()},
-                'next_followup_date': {'$lte': today_date_time},
-                'is_locked': False,
-            },
-            update={'$set': {'is_locked': True}},
-            return_document=True
-        )
-
-        return FollowUpCareState().populate_fields(record) if record else None
+    def claim_eligible_convos(limit: int, lease: timedelta) -> list[FollowUpCareState]:
+        """
+        Claims up to limit records which are due for a followup, with a lease which expires on its own,
+        so that a crashed scheduler never leaves records locked.
+        """
+        now = datetime.today()
+        claimable = {
+            'state': {'$nin': FollowupState.state_not_eligible_for_followups()},
+            'next_followup_date': {'$lte': now},
+            # Records still locked by the legacy boolean lock are left alone
+            'is_locked': {'$ne': True},
+            'dead_letter': {'$ne': True},
+            '$or': [{'locked_until': None}, {'locked_until': {'$lt': now}}],
+        }
+        # The longest due first, so that no record starves behind the others
+        candidate_ids = [record['_id'] for record in
+                         MongoDBClient.get_followup_care().find(claimable, projection={'_id': 1})
+                         .sort('next_followup_date', 1).limit(limit)]
+
+        if len(candidate_ids) == 0:
+            return []
+
+        # Candidates claimed by another scheduler in the meantime no longer match the filter.
+        lock_owner = uuid.uuid4().hex
+        MongoDBClient.get_followup_care().update_many(
+            filter={'_id': {'$in': candidate_ids}, **claimable},
+            update={'$set': {'locked_until': now + lease, 'lock_owner': lock_owner}})
+
+        records = MongoDBClient.get_followup_care().find({'_id': {'$in': candidate_ids}, 'lock_owner': lock_owner})
+        return [FollowUpCareState().populate_fields(record) for record in records]
 
     @staticmethod
     def update_followup_outcome(convo_id: str, outcome: str):
@@ -84,9 +109,9 @@ class FollowupCare:
             followup.upsert_to_db()
 
     @staticmethod
-    def release_lock_update_state(followup: FollowUpCareState):
+    def _advance_state(followup: FollowUpCareState):
         """
-        Releases the lock and updates the followup date on the followup care record.
+        Moves the followup to its next state and followup date, and releases its lock.
         """
         followup.state = FollowupCare._next_state(followup.state)
         followup.state_initiated = False
@@ -98,9 +123,58 @@ class FollowupCare:
         else:
             followup.next_followup_date = None
 
-        followup.is_locked = False  # Release the lock
+        followup.send_attempts = 0
+
+        # Release the lock
+        followup.is_locked = False
+        followup.locked_until = None
+        followup.lock_owner = None
+
+    @staticmethod
+    def release_lock_update_state(followup: FollowUpCareState):
+        """
+        Releases the lock and updates the followup date on the followup care record.
+        """
+        FollowupCare._advance_state(followup)
         followup.upsert_to_db()  # Writing to the database
 
+    @staticmethod
+    def complete_followups(sent: list[FollowUpCareState], failed: list[tuple[FollowUpCareState, str]]):
+        """
+        Writes back a processed batch in one round trip. Sent followups move to their next state. Failed ones are
+        released with their next followup date pushed back, and dead-lettered after MAX_SEND_ATTEMPTS.
+        """
+        now = datetime.today()
+        operations = []
+        for followup in sent:
+            # Only while the claim is still ours. An expired claim may have been taken by another scheduler.
+            claim = {'convo_id': followup.convo_id, 'lock_owner': followup.lock_owner}
+            FollowupCare._advance_state(followup)
+            operations.append(UpdateOne(claim,
+                                        {'$set': {'state': followup.state.inventory_name,
+                                                  'state_initiated': followup.state_initiated,
+                                                  'next_followup_date': followup.next_followup_date,
+                                                  'is_locked': False,
+                                                  'locked_until': None,
+                                                  'lock_owner': None,
+                                                  'send_attempts': 0,
+                                                  'last_send_error': None,
+                                                  'updated': now}}))
+        for followup, error in failed:
+            attempts = followup.send_attempts + 1
+            update = {'send_attempts': attempts, 'last_send_error': error, 'locked_until': None, 'lock_owner': None,
+                      'updated': now}
+            if attempts >= FollowupCare.MAX_SEND_ATTEMPTS:
+                logging.error(f'Dead-lettering followup {followup.convo_id} after {attempts} attempts: {error}')
+                update['dead_letter'] = True
+            else:
+                update['next_followup_date'] = now + FollowupCare.RETRY_DELAY * 2 ** (attempts - 1)
+            operations.append(UpdateOne({'convo_id': followup.convo_id, 'lock_owner': followup.lock_owner},
+                                        {'$set': update}))
+
+        if len(operations) > 0:
+            MongoDBClient.get_followup_care().bulk_write(operations, ordered=False)
+
     @staticmethod
     def _next_state(state: FollowupState) -> FollowupState:
         """Returns the next state in the followup state machine.
@@ -1,5 +1,7 @@
-import atexit
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 from src.followup.followup_care import FollowupCare
 from src.followup.followup_care_state import FollowUpCareState
@@ -8,26 +10,51 @@ from src.utils import MongoDBClient
 
 email_sender = EmailSender()
 
+BATCH_SIZE = int(os.getenv('FOLLOWUP_BATCH_SIZE', '50'))
+SEND_WORKERS = int(os.getenv('FOLLOWUP_SEND_WORKERS', '8'))
+# A claim outlives the processing of its batch by far. If the scheduler dies, the records are claimable again after.
+CLAIM_LEASE = timedelta(minutes=15)
+# Upper bound of batches per run, so that a run always ends.
+MAX_BATCHES = 100
+
+
+def _send_followup(followup_convo: FollowUpCareState) -> str | None:
+    """
+    Sends the followup email, and returns the error, if any.
+    """
+    try:
+        email_params = FollowUpEmailParameters(followup_convo.name, followup_convo.convo_id,
+                                               followup_convo.email_address)
+        email_sender.send_followup_email(email_params)
+        logging.info(f"Sent followup email to {followup_convo.email_address} for {followup_convo.convo_id}.")
+        return None
+    except Exception as e:
+        logging.error(f"Failed to send followup email for {followup_convo.convo_id}: {e}", exc_info=e)
+        return str(e)
+
 
 def process_followup_care():
     logging.info("Processing followup care.")
 
-    for _ in range(50):
-        followup_convo = FollowupCare.eligible_convo_with_lock()
+    with ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='followup') as executor:
+        for _ in range(MAX_BATCHES):
+            batch = FollowupCare.claim_eligible_convos(limit=BATCH_SIZE, lease=CLAIM_LEASE)
 
-        if followup_convo is None:
-            logging.info("No more followup care to process. Exiting.")
-            break
+            if len(batch) == 0:
+                logging.info("No more followup care to process. Exiting.")
+                break
 
-        logging.info(f"Processing followup care for {followup_convo.convo_id}")
+            logging.info(f"Processing followup care for {len(batch)} conversations")
 
-        email_params = FollowUpEmailParameters(followup_convo.name, followup_convo.convo_id, followup_convo.email_address)
-        email_sender.send_followup_email(email_params)
+            errors = list(executor.map(_send_followup, batch))
 
-        logging.info(f"Sent followup email to {followup_convo.email_address} for {followup_convo.convo_id}. "
-                     f"Released lock.")
+            sent = [followup for followup, error in zip(batch, errors) if error is None]
+            failed = [(followup, error) for followup, error in zip(batch, errors) if error is not None]
+            # Failed followups are pushed back, so that the next batches of this run carry on with the others.
+            FollowupCare.complete_followups(sent, failed)
 
-        FollowupCare.release_lock_update_state(followup_convo)
+            if len(failed) > 0:
+                logging.warning(f"Failed to send {len(failed)} followup emails, they will be retried later.")
 
 
 def send_test_email(convo_id: str):
@@ -42,13 +69,11 @@ def send_test_email(convo_id: str):
 
 
 def release_followup_care_locks():
-    # Not logging as logger might have been shut down by the time this function is called.
-    print("Application is shutting down. Releasing followup care locks.")
-    # release locks on the records which were locked 24 hours ago.
-    update_many = MongoDBClient.get_followup_care().update_many({'is_locked': True, },
-                                                                {'$set': {'is_locked': False}})
-
-    print(f"Released {update_many.modified_count} followup care locks.")
-
-
-atexit.register(release_followup_care_locks)
+    """
+    Releases all followup care claims. Claims expire on their own, this is only needed to retry right away.
+    """
+    update_many = MongoDBClient.get_followup_care().update_many(
+        {'$or': [{'is_locked': True}, {'locked_until': {'$ne': None}}]},
+        {'$set': {'is_locked': False, 'locked_until': None, 'lock_owner': None}})
+
+    logging.info(f"Released {update_many.modified_count} followup care locks.")
@@ -39,7 +39,15 @@ class FollowUpCareState(BaseModel):
     name: str = None
     state: FollowupState = FollowupState.NEW
     chief_complaint: str = None
+    # Legacy boolean lock, superseded by the claim lease below.
     is_locked: bool = False
+    # Claim of the scheduler processing the followup, which expires on its own.
+    locked_until: datetime = None
+    lock_owner: str = None
+    # Failed sends of the current state, retried with a backoff until dead-lettered.
+    send_attempts: int = 0
+    last_send_error: str = None
+    dead_letter: bool = False
     updated: datetime = None
     created: datetime = None
     next_followup_date: datetime = None
@@ -0,0 +1,117 @@
+"""
+Cluster-wide leader election for scheduled jobs.
+
+Every web worker on every node runs the same scheduler. A job only runs in the process which takes its lease,
+a document of the job_leases collection keyed by the job name. The holder renews the lease while the job runs,
+and once the job is done it records the run, so the other processes skip the job until the next interval.
+A failed run is recorded too, and the job is retried after a backoff, which doubles with every consecutive failure
+up to the interval. When the holder dies, its lease expires and the next process to fire the job takes over.
+"""
+
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from src.utils import MongoDBClient
+
+
+class JobLease:
+    TTL = int(os.getenv('JOB_LEASE_SECONDS', '300'))
+    # Fraction of the interval after which a job counts as due again, so that scheduler jitter between processes
+    # does not skip an interval.
+    DUE_FRACTION = 0.9
+    RETRY_DELAY = timedelta(seconds=int(os.getenv('JOB_RETRY_SECONDS', '60')))
+
+    def __init__(self, job_name: str, owner: str, interval: timedelta):
+        self.job_name = job_name
+        self.owner = owner
+        self.interval = interval
+
+    @classmethod
+    def try_acquire(cls, job_name: str, interval: timedelta) -> Optional['JobLease']:
+        owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        now = datetime.now()
+        try:
+            # Matches only a free lease of a job which is due. Otherwise the upsert collides on _id.
+            MongoDBClient.get_job_leases().update_one(
+                filter={'_id': job_name,
+                        'expires_at': {'$lte': now},
+                        '$and': [{'$or': [{'last_run_at': None},
+                                          {'last_run_at': {'$lte': now - interval * cls.DUE_FRACTION}}]},
+                                 {'$or': [{'retry_at': None}, {'retry_at': {'$lte': now}}]}]},
+                update={'$set': {'owner': owner, 'acquired_at': now, 'expires_at': now + timedelta(seconds=cls.TTL)}},
+                upsert=True)
+        except DuplicateKeyError:
+            return None
+        return cls(job_name, owner, interval)
+
+    def renew(self) -> bool:
+        result = MongoDBClient.get_job_leases().update_one(
+            filter={'_id': self.job_name, 'owner': self.owner},
+            update={'$set': {'expires_at': datetime.now() + timedelta(seconds=JobLease.TTL)}})
+        return result.matched_count > 0
+
+    def release(self, completed: bool) -> None:
+        """
+        Frees the lease. A completed run is recorded, so that the job is skipped until the next interval. A failed
+        one is recorded as an attempt, so that the job is skipped until its retry is due.
+        """
+        now = datetime.now()
+        if completed:
+            MongoDBClient.get_job_leases().update_one(
+                filter={'_id': self.job_name, 'owner': self.owner},
+                update={'$set': {'expires_at': now, 'last_run_at': now, 'last_attempt_at': now, 'failures': 0,
+                                 'retry_at': None}})
+            return
+
+        lease = MongoDBClient.get_job_leases().find_one_and_update(
+            filter={'_id': self.job_name, 'owner': self.owner},
+            update={'$set': {'last_attempt_at': now}, '$inc': {'failures': 1}},
+            return_document=ReturnDocument.AFTER)
+        failures = lease['failures'] if lease is not None else 1
+        retry_at = now + min(JobLease.RETRY_DELAY * 2 ** (failures - 1), self.interval)
+        logging.warning(f'Job {self.job_name} failed {failures} times in a row, retrying it at {retry_at}')
+        MongoDBClient.get_job_leases().update_one(filter={'_id': self.job_name, 'owner': self.owner},
+                                                  update={'$set': {'expires_at': now, 'retry_at': retry_at}})
+
+    def _keep_alive(self, done: threading.Event) -> None:
+        while not done.wait(JobLease.TTL / 3):
+            if not self.renew():
+                logging.warning(f'Lost the lease of job {self.job_name}')
+                return
+
+
+def leader_only(job: Callable, interval: timedelta, job_name: str = None) -> Callable:
+    """
+    Wraps a scheduled job, so that it runs once per interval across the cluster.
+    """
+    job_name = job_name or job.__name__
+
+    @wraps(job)
+    def run_if_leader(*args, **kwargs):
+        lease = JobLease.try_acquire(job_name, interval)
+        if lease is None:
+            logging.debug(f'Job {job_name} is not due or running elsewhere, skipping')
+            return None
+
+        logging.info(f'Running job {job_name} as {lease.owner}')
+        done = threading.Event()
+        threading.Thread(target=lease._keep_alive, args=(done,), daemon=True).start()
+        completed = False
+        try:
+            result = job(*args, **kwargs)
+            completed = True
+            return result
+        finally:
+            done.set()
+            lease.release(completed)
+
+    return run_if_leader
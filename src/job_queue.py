@@ -0,0 +1,162 @@
+"""
+Durable queue of background jobs, like pushing an offer to the EHR.
+
+Jobs are documents of the jobs collection, keyed by their type and an idempotency key, so that enqueuing the same
+job twice, e.g. on a redelivered webhook, is a no-op. Workers claim due jobs with a lease, run them on a bounded
+pool, and retry failed jobs with an exponential backoff. Jobs which still fail after MAX_ATTEMPTS are dead-lettered,
+and stay in the collection with their last error until retried by hand.
+"""
+
+import logging
+import os
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable
+
+from pymongo import UpdateOne
+
+from src.utils import MongoDBClient
+
+
+class JobQueue:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    DEAD = 'dead'
+
+    MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+    # A claim outlives a job by far. If the worker dies, the job is claimable again after.
+    CLAIM_LEASE = timedelta(minutes=int(os.getenv('JOB_LEASE_MINUTES', '10')))
+    BASE_DELAY = timedelta(seconds=30)
+    MAX_DELAY = timedelta(hours=1)
+
+    handlers: dict[str, Callable] = {}
+
+    @staticmethod
+    def register(job_type: str, handler: Callable) -> None:
+        """
+        Registers the handler of a job type. It is called with the payload of the job as keyword arguments.
+        """
+        JobQueue.handlers[job_type] = handler
+
+    @staticmethod
+    def enqueue(job_type: str, key: str, payload: dict) -> bool:
+        """
+        Enqueues a job, unless a job of the type with the same key was enqueued before. Returns whether it was new.
+        """
+        now = datetime.now()
+        result = MongoDBClient.get_jobs().update_one(
+            {'_id': f'{job_type}:{key}'},
+            {'$setOnInsert': {'type': job_type,
+                              'key': key,
+                              'payload': payload,
+                              'status': JobQueue.PENDING,
+                              'attempts': 0,
+                              'run_at': now,
+                              'created': now}},
+            upsert=True)
+
+        if result.upserted_id is None:
+            logging.info(f'Job {job_type} for {key} was already enqueued')
+            return False
+        return True
+
+    @staticmethod
+    def retry(job_id: str) -> bool:
+        """
+        Requeues a dead job.
+        """
+        result = MongoDBClient.get_jobs().update_one({'_id': job_id, 'status': JobQueue.DEAD},
+                                                     {'$set': {'status': JobQueue.PENDING,
+                                                               'attempts': 0,
+                                                               'run_at': datetime.now()}})
+        return result.modified_count > 0
+
+    @staticmethod
+    def claim(limit: int) -> list[dict]:
+        now = datetime.now()
+        claimable = {
+            '$or': [{'status': JobQueue.PENDING, 'run_at': {'$lte': now}},
+                    {'status': JobQueue.RUNNING, 'locked_until': {'$lt': now}}],
+        }
+        candidate_ids = [record['_id'] for record in
+                         MongoDBClient.get_jobs().find(claimable, projection={'_id': 1}).sort('run_at', 1).limit(limit)]
+
+        if len(candidate_ids) == 0:
+            return []
+
+        lock_owner = uuid.uuid4().hex
+        MongoDBClient.get_jobs().update_many(
+            filter={'_id': {'$in': candidate_ids}, **claimable},
+            update={'$set': {'status': JobQueue.RUNNING,
+                             'locked_until': now + JobQueue.CLAIM_LEASE,
+                             'lock_owner': lock_owner}})
+
+        return list(MongoDBClient.get_jobs().find({'_id': {'$in': candidate_ids}, 'lock_owner': lock_owner}))
+
+    @staticmethod
+    def run(job: dict) -> str | None:
+        """
+        Runs a claimed job, and returns its error, if any.
+        """
+        handler = JobQueue.handlers.get(job['type'])
+        if handler is None:
+            return f'No handler registered for job type {job["type"]}'
+
+        try:
+            handler(**job['payload'])
+            return None
+        except Exception as e:
+            logging.error(f'Job {job["_id"]} failed: {e}', exc_info=e)
+            return ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+    @staticmethod
+    def complete(results: list[tuple[dict, str | None]]) -> None:
+        now = datetime.now()
+        operations = []
+        for job, error in results:
+            attempts = job.get('attempts', 0) + 1
+            if error is None:
+                update = {'status': JobQueue.DONE, 'done_at': now}
+            elif attempts >= JobQueue.MAX_ATTEMPTS:
+                logging.error(f'Dead-lettering job {job["_id"]} after {attempts} attempts: {error}')
+                update = {'status': JobQueue.DEAD, 'last_error': error}
+            else:
+                delay = min(JobQueue.BASE_DELAY * 2 ** (attempts - 1), JobQueue.MAX_DELAY)
+                update = {'status': JobQueue.PENDING, 'run_at': now + delay, 'last_error': error}
+
+            # Filtered by the owner, so that a job whose lease expired and was claimed again is left to its new owner
+            operations.append(UpdateOne({'_id': job['_id'], 'lock_owner': job['lock_owner']},
+                                        {'$set': {**update, 'attempts': attempts,
+                                                  'locked_until': None, 'lock_owner': None}}))
+
+        if len(operations) > 0:
+            MongoDBClient.get_jobs().bulk_write(operations, ordered=False)
+
+    @staticmethod
+    def stats() -> dict:
+        counts = {status: 0 for status in [JobQueue.PENDING, JobQueue.RUNNING, JobQueue.DONE, JobQueue.DEAD]}
+        for record in MongoDBClient.get_jobs().aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[record['_id']] = record['count']
+        return counts
+
+
+def process_job_queue(batch_size: int = None, workers: int = None) -> int:
+    """
+    Runs the due jobs of the queue on a bounded pool, and returns how many ran.
+    """
+    batch_size = batch_size or int(os.getenv('JOB_QUEUE_BATCH_SIZE', '20'))
+    workers = workers or int(os.getenv('JOB_QUEUE_WORKERS', '4'))
+
+    jobs = JobQueue.claim(batch_size)
+    if len(jobs) == 0:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job') as pool:
+        errors = list(pool.map(JobQueue.run, jobs))
+
+    JobQueue.complete(list(zip(jobs, errors)))
+    logging.info(f'Ran {len(jobs)} jobs, {sum(error is not None for error in errors)} failed')
+    return len(jobs)
@@ -0,0 +1,274 @@
+"""
+Runner of the data migrations, like the update_* scripts at the root of the repo.
+
+A migration selects the documents of a collection, and computes the fields to set on each of them. The runner splits
+the selected range of created dates, or of _id, into partitions, which a pool of workers migrates in parallel. Each
+partition is read in (created, _id) order, written in chunks with bulk_write, and checkpointed after every chunk, so
+that a failed or interrupted run resumes where it stopped, as long as it is run again with the same partitions. A dry
+run writes nothing, and reports the diff it would apply instead.
+
+    python update_feedback.py --apply --workers 8
+"""
+
+import argparse
+import csv
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import dotenv
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from src.utils import MongoDBClient
+
+
+class Migration(ABC):
+    name: str
+    # created, compared as ISO strings, or _id
+    partition_field = 'created'
+    partition_size = timedelta(days=7)
+    projection: Optional[dict] = None
+
+    # Set by the runner
+    dry_run = True
+    runner: 'MigrationRunner' = None
+
+    @abstractmethod
+    def collection(self) -> Collection:
+        pass
+
+    @abstractmethod
+    def query(self) -> dict:
+        pass
+
+    @abstractmethod
+    def migrate(self, record: dict) -> Optional[dict]:
+        """
+        Returns the fields to set on the record, or None to leave it as is.
+        """
+        pass
+
+    def exception(self, record: dict, reason: str) -> None:
+        """
+        Reports a record which could not be migrated.
+        """
+        logging.info(f'{self.name}: {record.get("username", record["_id"])} {reason}')
+        if self.runner is not None:
+            self.runner.write_exception(record, reason)
+
+
+class MigrationRunner:
+    def __init__(self, migration: Migration, start: datetime = None, end: datetime = None, workers: int = 4,
+                 chunk_size: int = 500, dry_run: bool = True, restart: bool = False, diff_path: str = None,
+                 exceptions_path: str = None):
+        """
+        :param start: Start of the partitioned range, the oldest selected document by default.
+        :param end: End of the partitioned range, excluded, right after the newest selected document by default.
+        :param restart: Ignores the checkpoints of previous runs.
+        :param diff_path: JSON lines file of the changes, by default they are logged on dry runs only.
+        :param exceptions_path: CSV file of the records the migration could not migrate.
+        """
+        self.migration = migration
+        self.migration.dry_run = dry_run
+        self.migration.runner = self
+        self.start = start
+        self.end = end
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.restart = restart
+        self.diff_path = diff_path
+        self.exceptions_path = exceptions_path
+
+        self.lock = threading.Lock()
+        self.scanned = 0
+        self.changed = 0
+        self.total = 0
+        self.started_at = 0.0
+
+    def run(self) -> dict:
+        query = self.migration.query()
+        start, end = self._bounds(query)
+        if start is None:
+            logging.info(f'{self.migration.name}: nothing to migrate')
+            return {'scanned': 0, 'changed': 0, 'failed_partitions': []}
+
+        partitions = []
+        partition_start = start
+        while partition_start < end:
+            partitions.append((partition_start, min(partition_start + self.migration.partition_size, end)))
+            partition_start += self.migration.partition_size
+
+        self.total = self.migration.collection().count_documents({'$and': [query, self._range(start, end)]})
+        logging.info(f'{self.migration.name}: {self.total} documents from {start} to {end} in {len(partitions)} '
+                     f'partitions{" (dry run)" if self.dry_run else ""}')
+
+        self._open_reports()
+        self.started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='migration') as pool:
+            succeeded = list(pool.map(lambda partition: self._run_partition(query, *partition), partitions))
+
+        duration = time.monotonic() - self.started_at
+        metrics = {
+            'scanned': self.scanned,
+            'changed': self.changed,
+            'duration_seconds': round(duration, 1),
+            'throughput_per_second': round(self.scanned / duration, 1) if duration > 0 else None,
+            'failed_partitions': [str(partition[0]) for partition, ok in zip(partitions, succeeded) if not ok],
+        }
+        logging.info(f'{self.migration.name}: done {metrics}')
+        return metrics
+
+    def _bounds(self, query: dict) -> tuple:
+        field = self.migration.partition_field
+        start, end = self.start, self.end
+
+        if start is None:
+            first = self.migration.collection().find_one(query, projection={field: 1}, sort=[(field, 1)])
+            start = self._to_datetime(first[field]) if first else None
+        if end is None:
+            last = self.migration.collection().find_one(query, projection={field: 1}, sort=[(field, -1)])
+            # _id only has a precision of seconds
+            end = self._to_datetime(last[field]) + timedelta(seconds=1) if last else None
+
+        return start, end
+
+    def _to_datetime(self, value) -> datetime:
+        if isinstance(value, ObjectId):
+            return value.generation_time.replace(tzinfo=None)
+        return datetime.fromisoformat(value)
+
+    def _to_value(self, moment: datetime) -> Any:
+        if self.migration.partition_field == '_id':
+            return ObjectId.from_datetime(moment)
+        return moment.isoformat()
+
+    def _range(self, start: datetime, end: datetime) -> dict:
+        return {self.migration.partition_field: {'$gte': self._to_value(start), '$lt': self._to_value(end)}}
+
+    def _sort(self) -> list:
+        field = self.migration.partition_field
+        return [('_id', 1)] if field == '_id' else [(field, 1), ('_id', 1)]
+
+    def _after(self, checkpoint: dict) -> dict:
+        field = self.migration.partition_field
+        if field == '_id':
+            return {'_id': {'$gt': checkpoint['last_id']}}
+        return {'$or': [{field: {'$gt': checkpoint['last_value']}},
+                        {field: checkpoint['last_value'], '_id': {'$gt': checkpoint['last_id']}}]}
+
+    def _run_partition(self, query: dict, start: datetime, end: datetime) -> bool:
+        checkpoint_id = f'{self.migration.name}:{start.isoformat()}'
+        # Dry runs read the checkpoints too, so that they diff what is left to migrate
+        checkpoint = None if self.restart else MongoDBClient.get_migration_checkpoints().find_one({'_id': checkpoint_id})
+
+        if checkpoint is not None and checkpoint.get('done'):
+            return True
+
+        filters = [query, self._range(start, end)]
+        if checkpoint is not None:
+            filters.append(self._after(checkpoint))
+
+        records = self.migration.collection().find({'$and': filters}, projection=self.migration.projection) \
+            .sort(self._sort()).batch_size(self.chunk_size)
+
+        chunk = []
+        try:
+            for record in records:
+                chunk.append(record)
+                if len(chunk) == self.chunk_size:
+                    self._flush(chunk, checkpoint_id)
+                    chunk = []
+            self._flush(chunk, checkpoint_id, done=True)
+            return True
+        except Exception as e:
+            logging.error(f'{self.migration.name}: partition from {start} failed, it resumes from its last '
+                          f'checkpoint on the next run', exc_info=e)
+            return False
+
+    def _flush(self, chunk: list[dict], checkpoint_id: str, done: bool = False) -> None:
+        operations = []
+        diffs = []
+        for record in chunk:
+            update = self.migration.migrate(record)
+            if not update:
+                continue
+            operations.append(UpdateOne({'_id': record['_id']}, {'$set': update}))
+            diffs.append({'_id': str(record['_id']),
+                          'before': {field: record.get(field) for field in update},
+                          'after': update})
+
+        if not self.dry_run:
+            if len(operations) > 0:
+                self.migration.collection().bulk_write(operations, ordered=False)
+
+            checkpoint = {'migration': self.migration.name, 'done': done, 'updated': datetime.now()}
+            if len(chunk) > 0:
+                checkpoint['last_value'] = chunk[-1].get(self.migration.partition_field)
+                checkpoint['last_id'] = chunk[-1]['_id']
+            MongoDBClient.get_migration_checkpoints().update_one({'_id': checkpoint_id}, {'$set': checkpoint},
+                                                                 upsert=True)
+
+        with self.lock:
+            self.scanned += len(chunk)
+            self.changed += len(operations)
+            self._write_diffs(diffs)
+            if len(chunk) > 0:
+                elapsed = time.monotonic() - self.started_at
+                logging.info(f'{self.migration.name}: {self.scanned}/{self.total} scanned, {self.changed} changed, '
+                             f'{self.scanned / elapsed if elapsed > 0 else 0:.0f} documents/s')
+
+    def write_exception(self, record: dict, reason: str) -> None:
+        if self.exceptions_path is not None:
+            with self.lock, open(self.exceptions_path, 'a', newline='') as file:
+                csv.writer(file).writerow([record.get('created'), record.get('username'), reason])
+
+    def _open_reports(self) -> None:
+        if self.exceptions_path is not None:
+            with open(self.exceptions_path, 'w', newline='') as file:
+                csv.writer(file).writerow(['Created Date', 'Convo ID', 'Reason'])
+        if self.diff_path is not None:
+            open(self.diff_path, 'w').close()
+
+    def _write_diffs(self, diffs: list[dict]) -> None:
+        if self.diff_path is not None:
+            with open(self.diff_path, 'a') as file:
+                for diff in diffs:
+                    file.write(json.dumps(diff, default=str) + '\n')
+        elif self.dry_run:
+            for diff in diffs:
+                logging.info(f'{self.migration.name}: DRY RUN {json.dumps(diff, default=str)}')
+
+
+def main(migration: Migration, start: datetime = None, end: datetime = None) -> dict:
+    """
+    Runs the migration from the command line, as a dry run unless --apply is given.
+    """
+    parser = argparse.ArgumentParser(description=f'Runs the {migration.name} migration')
+    parser.add_argument('--apply', action='store_true', help='writes the changes, instead of a dry run')
+    parser.add_argument('--start', type=datetime.fromisoformat, default=start)
+    parser.add_argument('--end', type=datetime.fromisoformat, default=end)
+    parser.add_argument('--partition-days', type=float, help='size of the partitions, in days')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--restart', action='store_true', help='ignores the checkpoints of previous runs')
+    parser.add_argument('--diff', help='JSON lines file of the changes')
+    parser.add_argument('--exceptions', help='CSV file of the records which could not be migrated')
+    args = parser.parse_args()
+
+    dotenv.load_dotenv()
+    logging.getLogger().setLevel(logging.INFO)
+
+    if args.partition_days is not None:
+        migration.partition_size = timedelta(days=args.partition_days)
+
+    return MigrationRunner(migration, start=args.start, end=args.end, workers=args.workers,
+                           chunk_size=args.chunk_size, dry_run=not args.apply, restart=args.restart,
+                           diff_path=args.diff, exceptions_path=args.exceptions).run()
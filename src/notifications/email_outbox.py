@@ -0,0 +1,135 @@
+"""
+Outbox for transactional emails.
+
+Request paths only insert the email into the email_outbox collection. The dispatcher, run by the scheduler,
+claims pending emails, groups them by template and sender, and sends every group with as few Pinpoint calls as
+possible, each carrying many addresses. Failed emails are retried with an exponential backoff and given up on
+after MAX_ATTEMPTS.
+"""
+
+import logging
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from src.utils import MongoDBClient
+
+
+class EmailOutbox:
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    MAX_ATTEMPTS = 5
+    # Pinpoint accepts up to 100 addresses in a single send_messages call.
+    MAX_ADDRESSES = 100
+    # A claim outlives a dispatch by far. If the dispatcher dies, the emails are claimable again after.
+    CLAIM_LEASE = timedelta(minutes=10)
+
+    @staticmethod
+    def enqueue(template_param, substitutions: dict) -> None:
+        MongoDBClient.get_email_outbox().insert_one({
+            'template_name': template_param.template_name,
+            'template_version': template_param.template_version,
+            'from_address': template_param.from_address,
+            'email_address': template_param.email_address,
+            'substitutions': substitutions,
+            'status': EmailOutbox.PENDING,
+            'attempts': 0,
+            'next_attempt_at': datetime.now(),
+            'created': datetime.now(),
+        })
+
+    @staticmethod
+    def claim(limit: int) -> list[dict]:
+        now = datetime.now()
+        claimable = {
+            '$or': [{'status': EmailOutbox.PENDING, 'next_attempt_at': {'$lte': now}},
+                    {'status': EmailOutbox.SENDING, 'locked_until': {'$lt': now}}],
+        }
+        candidate_ids = [record['_id'] for record in
+                         MongoDBClient.get_email_outbox().find(claimable, projection={'_id': 1})
+                         .sort('created', 1).limit(limit)]
+
+        if len(candidate_ids) == 0:
+            return []
+
+        lock_owner = uuid.uuid4().hex
+        MongoDBClient.get_email_outbox().update_many(
+            filter={'_id': {'$in': candidate_ids}, **claimable},
+            update={'$set': {'status': EmailOutbox.SENDING,
+                             'locked_until': now + EmailOutbox.CLAIM_LEASE,
+                             'lock_owner': lock_owner}})
+
+        return list(MongoDBClient.get_email_outbox().find({'_id': {'$in': candidate_ids}, 'lock_owner': lock_owner}))
+
+    @staticmethod
+    def group(emails: list[dict]) -> list[list[dict]]:
+        """
+        Groups emails sharing a template and sender into send_messages calls. Addresses key the request,
+        so an address appears at most once per call.
+        """
+        calls: dict[tuple, list[list[dict]]] = {}
+        for email in emails:
+            key = (email['template_name'], email['template_version'], email['from_address'])
+            batches = calls.setdefault(key, [])
+            batch = next((batch for batch in batches
+                          if len(batch) < EmailOutbox.MAX_ADDRESSES and
+                          all(other['email_address'] != email['email_address'] for other in batch)), None)
+            if batch is None:
+                batch = []
+                batches.append(batch)
+            batch.append(email)
+        return [batch for batches in calls.values() for batch in batches]
+
+    @staticmethod
+    def complete(sent: list[dict], failed: list[dict]) -> None:
+        now = datetime.now()
+        operations = []
+        for email in sent:
+            operations.append(UpdateOne({'_id': email['_id']},
+                                        {'$set': {'status': EmailOutbox.SENT, 'sent_at': now,
+                                                  'locked_until': None, 'lock_owner': None}}))
+        for email in failed:
+            attempts = email.get('attempts', 0) + 1
+            if attempts >= EmailOutbox.MAX_ATTEMPTS:
+                logging.error(f"Giving up on email {email['template_name']} to {email['email_address']} "
+                              f"after {attempts} attempts")
+                update = {'status': EmailOutbox.FAILED}
+            else:
+                update = {'status': EmailOutbox.PENDING,
+                          'next_attempt_at': now + timedelta(minutes=2 ** attempts)}
+            operations.append(UpdateOne({'_id': email['_id']},
+                                        {'$set': {**update, 'attempts': attempts,
+                                                  'locked_until': None, 'lock_owner': None}}))
+
+        if len(operations) > 0:
+            MongoDBClient.get_email_outbox().bulk_write(operations, ordered=False)
+
+
+def dispatch_email_outbox(batch_size: int = 500, sender=None):
+    """
+    Sends the pending emails of the outbox.
+    """
+    from src.notifications.email_sender import EmailSender
+
+    sender = sender or EmailSender()
+
+    while True:
+        emails = EmailOutbox.claim(batch_size)
+        if len(emails) == 0:
+            return
+
+        sent, failed = [], []
+        for batch in EmailOutbox.group(emails):
+            delivered = sender.send_batch(batch)
+            for email in batch:
+                (sent if email['email_address'] in delivered else failed).append(email)
+
+        EmailOutbox.complete(sent, failed)
+        logging.info(f'Dispatched {len(sent)} emails from the outbox, {len(failed)} failed')
+
+        if len(emails) < batch_size or len(failed) > 0:
+            return
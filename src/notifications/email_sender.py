@@ -1,10 +1,21 @@
 import logging
 import os
+from functools import lru_cache
 
 import boto3
+
+from src.notifications.email_outbox import EmailOutbox
 from src.utils import base_url
 
 
+@lru_cache(maxsize=None)
+def pinpoint_client():
+    """
+    A single pinpoint client for the process. boto3 clients are thread safe, and costly to create.
+    """
+    return boto3.client('pinpoint', region_name='us-east-1')
+
+
 class FollowUpEmailParameters:
     def __init__(self, name: str, convo_id: str, email_address: str):
         self.template_version = '5'
@@ -76,11 +87,15 @@ class CodyCareCertifiedPlanEmailParameters:
 
 
 class EmailSender:
-    def __init__(self):
+    def __init__(self, outbox: bool = False):
+        """
+        With outbox, emails are only enqueued, to be sent by the outbox dispatcher. Request paths should use it.
+        """
+        self.outbox = outbox
         if os.getenv('MOCK_EMAIL', 'false') == 'true':
             self.pinpoint = None
         else:
-            self.pinpoint = boto3.client('pinpoint', region_name='us-east-1')
+            self.pinpoint = pinpoint_client()
         self.PINPOINT_APPLICATION_ID = '28381c0365eb45ba907d56fbdfcb8bbb' if os.getenv('ENVIRONMENT',
                                                                                        'dev') == 'production' else '92fcf7a945ad4634aa2852d22e3f8d9a'
 
@@ -141,6 +156,10 @@ class EmailSender:
                 f"""Not sending email in non-staging/production environment. Values received: €{template_param}""")
             return None
 
+        if self.outbox:
+            EmailOutbox.enqueue(template_param, substitutions)
+            return None
+
         try:
             response = self.pinpoint.send_messages(
                 ApplicationId=self.PINPOINT_APPLICATION_ID,
@@ -169,3 +188,38 @@ class EmailSender:
         except Exception as e:
             logging.error(f"""Error sending email: €{e}""", exc_info=e)
             return None
+
+    def send_batch(self, emails: list[dict]) -> set[str]:
+        """
+        Sends outbox emails sharing a template and sender with a single call, and returns the delivered addresses.
+        """
+        first = emails[0]
+        try:
+            response = self.pinpoint.send_messages(
+                ApplicationId=self.PINPOINT_APPLICATION_ID,
+                MessageRequest={
+                    'Addresses': {
+                        email['email_address']: {
+                            'ChannelType': 'EMAIL',
+                            'Substitutions': email['substitutions']
+                        } for email in emails
+                    },
+                    'MessageConfiguration': {
+                        'EmailMessage': {
+                            'FromAddress': first['from_address'],
+                        }
+                    },
+                    'TemplateConfiguration': {
+                        'EmailTemplate': {
+                            'Name': first['template_name'],
+                            'Version': first['template_version']
+                        }
+                    }
+                }
+            )
+        except Exception as e:
+            logging.error(f"""Error sending {len(emails)} emails: €{e}""", exc_info=e)
+            return set()
+
+        results = response['MessageResponse']['Result']
+        return {address for address, result in results.items() if result.get('DeliveryStatus') == 'SUCCESSFUL'}
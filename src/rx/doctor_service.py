@@ -7,16 +7,21 @@ from typing import Tuple
 import us
 
 from src.agents.cody_care_questionnaires import get_questionaire
+from src.bot_lease import ConversationLease
 from src.bot_state import BotState
+from src.job_queue import JobQueue
 from src.notifications.email_sender import EmailSender, CodyCareCertifiedPlanEmailParameters, \
     TaskAssignedHcpEmailParameters
-from src.rx.doctor_service_state import DoctorServiceOfferEvent, DoctorServiceOfferState
+from src.rx.doctor_service_state import DoctorServiceOfferEvent, DoctorServiceOfferState, DoctorServiceOfferHead
 from src.rx.ehr_service import EhrService
 from src.user.users_account import find_user, update_user_ehr_id
 from src.utils import MongoDBClient, base_url
 
 
 class DoctorService:
+    PROCESS_FOR_EHR_JOB = 'process_for_ehr'
+    PROCESS_FOR_CERTIFIED_PLAN_JOB = 'process_for_certified_plan'
+
     CONVO_DESCRIPTION_TEMPLATE = """
 Conversation ID: {convo_id}
 <br>
@@ -73,14 +78,27 @@ Top 3 Diagnoses: {top_3_diagnoses}
 
         doctor_service_state.insert_to_db()
 
+    @staticmethod
+    def _head(key: str, log_filter: dict) -> dict | None:
+        """
+        Returns the head of an offer or conversation. Heads missing for offers which predate them are rebuilt
+        from the event log.
+        """
+        head = DoctorServiceOfferHead.get(key)
+        if head is None:
+            head = MongoDBClient.get_doctor_service_offer().find_one(log_filter, sort=[('created', -1)])
+            if head is not None:
+                head.pop('_id')
+                DoctorServiceOfferHead.advance(head)
+        return head
+
     @staticmethod
     def latest_event(convo_id: str) -> DoctorServiceOfferState:
         """
         Returns the latest doctor service event for a user, if it exists.
         """
 
-        latest_offer = MongoDBClient.get_doctor_service_offer().find_one(
-            {'convo_id': convo_id}, sort=[('created', -1)])
+        latest_offer = DoctorService._head(DoctorServiceOfferHead.convo_key(convo_id), {'convo_id': convo_id})
 
         return DoctorServiceOfferState().populate_fields(latest_offer) if latest_offer else DoctorServiceOfferState()
 
@@ -90,8 +108,7 @@ Top 3 Diagnoses: {top_3_diagnoses}
         Returns the latest doctor service event for a user, if it exists.
         """
 
-        latest_offer = MongoDBClient.get_doctor_service_offer().find_one(
-            {'offer_id': offer_id}, sort=[('created', -1)])
+        latest_offer = DoctorService._head(DoctorServiceOfferHead.offer_key(offer_id), {'offer_id': offer_id})
 
         return DoctorServiceOfferState().populate_fields(latest_offer) if latest_offer else DoctorServiceOfferState()
 
@@ -101,8 +118,12 @@ Top 3 Diagnoses: {top_3_diagnoses}
         Returns the latest doctor service event for a user, if it exists.
         """
 
-        latest_offer = MongoDBClient.get_doctor_service_offer().find_one(
-            {'offer_id': offer_id, 'event': event.inventory_name}, sort=[('created', -1)])
+        latest_offer = DoctorService._head(DoctorServiceOfferHead.offer_key(offer_id), {'offer_id': offer_id})
+
+        # Only events older than the head of the offer need the event log
+        if latest_offer is not None and latest_offer['event'] != event.inventory_name:
+            latest_offer = MongoDBClient.get_doctor_service_offer().find_one(
+                {'offer_id': offer_id, 'event': event.inventory_name}, sort=[('created', -1)])
 
         return DoctorServiceOfferState().populate_fields(latest_offer) if latest_offer else DoctorServiceOfferState()
 
@@ -135,8 +156,7 @@ Top 3 Diagnoses: {top_3_diagnoses}
 
         Its being hardened to make sure only valid fields are updated and nothing else is possible to update.
         """
-        latest_offer = MongoDBClient.get_doctor_service_offer().find_one(
-            {'offer_id': offer_id}, sort=[('created', -1)])
+        latest_offer = DoctorService._head(DoctorServiceOfferHead.offer_key(offer_id), {'offer_id': offer_id})
 
         if latest_offer and latest_offer['event'] != event.inventory_name:
             raise Exception(
@@ -152,6 +172,40 @@ Top 3 Diagnoses: {top_3_diagnoses}
         MongoDBClient.get_doctor_service_offer().update_one({'offer_id': offer_id, 'event': event.inventory_name},
                                                             {'$set': update_record},
                                                             upsert=True)
+        DoctorServiceOfferHead.update_fields(offer_id, event, update_record)
+
+    @staticmethod
+    def enqueue_for_ehr(offer_id: str) -> None:
+        """
+        Queues sending the offer to the EHR. The job runs once per offer, however often the event is captured.
+        """
+        JobQueue.enqueue(DoctorService.PROCESS_FOR_EHR_JOB,
+                         f'{offer_id}:{DoctorServiceOfferEvent.SEND_TO_EHR.inventory_name}',
+                         {'offer_id': offer_id})
+
+    @staticmethod
+    def enqueue_for_certified_plan(offer_id: str) -> None:
+        """
+        Queues delivering the certified plan of the offer. Redelivered Akute webhooks do not queue it again.
+        """
+        JobQueue.enqueue(DoctorService.PROCESS_FOR_CERTIFIED_PLAN_JOB,
+                         f'{offer_id}:{DoctorServiceOfferEvent.EHR_TASK_DONE.inventory_name}',
+                         {'offer_id': offer_id})
+
+    @staticmethod
+    def process_job_for_ehr(offer_id: str) -> None:
+        # A retried job must not create a second task, if only the end of the previous attempt failed
+        if DoctorService.event_of_type(offer_id, DoctorServiceOfferEvent.EHR_SENT).user_id:
+            logging.info(f'Offer {offer_id} was already sent to the EHR. Skipping processing!')
+            return
+        DoctorService.process_for_ehr(offer_id)
+
+    @staticmethod
+    def process_job_for_certified_plan(offer_id: str) -> None:
+        if DoctorService.event_of_type(offer_id, DoctorServiceOfferEvent.EHR_PLAN_READY).user_id:
+            logging.info(f'Certified plan of offer {offer_id} was already delivered. Skipping processing!')
+            return
+        DoctorService.process_for_certified_plan(offer_id)
 
     @staticmethod
     def process_for_ehr(offer_id):
@@ -292,7 +346,7 @@ Top 3 Diagnoses: {top_3_diagnoses}
                                           'ehr_task_id': task_['data']['id']
                                       })
 
-                EmailSender().send_task_assigned_hcp(
+                EmailSender(outbox=True).send_task_assigned_hcp(
                     TaskAssignedHcpEmailParameters(
                         name=hcp_match_event.hcp['name'],
                         email_address=hcp_match_event.hcp['email'],
@@ -304,7 +358,7 @@ Top 3 Diagnoses: {top_3_diagnoses}
                 admin_emails = os.getenv('ADMIN_EMAILS').split(',') if os.getenv('ADMIN_EMAILS') else []
 
                 for email in admin_emails:
-                    EmailSender().send_task_assigned_hcp(
+                    EmailSender(outbox=True).send_task_assigned_hcp(
                         TaskAssignedHcpEmailParameters(
                             name=email,
                             email_address=email,
@@ -349,23 +403,32 @@ Top 3 Diagnoses: {top_3_diagnoses}
             # Remove extra new lines to avoid multiple bubbles
             plan = re.sub('\n{3,}', '\n\n', plan)
 
-            # Need to update current agent to CodyCareAgent in case user had interacted with other agents.
-            from src.bot import Bot
-            bot = Bot(username=event_of_type.convo_id)
-            from src import agents
-            plan = f"{bot.state.patient_name}, your Doctor completed your 🩺Certified Plan.\n\nPlease review your 🩺Certified Plan and Approve it below.\n\n\n" + plan
+            # Written like a turn, under the lease of the conversation. A busy conversation is retried by the queue.
+            lease = ConversationLease.acquire(event_of_type.convo_id)
+            if lease is None:
+                raise RuntimeError(f'Conversation {event_of_type.convo_id} is busy, the certified plan is retried')
 
             questionnaire = get_questionaire('plan_acknowledgement')
 
-            bot.full_conv_hist.append_token('\n\n\n' +
-                                            plan + '\n\n\n' +
-                                            DoctorService.HELP_TEXT + '\n\n\n' +
-                                            questionnaire[0]['question'])
-
-            bot.state.next_agent(name=agents.CodyCareAgent.name)
-            bot.update_conv()
-
-            EmailSender().send_cody_care_plan_ready(CodyCareCertifiedPlanEmailParameters(
+            try:
+                # Need to update current agent to CodyCareAgent in case user had interacted with other agents.
+                from src.bot import Bot
+                bot = Bot(username=event_of_type.convo_id)
+                from src import agents
+                plan = f"{bot.state.patient_name}, your Doctor completed your 🩺Certified Plan.\n\nPlease review your 🩺Certified Plan and Approve it below.\n\n\n" + plan
+
+                bot.full_conv_hist.append_token('\n\n\n' +
+                                                plan + '\n\n\n' +
+                                                DoctorService.HELP_TEXT + '\n\n\n' +
+                                                questionnaire[0]['question'])
+
+                bot.state.next_agent(name=agents.CodyCareAgent.name)
+                # A StaleBotStateError fails the job, which is retried on the state written meanwhile.
+                bot.update_conv()
+            finally:
+                lease.release()
+
+            EmailSender(outbox=True).send_cody_care_plan_ready(CodyCareCertifiedPlanEmailParameters(
                 name=bot.state.patient_name,
                 email_address=event_of_type.user_id,
                 convo_id=event_of_type.convo_id))
@@ -394,3 +457,7 @@ Top 3 Diagnoses: {top_3_diagnoses}
         except IndexError:
             # Record not found, meaning task id is not associated with any event.
             return None
+
+
+JobQueue.register(DoctorService.PROCESS_FOR_EHR_JOB, DoctorService.process_job_for_ehr)
+JobQueue.register(DoctorService.PROCESS_FOR_CERTIFIED_PLAN_JOB, DoctorService.process_job_for_certified_plan)
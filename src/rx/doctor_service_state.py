@@ -2,6 +2,7 @@ from datetime import datetime
 from enum import Enum
 
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 
 from src.utils import MongoDBClient
 
@@ -84,3 +85,62 @@ class DoctorServiceOfferState(BaseModel):
         data_dict['event'] = self.event.inventory_name
 
         MongoDBClient.get_doctor_service_offer().insert_one(data_dict)
+        data_dict.pop('_id')
+        DoctorServiceOfferHead.advance(data_dict)
+
+
+class DoctorServiceOfferHead:
+    """
+    Latest event of every offer and of every conversation, materialized from the append-only doctor_service_offer
+    event log into doctor_service_offer_head, so that the current state of an offer is a point lookup by _id.
+    Heads are advanced on every captured event, and rebuilt from the log for offers which predate them.
+    """
+
+    @staticmethod
+    def offer_key(offer_id: str) -> str:
+        return f'offer:{offer_id}'
+
+    @staticmethod
+    def convo_key(convo_id: str) -> str:
+        return f'convo:{convo_id}'
+
+    @staticmethod
+    def advance(record: dict) -> None:
+        """
+        Makes the event record the head of its offer and conversation, unless a later event already is.
+        """
+        keys = [DoctorServiceOfferHead.offer_key(record['offer_id'])]
+        if record.get('convo_id') is not None:
+            keys.append(DoctorServiceOfferHead.convo_key(record['convo_id']))
+
+        for key in keys:
+            try:
+                # Matches only a missing or older head. A later head makes the upsert collide on _id.
+                # Heads rebuilt from legacy events may carry a created which is not a date, and are always replaced.
+                MongoDBClient.get_doctor_service_offer_head().replace_one(
+                    {'_id': key, '$or': [{'created': {'$lte': record['created']}},
+                                         {'created': {'$not': {'$type': 'date'}}}]},
+                    record, upsert=True)
+            except DuplicateKeyError:
+                pass
+
+    @staticmethod
+    def get(key: str) -> dict | None:
+        return MongoDBClient.get_doctor_service_offer_head().find_one({'_id': key})
+
+    @staticmethod
+    def update_fields(offer_id: str, event: DoctorServiceOfferEvent, fields: dict) -> None:
+        """
+        Applies the updated fields of an event to the heads it is the latest event of.
+        """
+        head = DoctorServiceOfferHead.get(DoctorServiceOfferHead.offer_key(offer_id))
+        if head is None:
+            return
+
+        keys = [DoctorServiceOfferHead.offer_key(offer_id)]
+        if head.get('convo_id') is not None:
+            keys.append(DoctorServiceOfferHead.convo_key(head['convo_id']))
+
+        MongoDBClient.get_doctor_service_offer_head().update_many(
+            {'_id': {'$in': keys}, 'offer_id': offer_id, 'event': event.inventory_name},
+            {'$set': fields})
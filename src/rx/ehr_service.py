@@ -1,52 +1,90 @@
 import datetime
 import logging
 import os
+from collections import defaultdict
+from datetime import timedelta
 
-import cachetools
 import requests
 
+from src.shared_cache import SharedCache
+
+
+class PrescriberIndex:
+    """
+    Akute users compiled by licensed state, with the license expirations parsed once. For every state, it keeps
+    the latest expiration of any license, and the prescribers licensed there, the ones with a bio first.
+    """
+
+    def __init__(self, users: list[dict] | None):
+        self.users = users or []
+        self.expirations: dict[str, datetime.datetime] = {}
+        prescribers: dict[str, dict[str, tuple[datetime.datetime, dict]]] = defaultdict(dict)
+
+        for user in self.users:
+            for license_details in user['licenses']:
+                state = license_details['state'].lower()
+                expiration_date = datetime.datetime.strptime(license_details['expirationDate'], '%Y-%m-%d')
+
+                if state not in self.expirations or expiration_date > self.expirations[state]:
+                    self.expirations[state] = expiration_date
+
+                if 'Prescriber' not in user['roles']:
+                    continue
+
+                # A prescriber is licensed in a state until their latest license there expires
+                previous = prescribers[state].get(user['id'])
+                if previous is None or expiration_date > previous[0]:
+                    prescribers[state][user['id']] = (expiration_date, user)
+
+        # Sorting is stable, so prescribers keep the order of Akute within the ones with and without a bio
+        self.prescribers: dict[str, list[tuple[datetime.datetime, dict]]] = {
+            state: sorted(by_id.values(), key=lambda entry: not entry[1].get('bio'))
+            for state, by_id in prescribers.items()
+        }
+
+    def supported_states(self, today: datetime.datetime) -> set:
+        return {state for state, expiration_date in self.expirations.items() if expiration_date > today}
+
+    def match(self, state: str, today: datetime.datetime) -> dict | None:
+        return next((prescriber for expiration_date, prescriber in self.prescribers.get(state.lower(), [])
+                     if expiration_date > today), None)
+
 
 class EhrService:
-    service_cache = cachetools.TTLCache(maxsize=1000, ttl=24 * 60 * 60)
+    # Akute users shared by all workers, refreshed ahead of the 24 hours they used to be cached for.
+    prescribers_cache = SharedCache('akute_users',
+                                    fetch=lambda: EhrService()._fetch_prescribers(),
+                                    refresh_after=timedelta(hours=int(os.getenv('AKUTE_REFRESH_AFTER_HOURS', '20'))),
+                                    ttl=timedelta(hours=24),
+                                    compile=PrescriberIndex)
 
     def __init__(self):
         self.api_key = os.getenv('AKUTE_API_KEY')
         self.akute_base_url = os.getenv('AKUTE_BASE_URL')
 
+    @staticmethod
+    def warm_up():
+        """
+        Loads the shared reference data at boot, so that requests never wait on Akute for it.
+        """
+        EhrService.prescribers_cache.warm_up()
+
+    @staticmethod
+    def refresh_reference_data():
+        EhrService.prescribers_cache.refresh()
+
     def all_supported_state(self) -> set:
         """
         Fetches all supported states by Akute
         :return:
         """
-        cached_states = EhrService.service_cache.get('all_supported_state')
-
-        if cached_states:
-            return cached_states
-
-        prescribers = self._all_prescribers()
-
-        supported_states = set()
-        for prescriber in prescribers:
-            licenses_ = prescriber['licenses']
-
-            for license_details in licenses_:
-                expiration_date = datetime.datetime.strptime(
-                    license_details['expirationDate'], '%Y-%m-%d')
-                if expiration_date > datetime.datetime.today():
-                    supported_states.add(license_details['state'].lower())
-
-        EhrService.service_cache['all_supported_state'] = supported_states
+        return self._prescriber_index().supported_states(datetime.datetime.today())
 
-        return supported_states
-
-    def _all_prescribers(self) -> dict:
+    def _fetch_prescribers(self) -> list | None:
         """
         Fetch all prescribers
         :return:
         """
-        if EhrService.service_cache.get('all_prescribers'):
-            return EhrService.service_cache['all_prescribers']
-
         url = f'{self.akute_base_url}/v1/users'
         headers = {
             'X-API-KEY': f'{self.api_key}'
@@ -57,41 +95,29 @@ class EhrService:
         if response.status_code != 200:
             logging.error(
                 f'Failed to fetch all supported states. Response: {response.text}')
-            return []
+            return None
+
+        return response.json()
 
-        prescribers = response.json()
-        EhrService.service_cache['all_prescribers'] = prescribers
+    def _all_prescribers(self) -> list:
+        return self._prescriber_index().users
 
-        return prescribers
+    def _prescriber_index(self) -> PrescriberIndex:
+        return EhrService.prescribers_cache.get()
 
     def match_prescriber(self, search_params: dict) -> dict:
         """
         Match prescriber. Rite now in version 1.a this is really simple, but this is where most of the validation
         and matching logic will be implemented.
         """
-        prescribers = self._all_prescribers()
-
-        prescribers_with_license = []
-        for prescriber in prescribers:
-            if 'Prescriber' not in prescriber['roles']:
-                continue
-
-            licenses_ = prescriber['licenses']
-            for license_details in licenses_:
-                expiration_date = datetime.datetime.strptime(
-                    license_details['expirationDate'], '%Y-%m-%d')
-                if expiration_date > datetime.datetime.today() and license_details['state'].lower() == search_params[
-                    'state'].lower():
-                    prescribers_with_license.append(prescriber)
-                    break
-
-        for prescriber in prescribers_with_license:
-            if prescriber.get('bio'):
-                return prescriber
+        prescriber = self._prescriber_index().match(search_params['state'], datetime.datetime.today())
 
-        if len(prescribers_with_license) > 0:
-            prescriber = prescribers_with_license[0]
+        if prescriber is None:
+            return {}
 
+        if not prescriber.get('bio'):
+            # Copied, so that the cached prescriber is left untouched
+            prescriber = dict(prescriber)
             prescriber['bio'] = f"""{prescriber['first_name']} {prescriber['last_name']},
 
 Medical School: NA
@@ -99,9 +125,8 @@ Specialty: NA
 Experience: NA
 Pronouns: NA
 """
-            return prescriber
 
-        return {}
+        return prescriber
 
     def create_patient(self, patient_data: dict) -> dict:
         """
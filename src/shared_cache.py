@@ -0,0 +1,127 @@
+"""
+Reference data cache shared by all workers and nodes through the reference_data collection.
+
+A document per key holds the data along with its version and fetched_at. Every process keeps the latest version it
+read in memory, compiled into whatever structure serves its reads. Once the data is older than refresh_after, a
+read triggers a refresh in the background and keeps being served the data in memory, so no request waits on the
+source. A refresh first adopts data another worker already refreshed, and only calls the source when the shared
+document is due too. Failed refreshes keep the stale data in service until the source recovers.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional
+
+from pymongo import ReturnDocument
+
+from src.background import run_in_background
+from src.utils import MongoDBClient
+
+
+class SharedCache:
+    # How long to wait before trying the source again after a failed refresh
+    RETRY_INTERVAL = timedelta(minutes=1)
+
+    def __init__(self, key: str, fetch: Callable[[], Optional[Any]], refresh_after: timedelta, ttl: timedelta,
+                 compile: Callable[[Any], Any] = lambda data: data):
+        """
+        :param fetch: Fetches the data from the source, returning None when it fails.
+        :param refresh_after: Age of the data after which it is refreshed ahead of its expiry.
+        :param ttl: Age of the data after which serving it stale is logged.
+        :param compile: Compiles the fetched data into the value served by get.
+        """
+        self.key = key
+        self.fetch = fetch
+        self.refresh_after = refresh_after
+        self.ttl = ttl
+        self.compile = compile
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.clear()
+
+    def clear(self) -> None:
+        self.value = None
+        self.version = None
+        self.fetched_at: datetime = None
+        self.retry_at: datetime = None
+
+    def get(self) -> Any:
+        if self.version is None:
+            with self.lock:
+                # Cold start, only when the worker was not warmed up and no worker ever fetched the data.
+                if self.version is None and not self._load():
+                    logging.warning(f'No shared {self.key} yet, fetching it on the request path')
+                    self.refresh()
+        elif self._is_due(self.fetched_at) and self._can_retry():
+            self._refresh_in_background()
+
+        return self.value if self.version is not None else self.compile(None)
+
+    def warm_up(self) -> None:
+        """
+        Loads the data before serving requests, fetching it if it is missing or due.
+        """
+        if not self._load() or self._is_due(self.fetched_at):
+            self.refresh()
+
+    def refresh(self) -> None:
+        document = MongoDBClient.get_reference_data().find_one({'_id': self.key})
+        if document is not None and not self._is_due(document['fetched_at']):
+            # Another worker refreshed it already
+            self._adopt(document)
+            return
+
+        try:
+            data = self.fetch()
+        except Exception as e:
+            logging.error(f'Error refreshing {self.key}', exc_info=e)
+            data = None
+
+        if data is None:
+            self.retry_at = datetime.now() + SharedCache.RETRY_INTERVAL
+            if self.fetched_at is not None and datetime.now() - self.fetched_at > self.ttl:
+                logging.warning(f'Serving {self.key} fetched at {self.fetched_at}, as refreshing it failed')
+            return
+
+        document = MongoDBClient.get_reference_data().find_one_and_update(
+            {'_id': self.key},
+            {'$set': {'data': data, 'fetched_at': datetime.now()}, '$inc': {'version': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        self._adopt(document)
+        self.retry_at = None
+        logging.info(f'Refreshed {self.key} to version {self.version}')
+
+    def _load(self) -> bool:
+        document = MongoDBClient.get_reference_data().find_one({'_id': self.key})
+        if document is None:
+            return False
+        self._adopt(document)
+        return True
+
+    def _adopt(self, document: dict) -> None:
+        if document['version'] != self.version:
+            self.value = self.compile(document['data'])
+            self.version = document['version']
+        self.fetched_at = document['fetched_at']
+
+    def _can_retry(self) -> bool:
+        return self.retry_at is None or datetime.now() >= self.retry_at
+
+    def _is_due(self, fetched_at: datetime) -> bool:
+        return datetime.now() - fetched_at >= self.refresh_after
+
+    def _refresh_in_background(self) -> None:
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            finally:
+                self.refreshing = False
+
+        run_in_background(refresh)
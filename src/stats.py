@@ -0,0 +1,65 @@
+"""
+Public conversation stats.
+
+dxCount is the number of conversations which got past the intake agents. It is incremented once per conversation,
+when its bot state is first saved on a qualifying agent, and reconciled by a periodic job which recounts the same
+conversations, from the bot states and the archived conversations. /stats reads it through an in-process TTL cache.
+"""
+
+import logging
+import os
+import threading
+
+import cachetools
+
+from src.utils import MongoDBClient
+
+STATS_ID = 'global'
+
+# Conversations still on one of these agents do not count towards dxCount.
+INTAKE_AGENTS = ['', 'chief_complaint_agent', 'followup_agent', 'name_enquiry_agent']
+
+
+def counts_as_dx(agent_name: str) -> bool:
+    return agent_name is not None and agent_name not in INTAKE_AGENTS
+
+
+def increment_dx_count() -> None:
+    MongoDBClient.get_stats().update_one({'_id': STATS_ID}, {'$inc': {'dxCount': 1}}, upsert=True)
+
+
+def dx_counted_query() -> dict:
+    """
+    Query of the bot states counted in dxCount, flagged when counted, or on a qualifying agent if saved before.
+    """
+    return {'$or': [{'dx_counted': True}, {'current_agent_name': {'$nin': INTAKE_AGENTS + [None]}}]}
+
+
+def reconcile_stats() -> None:
+    """
+    Recounts dxCount from the bot states, correcting any drift of the incremental counter.
+    """
+    dx_count = MongoDBClient.get_botstate().count_documents(dx_counted_query()) + \
+        MongoDBClient.get_conversation_archive().count_documents({'dx_counted': True})
+
+    previous = MongoDBClient.get_stats().find_one_and_update({'_id': STATS_ID}, {'$set': {'dxCount': dx_count}},
+                                                             upsert=True)
+    # Drops the document left by the former $out based view
+    MongoDBClient.get_stats().delete_many({'_id': {'$ne': STATS_ID}})
+
+    logging.info(f'Reconciled dxCount to {dx_count}, drift was {dx_count - ((previous or {}).get("dxCount") or 0)}')
+
+
+stats_cache = cachetools.TTLCache(maxsize=1, ttl=int(os.getenv('STATS_CACHE_SECONDS', '60')))
+stats_cache_lock = threading.Lock()
+
+
+@cachetools.cached(stats_cache, lock=stats_cache_lock)
+def get_stats() -> dict:
+    stats_data = MongoDBClient.get_stats().find_one({'_id': STATS_ID})
+    if stats_data is None:
+        # Until the first reconciliation, only the document of the former $out based view exists
+        stats_data = MongoDBClient.get_stats().find_one({'dxCount': {'$exists': True}}, sort=[('dxCount', -1)]) or {}
+    return {
+        'dxCount': stats_data.get('dxCount', 0),
+    }
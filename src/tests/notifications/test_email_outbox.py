@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+import pytest
+
+from src.notifications.email_outbox import EmailOutbox, dispatch_email_outbox
+from src.notifications.email_sender import EmailSender, TaskAssignedHcpEmailParameters
+from src.utils import MongoDBClient
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    MongoDBClient.create_new_mock_instance()
+    monkeypatch.setenv('ENVIRONMENT', 'staging')
+    monkeypatch.setenv('MOCK_EMAIL', 'true')
+
+    def send_messages(ApplicationId, MessageRequest):
+        return {'MessageResponse': {'Result': {
+            address: {'DeliveryStatus': 'PERMANENT_FAILURE' if address.startswith('bounce') else 'SUCCESSFUL'}
+            for address in MessageRequest['Addresses']}}}
+
+    sender = EmailSender()
+    sender.pinpoint = Mock()
+    sender.pinpoint.send_messages.side_effect = send_messages
+    return sender
+
+
+def enqueue(email_address: str, task_id: str = 'task'):
+    EmailSender(outbox=True).send_task_assigned_hcp(
+        TaskAssignedHcpEmailParameters(name=email_address, email_address=email_address, task_id=task_id))
+
+
+def test_outbox_only_enqueues(sender):
+    enqueue('doctor@cody.md')
+
+    sender.pinpoint.send_messages.assert_not_called()
+    record = MongoDBClient.get_email_outbox().find_one({})
+    assert record['status'] == EmailOutbox.PENDING
+    assert record['template_name'] == 'Task_Assigned_HCP'
+
+
+def test_dispatch_batches_by_template(sender):
+    for i in range(3):
+        enqueue(f'admin_{i}@cody.md')
+
+    dispatch_email_outbox(sender=sender)
+
+    sender.pinpoint.send_messages.assert_called_once()
+    addresses = sender.pinpoint.send_messages.call_args[1]['MessageRequest']['Addresses']
+    assert sorted(addresses) == ['admin_0@cody.md', 'admin_1@cody.md', 'admin_2@cody.md']
+    assert MongoDBClient.get_email_outbox().count_documents({'status': EmailOutbox.SENT}) == 3
+
+
+def test_dispatch_splits_repeated_addresses(sender):
+    enqueue('admin@cody.md', task_id='task_1')
+    enqueue('admin@cody.md', task_id='task_2')
+
+    dispatch_email_outbox(sender=sender)
+
+    assert sender.pinpoint.send_messages.call_count == 2
+    assert MongoDBClient.get_email_outbox().count_documents({'status': EmailOutbox.SENT}) == 2
+
+
+def test_failed_emails_are_retried_with_backoff(sender):
+    enqueue('bounce@cody.md')
+    enqueue('admin@cody.md')
+
+    dispatch_email_outbox(sender=sender)
+
+    failed = MongoDBClient.get_email_outbox().find_one({'email_address': 'bounce@cody.md'})
+    assert failed['status'] == EmailOutbox.PENDING
+    assert failed['attempts'] == 1
+    assert failed['next_attempt_at'] > datetime.now()
+
+    # Not due yet
+    dispatch_email_outbox(sender=sender)
+    assert sender.pinpoint.send_messages.call_count == 1
+
+    MongoDBClient.get_email_outbox().update_one({'_id': failed['_id']},
+                                                {'$set': {'attempts': EmailOutbox.MAX_ATTEMPTS - 1,
+                                                          'next_attempt_at': datetime.now() - timedelta(minutes=1)}})
+    dispatch_email_outbox(sender=sender)
+
+    assert MongoDBClient.get_email_outbox().find_one({'_id': failed['_id']})['status'] == EmailOutbox.FAILED
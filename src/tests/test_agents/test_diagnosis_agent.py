@@ -10,6 +10,7 @@ from src.followup.followup_care_state import FollowupState
 from src.specialist import Specialist
 from src.sub_specialist import SubSpecialtyDxGroup
 from src.agents.diagnosis_agent import dx_group_dict
+from src.dx_mapping import DxMapping
 from src.utils import MongoDBClient, fake_llm
 from src.bot import Bot
 from src import agents
@@ -22,6 +23,7 @@ def client():
     os.environ['STREAMING'] = 'False'
     fake_llm.clear()
     MongoDBClient.create_new_mock_instance()
+    DxMapping.invalidate()
     yield MongoDBClient.get_dx_mapping_errors()
 
 
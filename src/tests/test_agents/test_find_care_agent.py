@@ -256,7 +256,7 @@ def test_find_care_agent_search_on_specialty_result():
 def test_find_care_agent_search_on_specialty_no_result_fallback_primary_care():
     bot_state = Mock()
     care_provider_renderer = Mock()
-    care_provider_renderer.render.side_effect = ['', 'Care Providers']
+    care_provider_renderer.render.return_value = 'Care Providers'
 
     bot_state.patient_name = 'Dave'
     bot_state.conv_hist = {
@@ -284,17 +284,17 @@ def test_find_care_agent_search_on_specialty_no_result_fallback_primary_care():
 
     find_care_agent.act()
 
-    assert care_provider_renderer.render.call_count == 2
-    [call1, call2] = care_provider_renderer.render.call_args_list
+    care_provider_renderer.render.assert_called_once()
+    [call1] = care_provider_renderer.render.call_args_list
     assert call1[0][0].search_terms == ['neurologist', 'attention deficit hyperactivity disorder', 'near Oslo, Norway']
-    assert call2[0][0].search_terms == ['attention deficit hyperactivity disorder', 'doctor', 'near Oslo, Norway']
+    assert call1[1]['fallback'].search_terms == ['attention deficit hyperactivity disorder', 'doctor', 'near Oslo, Norway']
     assert bot_state.conv_hist['find_care_agent'][2] == AIMessage(content='Care Providers\n\n\n')
 
 
 def test_find_care_agent_search_on_specialty_no_result_fallback_primary_care_no_result():
     bot_state = Mock()
     care_provider_renderer = Mock()
-    care_provider_renderer.render.side_effect = ['', '']
+    care_provider_renderer.render.return_value = ''
 
     bot_state.patient_name = 'Dave'
     bot_state.conv_hist = {
@@ -321,10 +321,10 @@ def test_find_care_agent_search_on_specialty_no_result_fallback_primary_care_no_
 
     find_care_agent.act()
 
-    assert care_provider_renderer.render.call_count == 2
-    [call1, call2] = care_provider_renderer.render.call_args_list
+    care_provider_renderer.render.assert_called_once()
+    [call1] = care_provider_renderer.render.call_args_list
     assert call1[0][0].search_terms == ['neurologist', 'attention deficit hyperactivity disorder', 'near Oslo, Norway']
-    assert call2[0][0].search_terms == ['attention deficit hyperactivity disorder', 'doctor', 'near Oslo, Norway']
+    assert call1[1]['fallback'].search_terms == ['attention deficit hyperactivity disorder', 'doctor', 'near Oslo, Norway']
     assert bot_state.conv_hist['find_care_agent'][2] == AIMessage(content="Sorry, I couldn't find any care options for you. Please try again by providing another address.\n\n\n")
 
 
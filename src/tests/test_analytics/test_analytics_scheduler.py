@@ -1,11 +1,21 @@
 import os
 
+import pytest
+
 from src.analytics.analytics_scheduler import process_conversations
+from src.analytics.reverse_geocoder import ReverseGeocoder, OfflineGazetteer
 from src.tests.utils import load_mogo_records
 from src.utils import MongoDBClient
 from src.tests.test_apis.utils import app_client
 
 
+@pytest.fixture(autouse=True)
+def reverse_geocoder(monkeypatch):
+    gazetteer = OfflineGazetteer(dataset_path=os.path.join(os.path.dirname(__file__), 'test_data', 'gazetteer.json'))
+    monkeypatch.setattr('src.analytics.analytics_scheduler.reverse_geocoder',
+                        ReverseGeocoder(gazetteer, nominatim_fallback=False))
+
+
 def test_process_conversations(app_client):
     os.environ['ENVIRONMENT'] = 'staging'
 
@@ -51,3 +61,33 @@ def test_process_conversations(app_client):
             assert convo[key] == expected_fields[key]
         else:
             assert False, f"Unexpected field found in convo: {key}. Update the test case accordingly"
+
+
+def test_process_conversations_in_batches(app_client, monkeypatch):
+    os.environ['ENVIRONMENT'] = 'staging'
+    monkeypatch.setattr('src.analytics.analytics_scheduler.BATCH_SIZE', 2)
+
+    for i in range(5):
+        MongoDBClient.get_botstate().insert_one({
+            'username': f'convo-{i}',
+            'created': '2024-03-10T12:02:22.607744',
+            'agent_names': ['concierge_agent', 'question_agent'],
+            'current_agent_index': 1,
+            'current_agent_name': '',
+            'conv_hist': {'question_agent': [{'role': 'assistant', 'content': 'How long?'}]},
+            'diagnosis_list': [],
+            'specialist': 'gastroenterologist',
+        })
+    MongoDBClient.get_botstate().insert_one({'username': 'convo-recent', 'created': '2999-01-01T00:00:00'})
+    MongoDBClient.get_sessions().insert_one({'ai_session': 'convo-3', 'userName': 'user@test.com'})
+
+    process_conversations()
+
+    analytics = {convo['convo_id']: convo for convo in MongoDBClient.get_convo_analytics().find()}
+    assert sorted(analytics.keys()) == [f'convo-{i}' for i in range(5)]
+    assert analytics['convo-0']['agent_reached'] == 'question_agent'
+    assert analytics['convo-0']['farthest_agent_reached'] == 'question_agent'
+    assert analytics['convo-0']['find_care_used'] is False
+    assert analytics['convo-0']['user_id'] == ''
+    assert analytics['convo-3']['user_id'] == 'user@test.com'
+    assert MongoDBClient.get_botstate().count_documents({'analytics_state': 'PROCESSED'}) == 5
@@ -0,0 +1,60 @@
+import os
+from unittest.mock import patch
+
+from src.analytics.reverse_geocoder import OfflineGazetteer, ReverseGeocoder, UNKNOWN_PLACE
+
+GAZETTEER = os.path.join(os.path.dirname(__file__), 'test_data', 'gazetteer.json')
+
+
+def test_gazetteer_nearest():
+    gazetteer = OfflineGazetteer(dataset_path=GAZETTEER)
+
+    assert gazetteer.nearest(28.4217, 77.0998)['name'] == 'Gurugram District'
+    assert gazetteer.nearest(28.63, 77.22)['name'] == 'New Delhi'
+    # Middle of the Atlantic, nothing within range
+    assert gazetteer.nearest(30.0, -40.0) is None
+
+
+def test_gazetteer_missing_dataset():
+    assert OfflineGazetteer(dataset_path='/nonexistent.json').nearest(28.4217, 77.0998) is None
+
+
+def test_reverse_is_cached_by_rounded_coordinates():
+    geocoder = ReverseGeocoder(OfflineGazetteer(dataset_path=GAZETTEER), nominatim_fallback=False)
+
+    with patch.object(geocoder.gazetteer, 'nearest', wraps=geocoder.gazetteer.nearest) as nearest:
+        assert geocoder.reverse(28.421657, 77.099804) == ('Gurugram District', 'Haryana', 'India', 'IN')
+        assert geocoder.reverse(28.421999, 77.100001) == ('Gurugram District', 'Haryana', 'India', 'IN')
+        assert nearest.call_count == 1
+
+
+def test_reverse_falls_back_to_nominatim():
+    geocoder = ReverseGeocoder(OfflineGazetteer(dataset_path=GAZETTEER), nominatim_fallback=True)
+
+    with patch.object(geocoder, '_reverse_nominatim', return_value=('', '', 'Atlantis', 'xx')) as nominatim:
+        assert geocoder.reverse(30.0, -40.0) == ('', '', 'Atlantis', 'xx')
+        nominatim.assert_called_once()
+
+
+def test_reverse_unknown_without_fallback():
+    geocoder = ReverseGeocoder(OfflineGazetteer(dataset_path=GAZETTEER), nominatim_fallback=False)
+
+    with patch.object(geocoder, '_reverse_nominatim') as nominatim:
+        assert geocoder.reverse(30.0, -40.0) == UNKNOWN_PLACE
+        nominatim.assert_not_called()
+
+
+def test_nominatim_errors_are_not_cached():
+    geocoder = ReverseGeocoder(OfflineGazetteer(dataset_path=GAZETTEER), nominatim_fallback=True)
+
+    with patch.object(geocoder, '_reverse_nominatim', side_effect=[Exception('Timeout'), ('', '', 'Atlantis', 'xx')]):
+        assert geocoder.reverse(30.0, -40.0) == UNKNOWN_PLACE
+        assert geocoder.reverse(30.0, -40.0) == ('', '', 'Atlantis', 'xx')
+
+
+def test_nominatim_fallback_by_default_without_gazetteer(monkeypatch):
+    monkeypatch.delenv('GEOCODE_NOMINATIM_FALLBACK', raising=False)
+    monkeypatch.delenv('GAZETTEER_PATH', raising=False)
+
+    assert ReverseGeocoder().nominatim_fallback
+    assert not ReverseGeocoder(OfflineGazetteer(dataset_path=GAZETTEER)).nominatim_fallback
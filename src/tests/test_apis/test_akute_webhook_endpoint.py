@@ -4,6 +4,7 @@ import time
 
 from src.rx.doctor_service import DoctorService, DoctorServiceOfferEvent
 from src.tests.test_apis.utils import app_client
+from src.utils import MongoDBClient
 from utils import compute_signature
 
 
@@ -32,6 +33,12 @@ def test_akute_ehr_task_complete(app_client, monkeypatch):
     assert response.status_code == 200
     assert response.json['message'] == 'success'
 
+    # A redelivered webhook does not queue the certified plan again
+    app_client.post('/akute-webhook', headers=headers, data=compressed_data)
+    jobs = list(MongoDBClient.get_jobs().find({}))
+    assert [job['_id'] for job in jobs] == ['process_for_certified_plan:offer_id:ehr_task_done']
+    assert jobs[0]['payload'] == {'offer_id': 'offer_id'}
+
 
 def test_akute_task_not_found(app_client, monkeypatch):
     monkeypatch.setenv('AKUTE_WEBHOOK_SECRET',
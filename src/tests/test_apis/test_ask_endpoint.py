@@ -1,7 +1,13 @@
 from src.utils import fake_llm
+import base64
 import json
+import re
+import threading
 
 from src.utils import MongoDBClient
+from src.bot_executor import TurnExecutor
+from src.bot_lease import ConversationLease
+from src.bot_stream_replay import StreamReplayBuffer
 from src.tests.test_apis.utils import get_credentials, app_client
 
 
@@ -328,3 +334,125 @@ def test_ask_endpoint_with_empty_input_and_care_agent(app_client):
     assert state_['user_id'] == 'fake_ask'
     assert state_['event'] == 'capture_state'
 
+
+
+def test_ask_endpoint_event_stream(app_client):
+    response = app_client.get('/new_token?session_id=fake_ask',
+                              headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+
+    fake_llm.responses = ['Do you suspect of fever\nor confirmed?']
+
+    ask_events = app_client.post('/ask', headers={'Authorization': f'Bearer {token_}',
+                                                  'Accept': 'text/event-stream'}, json={'input': 'Fever'})
+
+    assert ask_events.status_code == 200
+    events = ask_events.get_data(as_text=True)
+    event_id, data = events.split('\n', 1)
+    assert re.fullmatch(r'id: \d+-1', event_id)
+    assert data == 'data: Do you suspect of fever\ndata: or confirmed?\n\n'
+
+    # Resuming after the last event has nothing more to send
+    resumed = app_client.get('/ask/stream', headers={'Authorization': f'Bearer {token_}',
+                                                     'Last-Event-ID': event_id[len('id: '):]})
+    assert resumed.status_code == 200
+    assert resumed.get_data(as_text=True) == ''
+
+    # Resuming without an event id replays the whole turn
+    resumed = app_client.get('/ask/stream', headers={'Authorization': f'Bearer {token_}'})
+    assert resumed.get_data(as_text=True) == events
+
+
+def test_ask_resume_without_stream(app_client):
+    response = app_client.get('/new_token?session_id=fake_ask_no_stream',
+                              headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+
+    resumed = app_client.get('/ask/stream', headers={'Authorization': f'Bearer {token_}'})
+
+    assert resumed.status_code == 404
+
+
+def test_ask_resume_after_events_dropped(app_client):
+    response = app_client.get('/new_token?session_id=fake_ask_dropped',
+                              headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+
+    replay = StreamReplayBuffer.get()
+    turn = replay.start_turn('fake_ask_dropped')
+    for seq in range(1, replay.max_events + 2):
+        replay.append('fake_ask_dropped', turn, seq, str(seq))
+    replay.close('fake_ask_dropped', turn)
+
+    resumed = app_client.get('/ask/stream', headers={'Authorization': f'Bearer {token_}'})
+
+    assert resumed.status_code == 410
+    assert resumed.json['reset']
+
+
+def test_ask_rejected_when_saturated(app_client, monkeypatch):
+    response = app_client.get('/new_token?session_id=fake_ask_saturated',
+                              headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+
+    executor = TurnExecutor(max_workers=1, max_queue=0)
+    monkeypatch.setattr(TurnExecutor, '_instance', executor)
+    release = threading.Event()
+    executor.submit(release.wait, 5)
+
+    starts = []
+    monkeypatch.setattr(StreamReplayBuffer.get(), 'start_turn', lambda convo_id: starts.append(convo_id))
+    response = app_client.post('/ask', headers={'Authorization': f'Bearer {token_}', 'Accept': 'text/event-stream'},
+                               json={'input': 'Fever'})
+    release.set()
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.json['retry_after'] == 1
+    # Rejected before loading the bot or touching the replay buffer of the previous turn
+    assert MongoDBClient.get_botstate().find_one({'username': 'fake_ask_saturated'}) is None
+    assert starts == []
+    assert executor.gauges()['queue_depth'] == 0
+
+
+def test_ask_gives_back_its_reservation(app_client, monkeypatch):
+    response = app_client.get('/new_token?session_id=fake_ask_reservation',
+                              headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+    executor = TurnExecutor(max_workers=1, max_queue=0)
+    monkeypatch.setattr(TurnExecutor, '_instance', executor)
+
+    response = app_client.post('/ask', headers={'Authorization': f'Bearer {token_}'}, json={'input': ''})
+
+    assert response.status_code == 400
+    assert executor.gauges()['queue_depth'] == 0
+    assert executor.reserve() is not None
+
+
+def test_turn_gauges(app_client):
+    credentials = base64.b64encode(b'admin:adminCody@123').decode('utf-8')
+
+    response = app_client.get('/admin/turns', headers={'Authorization': f'Basic {credentials}'})
+
+    assert response.status_code == 200
+    assert 'queue_depth' in response.json
+    assert 'active_turns' in response.json
+
+
+def test_ask_rejected_while_conversation_busy(app_client, monkeypatch):
+    response = app_client.get('/new_token?session_id=fake_ask_busy',
+                              headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+    monkeypatch.setenv('CONVO_LEASE_WAIT', '0')
+
+    lease = ConversationLease.acquire('fake_ask_busy', wait=0)
+    response = app_client.post('/ask', headers={'Authorization': f'Bearer {token_}'}, json={'input': 'Fever'})
+    assert response.status_code == 409
+
+    lease.release()
+    fake_llm.responses = ['Do you suspect of fever or confirmed?']
+    response = app_client.post('/ask', headers={'Authorization': f'Bearer {token_}'}, json={'input': 'Fever'})
+    assert response.status_code == 200
+    response.get_data(as_text=True)
+    # The turn releases the lease right after ending the stream.
+    assert ConversationLease.acquire('fake_ask_busy', wait=1) is not None
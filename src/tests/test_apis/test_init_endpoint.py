@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 import requests_mock
 
 from src import agents
+from src.bot_lease import ConversationLease
 from src.bot_state import BotState
 from src.followup.followup_care import FollowupCare
 from src.followup.followup_care_state import FollowUpCareState
@@ -32,6 +33,20 @@ def test_init_endpoint_initialization(app_client):
     assert len(init_.json['conv_hist']) == 1
 
 
+def test_init_endpoint_waits_for_the_turn_in_progress(app_client, monkeypatch):
+    monkeypatch.setenv('CONVO_LEASE_WAIT', '0')
+    response = app_client.get('/new_token?session_id=busy', headers={'Authorization': f'Basic {get_credentials()}'})
+    token_ = response.json['access_token']
+
+    lease = ConversationLease.try_acquire('busy')
+    assert app_client.get('/init', headers={'Authorization': f'Bearer {token_}'}).status_code == 409
+
+    lease.release()
+    assert app_client.get('/init', headers={'Authorization': f'Bearer {token_}'}).status_code == 200
+    # The lease of /init is released once the bot is loaded
+    assert MongoDBClient.get_conversation_leases().find_one({'_id': 'busy'}) is None
+
+
 def test_init_endpoint_diagnosis_with_full_convo_history(app_client):
     response = app_client.get('/new_token?session_id=mgvg2skD9ecihUlx8CHA4SorKdHv9xcZ7YqLbsUjf1TRZkCiPS',
                               headers={'Authorization': f'Basic {get_credentials()}'})
@@ -0,0 +1,123 @@
+import base64
+import json
+
+from src.dx_mapping import DxMapping
+from src.tests.test_apis.utils import app_client
+from src.utils import MongoDBClient
+
+HEADERS = {'Authorization': f'Basic {base64.b64encode(b"admin:adminCody@123").decode("utf-8")}'}
+
+
+def insert_mappings():
+    MongoDBClient.get_dx_mapping().insert_many([
+        {'diagnosis': f'diagnosis {index}', 'dx_group': 'Gastritis' if index % 2 == 0 else 'Acne',
+         'specialist': 'Gastroenterologist' if index % 2 == 0 else 'Dermatologist',
+         'source': 'llm' if index < 5 else 'admin', 'bookmark': index == 3,
+         # Mappings 0 and 1 were created at the same time
+         'created': f'2024-01-0{max(index, 1)}T00:00:00'}
+        for index in range(8)
+    ])
+
+
+def test_mapping_pages(app_client):
+    insert_mappings()
+
+    diagnoses = []
+    cursor = None
+    while True:
+        response = app_client.get('/admin/mapping', query_string={'limit': 3, **({'cursor': cursor} if cursor else {})},
+                                  headers=HEADERS)
+        assert response.status_code == 200
+        diagnoses += [mapping['diagnosis'] for mapping in response.json['mappings']]
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            break
+
+    assert diagnoses[:6] == [f'diagnosis {index}' for index in range(7, 1, -1)]
+    assert sorted(diagnoses[6:]) == ['diagnosis 0', 'diagnosis 1']
+
+    # A page starts after the cursor, whatever is added meanwhile
+    first_page = app_client.get('/admin/mapping?limit=2', headers=HEADERS).json
+    MongoDBClient.get_dx_mapping().insert_one({'diagnosis': 'new', 'dx_group': 'Acne', 'specialist': 'Dermatologist',
+                                               'source': 'llm', 'created': '2024-02-01T00:00:00'})
+    second_page = app_client.get(f'/admin/mapping?limit=2&cursor={first_page["next_cursor"]}', headers=HEADERS).json
+    assert [mapping['diagnosis'] for mapping in second_page['mappings']] == ['diagnosis 5', 'diagnosis 4']
+
+
+def test_mapping_filters(app_client):
+    insert_mappings()
+
+    response = app_client.get('/admin/mapping?limit=10&source=llm&dx_group=Acne', headers=HEADERS)
+    assert [mapping['diagnosis'] for mapping in response.json['mappings']] == ['diagnosis 3', 'diagnosis 1']
+
+    response = app_client.get('/admin/mapping?limit=10&bookmark=true', headers=HEADERS)
+    assert response.json['mappings'] == [{'diagnosis': 'diagnosis 3', 'dx_group': 'Acne',
+                                          'specialist': 'Dermatologist', 'created': '2024-01-03T00:00:00',
+                                          'source': 'llm', 'bookmark': True}]
+
+
+def test_mapping_invalid_cursor(app_client):
+    response = app_client.get('/admin/mapping?cursor=invalid', headers=HEADERS)
+
+    assert response.status_code == 400
+
+
+def test_mapping_exports(app_client):
+    insert_mappings()
+
+    response = app_client.get('/admin/mapping?source=admin', headers=HEADERS)
+    assert [mapping['diagnosis'] for mapping in response.json] == ['diagnosis 7', 'diagnosis 6', 'diagnosis 5']
+
+    response = app_client.get('/admin/mapping?format=ndjson&source=admin', headers=HEADERS)
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['diagnosis'] for line in lines] == ['diagnosis 7', 'diagnosis 6', 'diagnosis 5']
+
+
+def test_mapping_unauthorized(app_client):
+    assert app_client.get('/admin/mapping').status_code == 401
+
+
+def test_mapping_bulk_update(app_client):
+    insert_mappings()
+    DxMapping.find('diagnosis 2')
+    edits = [
+        {'diagnosis': 'diagnosis 2', 'dx_group': 'acne', 'specialist': 'Dermatologist'},
+        {'diagnosis': 'diagnosis new', 'dx_group': 'Gastritis', 'specialist': 'Gastroenterologist', 'bookmark': True},
+        {'diagnosis': 'diagnosis 4', 'dx_group': 'Nonexistent', 'specialist': 'Dermatologist'},
+        {'diagnosis': 'diagnosis 5', 'dx_group': 'Acne', 'specialist': 'Gastroenterologist'},
+        {'diagnosis': 'diagnosis 2', 'dx_group': 'Gastritis', 'specialist': 'Gastroenterologist'},
+        'invalid',
+    ]
+
+    response = app_client.post('/admin/mapping/bulk', json=edits, headers=HEADERS)
+
+    assert response.status_code == 200
+    assert response.json['counts'] == {'updated': 1, 'created': 1, 'invalid': 4}
+    assert [result['status'] for result in response.json['results']] == ['updated', 'created', 'invalid', 'invalid',
+                                                                         'invalid', 'invalid']
+    assert response.json['results'][2]['error'] == 'Unknown dx_group Nonexistent'
+
+    # The cached mapping was invalidated
+    assert DxMapping.find('diagnosis 2')['dx_group'] == 'Acne'
+    assert DxMapping.find('diagnosis 2')['source'] == 'admin'
+    created = MongoDBClient.get_dx_mapping().find_one({'diagnosis': 'diagnosis new'})
+    assert created['bookmark'] is True
+    assert created['source'] == 'admin'
+    assert created['created'] is not None
+
+
+def test_mapping_bulk_update_ndjson(app_client, monkeypatch):
+    monkeypatch.setattr(DxMapping, 'BULK_CHUNK_SIZE', 2)
+    body = '\n'.join(json.dumps({'diagnosis': f'diagnosis {index}', 'dx_group': 'Acne', 'specialist': 'Dermatologist'})
+                     for index in range(5))
+
+    response = app_client.post('/admin/mapping/bulk', data=body, content_type='application/x-ndjson',
+                               headers=HEADERS)
+
+    assert response.json['counts'] == {'created': 5}
+    assert MongoDBClient.get_dx_mapping().count_documents({'dx_group': 'Acne'}) == 5
+
+    response = app_client.post('/admin/mapping/bulk', data='{"diagnosis":\n', content_type='application/x-ndjson',
+                               headers=HEADERS)
+    assert response.status_code == 400
@@ -1,8 +1,12 @@
 import base64
+import os
 
 import pytest
 
-from application import application
+# The jobs of the in-process scheduler would run against the mock database of whichever test is running.
+os.environ.setdefault('IN_PROCESS_SCHEDULER', 'false')
+
+from application import application  # noqa: E402
 from src.tests.utils import setup_code
 
 
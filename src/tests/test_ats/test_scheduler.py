@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from src.agents.utils import get_supported_sps
+from src.ats.scheduler import MAX_ATTEMPTS, run_ats_on_recent_convs, WATERMARK_ID
+from src.sub_specialist import SubSpecialtyDxGroup
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+SPECIALIST = next(sp for sp in get_supported_sps() if not isinstance(sp, SubSpecialtyDxGroup)).inventory_name
+
+
+def _insert_convo(username: str, created: datetime):
+    MongoDBClient.get_botstate().insert_one({
+        'username': username,
+        'created': created.isoformat(),
+        'specialist': SPECIALIST,
+        'subSpecialty': SubSpecialtyDxGroup.Generalist.inventory_name,
+        'dxg_version': 'v3',
+        'priority_fields_asked': ['symptoms'],
+        'conv_hist': {'magic_minute_agent': [{'role': 'assistant', 'content': f'Summary of {username}'}]},
+    })
+
+
+def test_scores_all_unscored_convos(setup):
+    now = datetime.now()
+    for i in range(7):
+        _insert_convo(f'convo-{i}', now - timedelta(minutes=i))
+    MongoDBClient.get_ats().insert_one({'username': 'convo-0', 'score': 10})
+
+    with patch('src.ats.scheduler.ats_run', return_value=(50.0, ['fever'], {'symptoms': 'cough'})) as ats_run:
+        metrics = run_ats_on_recent_convs(batch_size=2, concurrency=3)
+
+    # Scored conversations are skipped, but not the ones after them
+    assert ats_run.call_count == 6
+    assert metrics['scanned'] == 6
+    assert metrics['scored'] == 6
+    assert metrics['duration_seconds'] >= 0
+
+    assert MongoDBClient.get_ats().find_one({'username': 'convo-0'})['score'] == 10
+    ats = MongoDBClient.get_ats().find_one({'username': 'convo-6'})
+    assert ats['score'] == 50.0
+    assert ats['args'] == {'symptoms': 'cough'}
+    assert ats['date'] == (now - timedelta(minutes=6)).isoformat()[:10]
+
+    watermark = MongoDBClient.get_job_watermarks().find_one({'_id': WATERMARK_ID})
+    assert watermark['created'] == (now - timedelta(minutes=1)).isoformat()
+    assert watermark['last_run']['scored'] == 6
+
+
+def test_resumes_from_watermark(setup):
+    now = datetime.now()
+    _insert_convo('old', now - timedelta(days=10))
+    _insert_convo('late', now - timedelta(hours=2))
+    MongoDBClient.get_job_watermarks().insert_one({'_id': WATERMARK_ID, 'created': now.isoformat()})
+
+    with patch('src.ats.scheduler.ats_run', return_value=(50.0, [], {})):
+        metrics = run_ats_on_recent_convs()
+
+    # Conversations within the lookback are still scored, older ones were covered by earlier runs
+    assert metrics['scored'] == 1
+    assert MongoDBClient.get_ats().find_one({'username': 'late'}) is not None
+    assert MongoDBClient.get_ats().find_one({'username': 'old'}) is None
+
+
+def test_failed_scoring_is_retried_next_run(setup):
+    _insert_convo('flaky', datetime.now())
+
+    with patch('src.ats.scheduler.ats_run', side_effect=ValueError('Invalid JSON')):
+        assert run_ats_on_recent_convs()['scored'] == 0
+
+    with patch('src.ats.scheduler.ats_run', return_value=(50.0, [], {})):
+        assert run_ats_on_recent_convs()['scored'] == 1
+
+
+def test_failed_scoring_is_retried_beyond_the_lookback(setup):
+    now = datetime.now()
+    _insert_convo('flaky', now - timedelta(days=10))
+
+    with patch('src.ats.scheduler.ats_run', side_effect=ValueError('Invalid JSON')):
+        assert run_ats_on_recent_convs()['scored'] == 0
+
+    # Later runs moved the watermark on, far past the lookback
+    MongoDBClient.get_job_watermarks().update_one({'_id': WATERMARK_ID}, {'$set': {'created': now.isoformat()}})
+    with patch('src.ats.scheduler.ats_run', return_value=(50.0, [], {})):
+        assert run_ats_on_recent_convs()['scored'] == 1
+
+    assert MongoDBClient.get_ats().find_one({'username': 'flaky'}) is not None
+    assert MongoDBClient.get_job_watermarks().find_one({'_id': WATERMARK_ID})['retry'] == []
+
+
+def test_failed_scoring_is_given_up_after_max_attempts(setup):
+    _insert_convo('broken', datetime.now() - timedelta(days=10))
+
+    with patch('src.ats.scheduler.ats_run', side_effect=ValueError('Invalid JSON')) as ats_run:
+        run_ats_on_recent_convs()
+        MongoDBClient.get_job_watermarks().update_one({'_id': WATERMARK_ID},
+                                                      {'$set': {'created': datetime.now().isoformat()}})
+        for _ in range(MAX_ATTEMPTS):
+            run_ats_on_recent_convs()
+
+    assert ats_run.call_count == MAX_ATTEMPTS
+    assert MongoDBClient.get_job_watermarks().find_one({'_id': WATERMARK_ID})['retry'] == []
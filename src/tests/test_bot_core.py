@@ -1,6 +1,10 @@
+from langchain.adapters.openai import convert_dict_to_message
+from langchain.schema import AIMessage, HumanMessage
+
 from src.tests.utils import setup, ask
 from src.bot import Bot
-from src.utils import fake_llm
+from src.bot_state import BotState
+from src.utils import fake_llm, MongoDBClient
 
 
 def test_handling_of_exception(setup):
@@ -49,3 +53,57 @@ def test_handling_of_timeout(setup):
         in bot.full_conv_hist.full_conv_hist[-1]['content'], \
         'Doesnt have the timeout message.'
     
+
+
+def test_conv_hist_is_converted_on_access(setup, monkeypatch):
+    stored = {'role': 'user', 'content': 'Headache', 'unknown_field': 'kept as is'}
+    MongoDBClient.get_botstate().insert_one({'username': 'convo', 'revision': 1, 'conv_hist': {
+        'chief_complaint_agent': [{'role': 'assistant', 'content': 'How can I help?'}],
+        'followup_agent': [stored],
+    }})
+    conversions = []
+    monkeypatch.setattr('src.bot_state.convert_dict_to_message',
+                        lambda message: conversions.append(message) or convert_dict_to_message(message))
+
+    state = BotState(username='convo')
+    assert conversions == []
+    assert 'followup_agent' in state.conv_hist
+    assert len(state.conv_hist) == 2
+
+    state.conv_hist['chief_complaint_agent'].append(HumanMessage(content='Headache'))
+    state.conv_hist['diagnosis_agent'] = [AIMessage(content='Migraine')]
+    state.upsert_to_db()
+
+    assert len(conversions) == 1
+    conv_hist = MongoDBClient.get_botstate().find_one({'username': 'convo'})['conv_hist']
+    assert conv_hist['chief_complaint_agent'] == [{'role': 'assistant', 'content': 'How can I help?'},
+                                                  {'role': 'user', 'content': 'Headache'}]
+    # Untouched agents are written back as they were read
+    assert conv_hist['followup_agent'] == [stored]
+    assert conv_hist['diagnosis_agent'] == [{'role': 'assistant', 'content': 'Migraine'}]
+
+    copy = state.conv_hist.copy()
+    assert copy['followup_agent'][0].content == 'Headache'
+    assert state.conv_hist == {'chief_complaint_agent': copy['chief_complaint_agent'],
+                               'followup_agent': copy['followup_agent'],
+                               'diagnosis_agent': [AIMessage(content='Migraine')]}
+
+
+def test_bot_converts_no_conv_hist_on_init(setup, monkeypatch):
+    MongoDBClient.get_botstate().insert_one({
+        'username': 'convo', 'revision': 1, 'current_agent_name': 'diagnosis_agent',
+        'conv_hist': {agent_name: [{'role': 'user', 'content': 'Headache'},
+                                   {'role': 'assistant', 'content': 'How long?'}] * 10
+                      for agent_name in ['chief_complaint_agent', 'router_agent', 'diagnosis_agent']}})
+    MongoDBClient.get_full_conv_hist().insert_one({'conversation_id': 'convo', 'full_conv_hist': [
+        {'role': 'user', 'content': 'Headache'}, {'role': 'assistant', 'content': 'How long?'}]})
+    conversions = []
+    monkeypatch.setattr('src.bot_state.convert_dict_to_message',
+                        lambda message: conversions.append(message) or convert_dict_to_message(message))
+
+    bot = Bot(username='convo')
+
+    assert conversions == []
+    assert bot.state.current_agent_name == 'diagnosis_agent'
+    assert len(bot.state.conv_hist['diagnosis_agent']) == 20
+    assert len(conversions) == 20
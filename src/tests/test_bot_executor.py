@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from src.bot_executor import TurnExecutor, TurnRejected
+
+
+def test_turn_executor_runs_turns():
+    executor = TurnExecutor(max_workers=2, max_queue=2)
+
+    assert executor.submit(lambda x: x * 2, 21).result(1) == 42
+
+    gauges = executor.gauges()
+    assert gauges['completed'] == 1
+    assert gauges['active_turns'] == 0
+    assert gauges['queue_depth'] == 0
+
+
+def test_turn_executor_rejects_when_queue_full():
+    executor = TurnExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    running = executor.submit(release.wait, 5)
+    queued = executor.submit(release.wait, 5)
+
+    with pytest.raises(TurnRejected) as e:
+        executor.submit(release.wait, 5)
+    assert e.value.retry_after >= 1
+
+    gauges = executor.gauges()
+    assert gauges['active_turns'] == 1
+    assert gauges['queue_depth'] == 1
+    assert gauges['rejected'] == 1
+
+    release.set()
+    running.result(1)
+    queued.result(1)
+
+    # Slots are freed once the turns finish.
+    assert executor.submit(lambda: 'done').result(1) == 'done'
+    assert executor.gauges()['wait_ms_p95'] >= 0
+
+
+def test_turn_executor_survives_failing_turns():
+    executor = TurnExecutor(max_workers=1, max_queue=0)
+
+    def fail():
+        raise ValueError('Failed')
+
+    executor.submit(fail).result(1)
+
+    assert executor.gauges()['active_turns'] == 0
+    assert executor.submit(lambda: 'done').result(1) == 'done'
+
+
+def test_turn_executor_reservations():
+    executor = TurnExecutor(max_workers=1, max_queue=1)
+
+    first = executor.reserve()
+    second = executor.reserve()
+    with pytest.raises(TurnRejected):
+        executor.reserve()
+    assert executor.gauges()['queue_depth'] == 2
+
+    second.release()
+    second.release()
+    assert executor.gauges()['queue_depth'] == 1
+
+    assert first.submit(lambda: 'done').result(1) == 'done'
+    first.release()
+    assert executor.gauges()['queue_depth'] == 0
+    assert executor.gauges()['completed'] == 1
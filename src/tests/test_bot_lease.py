@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.bot import Bot
+from src.bot_lease import ConversationLease
+from src.bot_state import BotState, StaleBotStateError
+from src.tests.utils import setup
+from src.utils import MongoDBClient, fake_llm
+
+
+def test_lease_is_exclusive(setup):
+    lease = ConversationLease.acquire('convo', wait=0)
+
+    assert lease is not None
+    assert ConversationLease.acquire('convo', wait=0.2) is None
+    assert ConversationLease.acquire('other_convo', wait=0) is not None
+
+    lease.release()
+    assert ConversationLease.acquire('convo', wait=0) is not None
+
+
+def test_expired_lease_is_taken_over(setup):
+    lease = ConversationLease.acquire('convo', wait=0)
+    MongoDBClient.get_conversation_leases().update_one({'_id': 'convo'},
+                                                       {'$set': {'expires_at': datetime.now() - timedelta(seconds=1)}})
+
+    new_lease = ConversationLease.acquire('convo', wait=0)
+
+    assert new_lease is not None
+    assert not lease.renew()
+    # Releasing a lost lease leaves the new holder alone.
+    lease.release()
+    assert new_lease.renew()
+
+
+def test_concurrent_state_writes_conflict(setup):
+    state = BotState(username='convo')
+    state.upsert_to_db()
+    assert state.revision == 1
+
+    first = BotState(username='convo')
+    second = BotState(username='convo')
+    first.patient_name = 'First'
+    first.upsert_to_db()
+
+    second.patient_name = 'Second'
+    with pytest.raises(StaleBotStateError):
+        second.upsert_to_db()
+
+    assert MongoDBClient.get_botstate().find_one({'username': 'convo'})['patient_name'] == 'First'
+    assert MongoDBClient.get_botstate().count_documents({'username': 'convo'}) == 1
+
+
+def test_concurrent_new_conversations_conflict(setup):
+    first = BotState(username='convo')
+    second = BotState(username='convo')
+
+    first.upsert_to_db()
+    with pytest.raises(StaleBotStateError):
+        second.upsert_to_db()
+
+
+def test_legacy_state_without_revision(setup):
+    MongoDBClient.get_botstate().insert_one({'username': 'convo', 'patient_name': 'Legacy'})
+
+    state = BotState(username='convo')
+    state.upsert_to_db()
+
+    assert MongoDBClient.get_botstate().find_one({'username': 'convo'})['revision'] == 1
+
+
+def test_turn_releases_lease(setup):
+    bot = Bot(username='convo')
+    fake_llm.responses = ['Hello']
+    lease = ConversationLease.acquire('convo', wait=0)
+
+    bot._ask('Hi', lease=lease)
+
+    assert MongoDBClient.get_conversation_leases().find_one({'_id': 'convo'}) is None
+
+
+def test_read_only_bot_does_not_write(setup):
+    MongoDBClient.get_botstate().insert_one({'username': 'convo', 'revision': 3, 'conv_hist': {
+        'chief_complaint_agent': [{'role': 'assistant', 'content': 'How can I help?'},
+                                  {'role': 'user', 'content': 'Headache'}]}})
+
+    bot = Bot(username='convo', read_only=True)
+
+    # The legacy history is shown, without being backfilled
+    assert len(bot.get_conv_hist()) == 2
+    assert MongoDBClient.get_full_conv_hist().find_one({'conversation_id': 'convo'}) is None
+    assert MongoDBClient.get_botstate().find_one({'username': 'convo'})['revision'] == 3
@@ -0,0 +1,260 @@
+import threading
+import time
+
+import pytest
+from langchain.schema import AIMessage, HumanMessage
+
+from src.bot import Bot
+from src.bot_stream_llm import ThreadedGenerator, StreamWriter, StreamCallback, TurnCancelled, StreamChatOpenAI
+from src.tests.utils import setup
+from src.utils import fake_llm, MongoDBClient
+
+
+class FakeConvHist:
+    def __init__(self):
+        self.tokens = []
+
+    def append_token(self, token):
+        self.tokens.append(token)
+
+
+def drain(gen: ThreadedGenerator) -> list[str]:
+    return list(gen)
+
+
+def test_stream_writer_flushes_on_size_and_close():
+    gen = ThreadedGenerator()
+    writer = StreamWriter(gen, flush_interval=60, flush_bytes=10)
+
+    writer.write('Hello')
+    writer.write(' world')
+    writer.write('!')
+    writer.close()
+
+    assert drain(gen) == ['Hello world', '!']
+
+
+def test_stream_writer_flushes_on_interval():
+    gen = ThreadedGenerator()
+    writer = StreamWriter(gen, flush_interval=0, flush_bytes=1024)
+
+    writer.write('Hello')
+    writer.write(' world')
+    writer.close()
+
+    assert drain(gen) == ['Hello', ' world']
+
+
+def test_stream_writer_flushes_on_deadline():
+    gen = ThreadedGenerator()
+    gen.has_consumer = True
+    writer = StreamWriter(gen, flush_interval=0.05, flush_bytes=1024)
+
+    # No further write or flush follows, the deadline alone delivers the buffered token.
+    writer.write('Hello')
+
+    assert gen.queue.get(timeout=1) == 'Hello'
+    assert writer.buffer == []
+
+
+def test_stream_writer_uses_a_single_flusher():
+    gen = ThreadedGenerator()
+    writer = StreamWriter(gen, flush_interval=60, flush_bytes=1)
+    threads = threading.active_count()
+
+    for _ in range(100):
+        writer.write('token')
+
+    assert threading.active_count() <= threads + 1
+    writer.close()
+    assert len(drain(gen)) == 100
+
+
+def test_stream_writer_not_blocked_by_backpressure():
+    gen = ThreadedGenerator(maxsize=1)
+    gen.has_consumer = True
+    gen.send('unread')
+    writer = StreamWriter(gen, flush_interval=60, flush_bytes=1024)
+
+    writer.write('Hello')
+    flushing = threading.Thread(target=writer.flush)
+    flushing.start()
+    while writer.buffer:
+        time.sleep(0.01)
+
+    # The flush is blocked on the full queue, writes still go through
+    writer.write(' world')
+    assert writer.buffer == [' world']
+
+    assert gen.queue.get(timeout=1) == 'unread'
+    flushing.join(1)
+    assert gen.queue.get(timeout=1) == 'Hello'
+    writer.flush()
+    assert gen.queue.get(timeout=1) == ' world'
+    writer.close()
+
+
+def test_stream_writer_event_stream_framing():
+    gen = ThreadedGenerator()
+    writer = StreamWriter(gen, flush_interval=60, flush_bytes=1024, event_stream=True)
+
+    writer.write('Hello\n\nworld')
+    writer.close()
+
+    assert drain(gen) == ['data: Hello\ndata: \ndata: world\n\n']
+
+
+def test_stream_callback_flushes_agent_messages():
+    gen = ThreadedGenerator()
+    conv_hist = FakeConvHist()
+    callback = StreamCallback(StreamWriter(gen, flush_interval=60, flush_bytes=1024), conv_hist)
+
+    # Tokens of an llm run are buffered until the run ends
+    callback.on_llm_new_token('Hel', run_id='run')
+    callback.on_llm_new_token('lo', run_id='run')
+    callback.on_llm_end(None, run_id='run')
+
+    # Complete messages written by agents are flushed right away
+    callback.on_llm_new_token('Static message')
+    callback.writer.close()
+
+    assert drain(gen) == ['Hello', 'Static message']
+    assert conv_hist.tokens == ['Hel', 'lo', 'Static message']
+
+
+def test_threaded_generator_backpressure():
+    gen = ThreadedGenerator(maxsize=1)
+    gen.has_consumer = True
+    gen.send('first')
+
+    # The queue is full, so the producer blocks until the consumer reads.
+    producer = threading.Thread(target=gen.send, args=('second',))
+    producer.start()
+    producer.join(0.3)
+    assert producer.is_alive()
+
+    assert next(gen) == 'first'
+    producer.join(1)
+    assert not producer.is_alive()
+    assert next(gen) == 'second'
+
+
+def test_threaded_generator_drops_without_consumer():
+    gen = ThreadedGenerator(maxsize=1)
+    gen.send('first')
+    gen.send('second')
+    gen.end()
+
+    assert list(gen) == ['first']
+
+
+def test_threaded_generator_cancelled_on_disconnect():
+    gen = ThreadedGenerator(maxsize=1)
+    gen.has_consumer = True
+    gen.send('first')
+
+    producer = threading.Thread(target=gen.send, args=('second',))
+    producer.start()
+
+    # The WSGI server closes the response before the stream has finished.
+    gen.close()
+    producer.join(1)
+
+    assert not producer.is_alive()
+    assert gen.cancellation.cancelled
+    with pytest.raises(TurnCancelled):
+        gen.cancellation.raise_if_cancelled()
+
+
+def test_threaded_generator_not_cancelled_after_finish():
+    gen = ThreadedGenerator()
+    gen.send('first')
+    gen.end()
+
+    assert list(gen) == ['first']
+    gen.close()
+
+    assert not gen.cancellation.cancelled
+
+
+def test_threaded_generator_resumable_detached_on_disconnect():
+    gen = ThreadedGenerator()
+    gen.resumable = True
+    gen.close()
+    gen.send('dropped')
+
+    assert not gen.cancellation.cancelled
+    assert gen.detached
+    assert gen.queue.empty()
+
+
+def test_cancelled_turn_stops_and_persists(setup):
+    bot = Bot(username='test')
+    fake_llm.responses = ['Not used']
+
+    bot.stream.close()
+    bot._ask('Fever')
+
+    assert fake_llm.i == 0
+    assert bot.state.cancellations == 1
+    assert MongoDBClient.get_botstate().find_one({'username': 'test'})['cancellations'] == 1
+    assert MongoDBClient.get_full_conv_hist().find_one({'conversation_id': 'test'})['full_conv_hist'][-1] == {
+        'role': 'user', 'content': 'Fever'}
+
+
+def test_stream_chat_openai_cancelled(setup):
+    writer = StreamWriter(ThreadedGenerator())
+    llm = StreamChatOpenAI(writer=writer)
+    writer.cancellation.cancel('Client disconnected')
+
+    with pytest.raises(TurnCancelled):
+        llm([HumanMessage(content='Hi')])
+
+
+def test_threaded_generator_abandoned_resumable_cancelled(monkeypatch):
+    monkeypatch.setattr(ThreadedGenerator, 'RESUME_GRACE', 0.05)
+    gen = ThreadedGenerator()
+    gen.resumable = True
+    gen.close()
+
+    gen.cancellation.event.wait(1)
+    assert gen.cancellation.cancelled
+
+
+def test_threaded_generator_resumed_not_cancelled(monkeypatch):
+    monkeypatch.setattr(ThreadedGenerator, 'RESUME_GRACE', 0.05)
+    gen = ThreadedGenerator()
+    gen.resumable = True
+    gen.close()
+    gen.resumed_at = lambda: gen.disconnected_at + 0.01
+
+    assert not gen.cancellation.event.wait(0.3)
+
+
+def test_cancelled_stream_still_writes_error_messages():
+    gen = ThreadedGenerator()
+    writer = StreamWriter(gen)
+    conv_hist = FakeConvHist()
+    callback = StreamCallback(writer, conv_hist)
+    writer.cancellation.cancel('Client disconnected')
+
+    with pytest.raises(TurnCancelled):
+        callback.on_llm_new_token('token', run_id='run')
+    callback.write_message('Sorry')
+
+    assert conv_hist.tokens == ['Sorry']
+
+
+def test_cancelled_stream_keeps_agent_messages_consistent(setup):
+    bot = Bot(username='test')
+    bot.stream.close()
+    agent = bot.agents[bot.state.current_agent_index]
+
+    # Like an agent answering without an llm call, once the client is gone
+    bot.update_conv(update_db=False, user_input='Fever')
+    agent.conv_hist.append(AIMessage(content='Noted'))
+    bot.llm.stream_callback.on_llm_new_token('Noted')
+
+    assert bot.full_conv_hist.full_conv_hist[-1] == {'role': 'assistant', 'content': 'Noted'}
+    with pytest.raises(TurnCancelled):
+        bot.llm.stream_callback.on_llm_new_token('Streamed', run_id='run')
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from src.bot_stream_replay import InMemoryStreamReplayBuffer, MongoStreamReplayBuffer, parse_event_id, sse_frame
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+
+def test_sse_frame():
+    assert sse_frame('Hello\nworld') == 'data: Hello\ndata: world\n\n'
+    assert sse_frame('Hello', event_id='1-2') == 'id: 1-2\ndata: Hello\n\n'
+
+
+def test_parse_event_id():
+    assert parse_event_id('1700000000000-5') == (1700000000000, 5)
+    assert parse_event_id(None) == (None, 0)
+    assert parse_event_id('garbage') == (None, 0)
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def replay_buffer(request, setup):
+    if request.param == 'memory':
+        return InMemoryStreamReplayBuffer()
+    return MongoStreamReplayBuffer()
+
+
+def test_replay_after_last_event_id(replay_buffer):
+    turn = replay_buffer.start_turn('convo')
+    for seq, data in enumerate(['Hello', ' world', '!'], start=1):
+        replay_buffer.append('convo', turn, seq, data)
+    replay_buffer.close('convo', turn)
+
+    assert list(replay_buffer.replay('convo', f'{turn}-1')) == [(f'{turn}-2', ' world'), (f'{turn}-3', '!')]
+    assert list(replay_buffer.replay('convo')) == [(f'{turn}-1', 'Hello'), (f'{turn}-2', ' world'),
+                                                   (f'{turn}-3', '!')]
+
+
+def test_replay_of_older_turn_restarts_latest_turn(replay_buffer):
+    old_turn = replay_buffer.start_turn('convo')
+    replay_buffer.append('convo', old_turn, 1, 'Old')
+    replay_buffer.close('convo', old_turn)
+
+    turn = replay_buffer.start_turn('convo')
+    replay_buffer.append('convo', turn, 1, 'New')
+    replay_buffer.close('convo', turn)
+
+    assert turn > old_turn
+    assert list(replay_buffer.replay('convo', f'{old_turn}-1')) == [(f'{turn}-1', 'New')]
+
+
+def test_replay_follows_running_turn(replay_buffer):
+    replay_buffer.POLL_INTERVAL = 0.01
+    turn = replay_buffer.start_turn('convo')
+    replay_buffer.append('convo', turn, 1, 'Hello')
+
+    def finish_turn():
+        replay_buffer.append('convo', turn, 2, ' world')
+        replay_buffer.close('convo', turn)
+
+    timer = threading.Timer(0.05, finish_turn)
+    timer.start()
+
+    assert list(replay_buffer.replay('convo')) == [(f'{turn}-1', 'Hello'), (f'{turn}-2', ' world')]
+    timer.join()
+
+
+def test_replay_marks_turn_resumed(replay_buffer):
+    turn = replay_buffer.start_turn('convo')
+    replay_buffer.append('convo', turn, 1, 'Hello')
+    replay_buffer.close('convo', turn)
+
+    assert replay_buffer.resumed_at('convo', turn) is None
+    assert list(replay_buffer.replay('convo')) == [(f'{turn}-1', 'Hello')]
+    assert replay_buffer.resumed_at('convo', turn) is not None
+
+
+def test_in_memory_replay_is_bounded():
+    replay_buffer = InMemoryStreamReplayBuffer(max_events=2)
+    turn = replay_buffer.start_turn('convo')
+    for seq in range(1, 4):
+        replay_buffer.append('convo', turn, seq, str(seq))
+    replay_buffer.close('convo', turn)
+
+    # The first event was evicted, so only a client which has seen it can resume.
+    assert not replay_buffer.can_resume('convo')
+    assert list(replay_buffer.replay('convo')) == []
+    assert replay_buffer.can_resume('convo', f'{turn}-1')
+    assert list(replay_buffer.replay('convo', f'{turn}-1')) == [(f'{turn}-2', '2'), (f'{turn}-3', '3')]
+
+
+def test_mongo_replay_is_bounded(setup):
+    replay_buffer = MongoStreamReplayBuffer(max_events=2)
+    turn = replay_buffer.start_turn('convo')
+    for seq in range(1, 4):
+        replay_buffer.append('convo', turn, seq, str(seq))
+    replay_buffer.close('convo', turn)
+
+    assert replay_buffer.can_resume('convo', f'{turn}-1')
+    assert not replay_buffer.can_resume('convo', f'{turn}-2')
+    # The replay stops at the dropped events, instead of skipping to the end of the turn.
+    assert list(replay_buffer.replay('convo')) == [(f'{turn}-1', '1'), (f'{turn}-2', '2')]
+
+
+def test_mongo_appends_are_batched_off_thread(setup):
+    replay_buffer = MongoStreamReplayBuffer()
+    turn = replay_buffer.start_turn('convo')
+    replay_buffer.append('convo', turn, 1, 'Hello')
+    replay_buffer.append('convo', turn, 2, ' world')
+
+    # Written by the background writer, without a close.
+    deadline = time.monotonic() + 2
+    while MongoDBClient.get_stream_events().count_documents({'convo_id': 'convo'}) < 2 \
+            and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert replay_buffer.events_since('convo', turn, 0) == ([(1, 'Hello'), (2, ' world')], False)
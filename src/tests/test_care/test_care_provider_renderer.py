@@ -5,6 +5,7 @@ import pytest
 from src.care.care_provider import CareSearch, CareResult
 from src.care.care_provider_renderer import CareProviderRenderer
 from src.care.google_place_care_provider import GooglePlaceCareProvider
+from src.care.local_index_care_provider import LocalIndexCareProvider
 
 
 @pytest.fixture
@@ -53,6 +54,62 @@ def test_render_failure(setup_renderer):
     assert renderer.care_provider.find.call_count == 1
 
 
+def test_render_fallback_searched_concurrently(setup_renderer):
+    renderer = setup_renderer
+
+    renderer.care_provider.find.side_effect = lambda search: [] if search.search_terms == ['specialist'] else [
+        CareResult('fallback', 'fallback', '', 'fallback')]
+
+    result_html = renderer.render(CareSearch(['specialist']), fallback=CareSearch(['doctor']))
+
+    assert "Sure thing. I have found 1 best doctors near you" in result_html
+    assert "fallback" in result_html
+    assert renderer.care_provider.find.call_count == 2
+
+
+def test_render_prefers_primary_over_fallback(setup_renderer):
+    renderer = setup_renderer
 
+    renderer.care_provider.find.side_effect = lambda search: [
+        CareResult(search.search_terms[0], 'address', '', 'website')]
+
+    result_html = renderer.render(CareSearch(['specialist']), fallback=CareSearch(['doctor']))
+
+    assert "Sure thing. I have found 1 best doctors near you" in result_html
+    assert "specialist" in result_html
+    assert "doctor</a>" not in result_html
+
+
+def test_render_fallback_provider_on_failure(setup_renderer):
+    renderer = setup_renderer
+    renderer.fallback_provider = Mock()
+
+    renderer.care_provider.find.side_effect = GooglePlaceCareProvider.GoogleFindCareException("test", 500)
+    renderer.fallback_provider.find.return_value = [CareResult('local', 'local', '', 'local')]
 
+    result_html = renderer.render(CareSearch(['test']))
+
+    assert "Sure thing. I have found 1 best doctors near you" in result_html
+    assert "local" in result_html
+    assert renderer.fallback_provider.find.call_count == 1
+
+
+def test_render_fallback_provider_not_used_on_result(setup_renderer):
+    renderer = setup_renderer
+    renderer.fallback_provider = Mock()
+
+    renderer.care_provider.find.return_value = [CareResult('google', 'google', '', 'google')]
+
+    result_html = renderer.render(CareSearch(['test']))
+
+    assert "google" in result_html
+    renderer.fallback_provider.find.assert_not_called()
+
+
+def test_renderer_local_provider_from_env(monkeypatch):
+    monkeypatch.setenv('CARE_PROVIDER', 'local')
+
+    renderer = CareProviderRenderer()
 
+    assert isinstance(renderer.care_provider, LocalIndexCareProvider)
+    assert renderer.fallback_provider is None
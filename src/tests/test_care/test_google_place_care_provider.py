@@ -5,6 +5,11 @@ from src.care.care_provider import CareSearch
 from src.care.google_place_care_provider import GooglePlaceCareProvider
 
 
+@pytest.fixture(autouse=True)
+def clear_search_cache():
+    GooglePlaceCareProvider.search_cache.clear()
+
+
 def test_find_care_success_filter_out_non_operation(monkeypatch):
     monkeypatch.setenv('GOOGLE_API_KEY', 'test')
 
@@ -44,3 +49,36 @@ def test_find_care_google_failure(monkeypatch):
         assert e.value.message == "Unable to find care: ['test']"
 
         assert post.call_count == 1
+
+
+def test_find_care_repeat_search_served_from_cache(monkeypatch):
+    monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+
+    with requests_mock.Mocker() as req:
+        post = req.post('https://places.googleapis.com/v1/places:searchText', json={"places": [
+            {"displayName": {"text": "test"}, "shortFormattedAddress": "test", "internationalPhoneNumber": "test",
+             "websiteUri": "test", "rating": "5", "businessStatus": "OPERATIONAL"}
+        ]})
+
+        provider = GooglePlaceCareProvider()
+        first = provider.find(CareSearch(['dermatologist', 'near Austin, TX']))
+        second = provider.find(CareSearch(['Dermatologist', 'near austin  TX']))
+
+        assert first[0].name == 'test'
+        assert second == first
+        assert post.call_count == 1
+        assert post.last_request.json()['textQuery'] == 'dermatologist near Austin, TX'
+
+
+def test_find_care_failure_not_cached(monkeypatch):
+    monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+
+    with requests_mock.Mocker() as req:
+        post = req.post('https://places.googleapis.com/v1/places:searchText', status_code=500)
+        provider = GooglePlaceCareProvider()
+
+        for _ in range(2):
+            with pytest.raises(GooglePlaceCareProvider.GoogleFindCareException):
+                provider.find(CareSearch(['test']))
+
+        assert post.call_count == 2
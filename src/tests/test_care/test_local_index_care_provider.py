@@ -0,0 +1,72 @@
+import os
+
+from src.care.care_provider import CareSearch
+from src.care.local_index_care_provider import LocalIndexCareProvider
+from src.utils import haversine_km
+
+DATASET = os.path.join(os.path.dirname(__file__), 'test_data', 'care_providers.json')
+
+# GeoJSON point of downtown Austin, as captured on the bot state
+AUSTIN = {'type': 'Point', 'coordinates': [-97.7431, 30.2672]}
+
+
+def test_haversine():
+    assert round(haversine_km(30.2672, -97.7431, 29.4252, -98.4946)) == 118
+
+
+def test_find_nearest_by_location():
+    provider = LocalIndexCareProvider(dataset_path=DATASET)
+
+    results = provider.find(CareSearch(['dermatologist', 'acne', 'near Austin, TX'], location=AUSTIN))
+
+    # San Antonio is outside the search radius
+    assert [result.name for result in results] == ['Austin Skin Clinic', 'Round Rock Dermatology']
+    assert results[0].phone == '+1 512-555-0100'
+    assert results[0].rating == 4.2
+    assert results[0].rating_count == 120
+
+
+def test_find_generic_terms_match_primary_care():
+    provider = LocalIndexCareProvider(dataset_path=DATASET)
+
+    results = provider.find(CareSearch(['acne', 'doctor', 'near Austin, TX'], location=AUSTIN))
+
+    assert [result.name for result in results] == ['Austin Family Medicine']
+
+
+def test_find_by_address_without_location():
+    provider = LocalIndexCareProvider(dataset_path=DATASET)
+
+    results = provider.find(CareSearch(['dermatologist', 'near San Antonio, TX']))
+
+    assert [result.name for result in results] == ['San Antonio Derm']
+
+
+def test_find_unknown_specialty():
+    provider = LocalIndexCareProvider(dataset_path=DATASET)
+
+    assert provider.find(CareSearch(['cardiologist', 'near Austin, TX'], location=AUSTIN)) == []
+
+
+def test_find_missing_dataset():
+    provider = LocalIndexCareProvider(dataset_path='does_not_exist.json')
+
+    assert provider.find(CareSearch(['dermatologist', 'near Austin, TX'], location=AUSTIN)) == []
+
+
+def test_find_by_full_address_matches_city_and_state():
+    provider = LocalIndexCareProvider(dataset_path=DATASET)
+
+    results = provider.find(CareSearch(['dermatologist', 'near 1234 Main St, San Antonio, TX 78205']))
+    assert [result.name for result in results] == ['San Antonio Derm']
+
+    # A street shared with another city is not a match.
+    assert provider.find(CareSearch(['dermatologist', 'near 5 Main St, Dallas, TX'])) == []
+
+
+def test_find_prefers_address_away_from_location():
+    provider = LocalIndexCareProvider(dataset_path=DATASET)
+
+    results = provider.find(CareSearch(['dermatologist', 'near San Antonio, TX'], location=AUSTIN))
+
+    assert [result.name for result in results] == ['San Antonio Derm']
@@ -5,7 +5,7 @@ import requests_mock
 
 from src.agents.cody_care_questionnaires import get_questionaire
 from src.rx.doctor_service import DoctorService
-from src.rx.doctor_service_state import DoctorServiceOfferEvent
+from src.rx.doctor_service_state import DoctorServiceOfferEvent, DoctorServiceOfferHead
 from src.tests.utils import load_mogo_records
 from src.utils import MongoDBClient
 
@@ -518,3 +518,90 @@ def test_process_for_certified_plan(client, monkeypatch):
         {'conversation_id': "convo_id"})
     assert data['full_conv_hist'][-1]['role'] == 'assistant'
     assert '\n\n\nPLAN 2: Here is your Certified Plan' in data['full_conv_hist'][-1]['content']
+    assert MongoDBClient.get_conversation_leases().find_one({'_id': 'convo_id'}) is None
+
+
+def test_process_for_certified_plan_waits_for_the_turn_in_progress(client, monkeypatch):
+    from src.bot_lease import ConversationLease
+
+    MongoDBClient.get_doctor_service_offer().insert_one(
+        {'convo_id': 'convo_id', 'user_id': 'user_id', 'offer_id': 'offer_id',
+         'event': DoctorServiceOfferEvent.EHR_TASK_DONE.inventory_name,
+         'created': '2021-08-20T00:00:00', 'updated': '2021-08-20T00:00:00', 'ehr_task_id': 'task_id_1',
+         'ehr_task': {'patient_id': 'patient_id_1', 'date_created': '2021-08-20T00:00:00'}})
+    monkeypatch.setenv('CONVO_LEASE_WAIT', '0')
+    monkeypatch.setattr('src.rx.doctor_service.EhrService.get_plan', lambda self, patient_id, start_date: 'Plan')
+    ConversationLease.try_acquire('convo_id')
+
+    with pytest.raises(RuntimeError):
+        DoctorService.process_for_certified_plan('offer_id')
+
+    assert MongoDBClient.get_botstate().find_one({'username': 'convo_id'}) is None
+    assert DoctorService.event_of_type('offer_id', DoctorServiceOfferEvent.EHR_PLAN_READY).user_id is None
+
+
+def test_capture_advances_heads(client):
+    DoctorService.capture('test_offer_id', 'test_convo_id', 'test_user_id',
+                          DoctorServiceOfferEvent.OFFER_ACCEPTED, {})
+    DoctorService.capture('test_offer_id', 'test_convo_id', 'test_user_id',
+                          DoctorServiceOfferEvent.OFFER_PAYMENT_DONE, {'payment': {'status': 'succeeded'}})
+
+    offer_head = MongoDBClient.get_doctor_service_offer_head().find_one({'_id': 'offer:test_offer_id'})
+    convo_head = MongoDBClient.get_doctor_service_offer_head().find_one({'_id': 'convo:test_convo_id'})
+    assert offer_head['event'] == convo_head['event'] == 'offer_payment_done'
+    assert offer_head['payment'] == {'status': 'succeeded'}
+
+    # The event log is kept as the audit trail
+    assert MongoDBClient.get_doctor_service_offer().count_documents({'offer_id': 'test_offer_id'}) == 2
+
+    assert DoctorService.latest_event('test_convo_id').event == DoctorServiceOfferEvent.OFFER_PAYMENT_DONE
+    assert DoctorService.latest_event_by_offer('test_offer_id').payment == {'status': 'succeeded'}
+    assert DoctorService.event_of_type('test_offer_id',
+                                       DoctorServiceOfferEvent.OFFER_ACCEPTED).event == \
+           DoctorServiceOfferEvent.OFFER_ACCEPTED
+
+
+def test_older_event_does_not_replace_head(client):
+    DoctorService.capture('test_offer_id', 'test_convo_id', 'test_user_id',
+                          DoctorServiceOfferEvent.OFFER_PAYMENT_DONE, {})
+
+    DoctorServiceOfferHead.advance({'convo_id': 'test_convo_id', 'user_id': 'test_user_id',
+                                    'offer_id': 'test_offer_id', 'event': 'offer_accepted',
+                                    'created': datetime(2021, 8, 20)})
+
+    assert DoctorService.latest_event('test_convo_id').event == DoctorServiceOfferEvent.OFFER_PAYMENT_DONE
+
+
+def test_head_rebuilt_from_event_log(client):
+    MongoDBClient.get_doctor_service_offer().insert_one({'convo_id': 'test_convo_id',
+                                                         'user_id': 'test_user_id',
+                                                         'offer_id': 'test_offer_id',
+                                                         'event': 'offer_accepted',
+                                                         'created': datetime(2021, 8, 20)})
+
+    assert DoctorService.latest_event('test_convo_id').event == DoctorServiceOfferEvent.OFFER_ACCEPTED
+    assert MongoDBClient.get_doctor_service_offer_head().find_one({'_id': 'convo:test_convo_id'}) is not None
+
+
+def test_update_event_details_updates_head(client):
+    DoctorService.capture('test_offer_id', 'test_convo_id', 'test_user_id',
+                          DoctorServiceOfferEvent.CAPTURE_STATE, {})
+
+    DoctorService.update_event_details('test_offer_id', DoctorServiceOfferEvent.CAPTURE_STATE, {'state': 'California'})
+
+    assert DoctorService.latest_event('test_convo_id').state == 'California'
+    assert DoctorService.latest_event_by_offer('test_offer_id').state == 'California'
+
+
+def test_retried_ehr_job_does_not_send_twice(client, monkeypatch):
+    sent = []
+    monkeypatch.setattr(DoctorService, 'process_for_ehr', lambda offer_id: sent.append(offer_id))
+
+    DoctorService.capture('offer_id', 'convo_id', 'user_id', DoctorServiceOfferEvent.SEND_TO_EHR, {})
+    DoctorService.process_job_for_ehr('offer_id')
+    assert sent == ['offer_id']
+
+    DoctorService.capture('offer_id', 'convo_id', 'user_id', DoctorServiceOfferEvent.EHR_SENT,
+                          {'ehr_task_id': 'task_id'})
+    DoctorService.process_job_for_ehr('offer_id')
+    assert sent == ['offer_id']
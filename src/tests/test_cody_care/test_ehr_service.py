@@ -1,9 +1,20 @@
+import datetime
 import json
 import os
 
+import pytest
 import requests_mock
 
-from src.rx.ehr_service import EhrService
+from src.rx.ehr_service import EhrService, PrescriberIndex
+from src.utils import MongoDBClient
+
+
+@pytest.fixture(autouse=True)
+def prescribers_cache():
+    MongoDBClient.create_new_mock_instance()
+    EhrService.prescribers_cache.clear()
+    yield EhrService.prescribers_cache
+    EhrService.prescribers_cache.clear()
 
 
 def test_all_supported_state(monkeypatch):
@@ -114,3 +125,121 @@ def test_get_plan(monkeypatch):
                                      start_date='2024-04-01')
 
         assert plan.startswith('PLAN 2: Here is your Certified Plan')
+
+
+def test_prescriber_index():
+    next_year = (datetime.date.today() + datetime.timedelta(days=365)).isoformat()
+    last_year = (datetime.date.today() - datetime.timedelta(days=365)).isoformat()
+    today = datetime.datetime.today()
+
+    index = PrescriberIndex([
+        {'id': 'no_bio', 'roles': ['Prescriber'], 'first_name': 'A', 'last_name': 'B',
+         'licenses': [{'state': 'California', 'expirationDate': next_year}]},
+        {'id': 'expired', 'roles': ['Prescriber'], 'bio': 'Bio',
+         'licenses': [{'state': 'California', 'expirationDate': last_year},
+                      {'state': 'Oregon', 'expirationDate': last_year}]},
+        {'id': 'bio', 'roles': ['Prescriber'], 'bio': 'Bio',
+         'licenses': [{'state': 'California', 'expirationDate': next_year}]},
+        {'id': 'renewed', 'roles': ['Prescriber'], 'bio': 'Bio',
+         'licenses': [{'state': 'Arizona', 'expirationDate': last_year},
+                      {'state': 'Arizona', 'expirationDate': next_year}]},
+        {'id': 'admin', 'roles': ['Admin'],
+         'licenses': [{'state': 'Texas', 'expirationDate': next_year}]},
+    ])
+
+    assert index.supported_states(today) == {'california', 'arizona', 'texas'}
+    # Prescribers with a bio come first, and expired licenses are skipped
+    assert index.match('California', today)['id'] == 'bio'
+    assert index.match('arizona', today)['id'] == 'renewed'
+    assert index.match('Oregon', today) is None
+    assert index.match('Texas', today) is None
+
+
+def test_match_prescriber_does_not_alter_cached_prescribers(monkeypatch):
+    monkeypatch.setenv('AKUTE_API_KEY', 'test_key')
+    monkeypatch.setenv('AKUTE_BASE_URL', 'https://api.staging.akutehealth.com')
+
+    next_year = (datetime.date.today() + datetime.timedelta(days=365)).isoformat()
+    users = [{'id': 'no_bio', 'roles': ['Prescriber'], 'first_name': 'Jane', 'last_name': 'Doe',
+              'licenses': [{'state': 'California', 'expirationDate': next_year}]}]
+
+    with requests_mock.Mocker() as req:
+        mock = req.get('https://api.staging.akutehealth.com/v1/users', json=users)
+
+        prescriber = EhrService().match_prescriber({'state': 'California'})
+        assert prescriber['bio'].startswith('Jane Doe,')
+        assert EhrService().all_supported_state() == {'california'}
+
+        assert 'bio' not in EhrService()._all_prescribers()[0]
+        assert mock.call_count == 1
+
+
+def _users(expiration_date: str, state: str = 'California') -> list[dict]:
+    return [{'id': 'prescriber', 'roles': ['Prescriber'], 'bio': 'Bio',
+             'licenses': [{'state': state, 'expirationDate': expiration_date}]}]
+
+
+def test_prescribers_shared_across_workers(monkeypatch):
+    monkeypatch.setenv('AKUTE_BASE_URL', 'https://api.staging.akutehealth.com')
+    next_year = (datetime.date.today() + datetime.timedelta(days=365)).isoformat()
+
+    with requests_mock.Mocker() as req:
+        mock = req.get('https://api.staging.akutehealth.com/v1/users', json=_users(next_year))
+
+        EhrService.warm_up()
+        assert mock.call_count == 1
+
+        # Another worker booting reads the shared document, instead of calling Akute
+        EhrService.prescribers_cache.clear()
+        EhrService.warm_up()
+        assert EhrService().all_supported_state() == {'california'}
+        assert mock.call_count == 1
+
+    document = MongoDBClient.get_reference_data().find_one({'_id': 'akute_users'})
+    assert document['version'] == 1
+    assert document['data'] == _users(next_year)
+
+
+def test_prescribers_refreshed_ahead_in_background(monkeypatch, prescribers_cache):
+    monkeypatch.setenv('AKUTE_BASE_URL', 'https://api.staging.akutehealth.com')
+    next_year = (datetime.date.today() + datetime.timedelta(days=365)).isoformat()
+    fetched_at = datetime.datetime.now() - datetime.timedelta(hours=21)
+    MongoDBClient.get_reference_data().insert_one({'_id': 'akute_users', 'version': 1, 'fetched_at': fetched_at,
+                                                   'data': _users(next_year)})
+
+    refreshes = []
+    monkeypatch.setattr('src.shared_cache.run_in_background', lambda fn: refreshes.append(fn))
+
+    with requests_mock.Mocker() as req:
+        mock = req.get('https://api.staging.akutehealth.com/v1/users', json=_users(next_year, state='Arizona'))
+
+        # Due data is still served, while it is refreshed in the background
+        assert EhrService().all_supported_state() == {'california'}
+        assert EhrService().all_supported_state() == {'california'}
+        assert mock.call_count == 0
+        assert len(refreshes) == 1
+
+        refreshes[0]()
+        assert mock.call_count == 1
+        assert EhrService().all_supported_state() == {'arizona'}
+        assert prescribers_cache.version == 2
+
+
+def test_prescribers_stale_while_akute_fails(monkeypatch, prescribers_cache):
+    monkeypatch.setenv('AKUTE_BASE_URL', 'https://api.staging.akutehealth.com')
+    next_year = (datetime.date.today() + datetime.timedelta(days=365)).isoformat()
+    fetched_at = datetime.datetime.now() - datetime.timedelta(days=2)
+    MongoDBClient.get_reference_data().insert_one({'_id': 'akute_users', 'version': 1, 'fetched_at': fetched_at,
+                                                   'data': _users(next_year)})
+
+    with requests_mock.Mocker() as req:
+        mock = req.get('https://api.staging.akutehealth.com/v1/users', status_code=500)
+
+        EhrService.warm_up()
+        assert mock.call_count == 1
+        assert EhrService().all_supported_state() == {'california'}
+
+        # The failed refresh is not retried on every read
+        EhrService().all_supported_state()
+        assert mock.call_count == 1
+        assert prescribers_cache.retry_at is not None
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+from langchain.schema import AIMessage, HumanMessage
+
+from src.bot import Bot
+from src.bot_conv_hist import BotConvHist
+from src.bot_lease import ConversationLease
+from src.bot_state import BotState
+from src.conversation_archive import archive_idle_conversations
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+
+def create_conversation(username: str, idle: timedelta):
+    state = BotState(username=username)
+    state.patient_name = 'Jane'
+    state.conv_hist = {'chief_complaint_agent': [AIMessage(content='How can I help?'),
+                                                 HumanMessage(content='Headache ' * 100)]}
+    state.upsert_to_db()
+
+    full_conv_hist = BotConvHist(conversation_id=username)
+    full_conv_hist.full_conv_hist = [{'role': 'assistant', 'content': 'How can I help?'},
+                                     {'role': 'user', 'content': 'Headache ' * 100}]
+    full_conv_hist.upsert_to_db()
+
+    MongoDBClient.get_botstate().update_one({'username': username},
+                                            {'$set': {'last_updated': (datetime.now() - idle).isoformat()}})
+
+
+def test_archive_and_rehydrate(setup):
+    create_conversation('idle', timedelta(days=40))
+    create_conversation('active', timedelta(days=1))
+
+    assert archive_idle_conversations() == {'archived': 1, 'skipped': 0}
+
+    assert MongoDBClient.get_botstate().find_one({'username': 'idle'}) is None
+    assert MongoDBClient.get_full_conv_hist().find_one({'conversation_id': 'idle'}) is None
+    archived = MongoDBClient.get_conversation_archive().find_one({'_id': 'idle'})
+    assert archived['size'] < 900
+    assert archived['dx_counted'] is False
+    assert MongoDBClient.get_botstate().find_one({'username': 'active'}) is not None
+
+    bot = Bot(username='idle')
+
+    assert bot.state.patient_name == 'Jane'
+    assert bot.state.revision == 1
+    assert bot.state.conv_hist['chief_complaint_agent'][1].content == 'Headache ' * 100
+    assert bot.full_conv_hist.full_conv_hist[1] == {'role': 'user', 'content': 'Headache ' * 100}
+    assert MongoDBClient.get_conversation_archive().count_documents({}) == 0
+
+    # The rehydrated conversation carries on as before
+    bot.state.upsert_to_db()
+    assert MongoDBClient.get_botstate().find_one({'username': 'idle'})['revision'] == 2
+
+
+def test_legacy_conversation_is_archived_by_created(setup):
+    create_conversation('legacy', timedelta(days=40))
+    MongoDBClient.get_botstate().update_one({'username': 'legacy'},
+                                            {'$unset': {'last_updated': 1},
+                                             '$set': {'created': (datetime.now() - timedelta(days=40)).isoformat()}})
+    create_conversation('legacy_active', timedelta(days=1))
+    MongoDBClient.get_botstate().update_one({'username': 'legacy_active'}, {'$unset': {'last_updated': 1}})
+
+    assert archive_idle_conversations() == {'archived': 1, 'skipped': 0}
+
+    assert MongoDBClient.get_botstate().find_one({'username': 'legacy'}) is None
+    assert MongoDBClient.get_botstate().find_one({'username': 'legacy_active'}) is not None
+    assert Bot(username='legacy').state.patient_name == 'Jane'
+
+
+def test_conversation_in_use_is_not_archived(setup):
+    create_conversation('idle', timedelta(days=40))
+    lease = ConversationLease.try_acquire('idle')
+
+    assert archive_idle_conversations() == {'archived': 0, 'skipped': 1}
+
+    lease.release()
+    assert archive_idle_conversations() == {'archived': 1, 'skipped': 0}
+
+
+def test_conversation_updated_meanwhile_is_not_archived(setup, monkeypatch):
+    create_conversation('idle', timedelta(days=40))
+
+    def try_acquire(convo_id):
+        # A turn updated the conversation after it was selected
+        MongoDBClient.get_botstate().update_one({'username': convo_id}, {'$inc': {'revision': 1}})
+        return ConversationLease(convo_id, 'owner')
+
+    monkeypatch.setattr(ConversationLease, 'try_acquire', try_acquire)
+
+    assert archive_idle_conversations() == {'archived': 0, 'skipped': 1}
+    assert MongoDBClient.get_botstate().find_one({'username': 'idle'}) is not None
+    assert MongoDBClient.get_full_conv_hist().find_one({'conversation_id': 'idle'}) is not None
+    assert MongoDBClient.get_conversation_archive().count_documents({}) == 0
@@ -212,3 +212,100 @@ def test_release_followup_care_locks(client):
 
 
 
+
+
+def _due_followup(convo_id: str, **fields) -> dict:
+    yesterday = datetime.today() - timedelta(days=1)
+    return {'convo_id': convo_id,
+            'user_id': f'user_{convo_id}',
+            'email_address': f'{convo_id}@email.com',
+            'name': convo_id,
+            'state': 'new',
+            'is_locked': False,
+            'updated': yesterday,
+            'created': yesterday,
+            'next_followup_date': yesterday,
+            **fields}
+
+
+def test_claimed_followups_are_skipped_until_lease_expires(client):
+    from src.followup.followup_care import FollowupCare
+
+    MongoDBClient.get_followup_care().insert_many([
+        _due_followup('claimed', locked_until=datetime.today() + timedelta(minutes=5), lock_owner='other'),
+        _due_followup('expired', locked_until=datetime.today() - timedelta(minutes=5), lock_owner='dead'),
+        _due_followup('free'),
+    ])
+
+    batch = FollowupCare.claim_eligible_convos(limit=10, lease=timedelta(minutes=15))
+
+    assert sorted(followup.convo_id for followup in batch) == ['expired', 'free']
+    assert FollowupCare.claim_eligible_convos(limit=10, lease=timedelta(minutes=15)) == []
+
+
+def test_process_followup_care_in_batches(client, monkeypatch):
+    monkeypatch.setattr(followup_care_scheduler, 'BATCH_SIZE', 2)
+    MongoDBClient.get_followup_care().insert_many([_due_followup(f'convo_{i}') for i in range(5)])
+    followup_care_scheduler.email_sender = Mock()
+
+    process_followup_care()
+
+    assert followup_care_scheduler.email_sender.send_followup_email.call_count == 5
+    for record in MongoDBClient.get_followup_care().find({}):
+        assert record['state'] == 'follow_up_1'
+        assert record['locked_until'] is None
+
+
+def test_failed_followup_is_released_for_retry(client, monkeypatch):
+    monkeypatch.setattr(followup_care_scheduler, 'BATCH_SIZE', 1)
+    MongoDBClient.get_followup_care().insert_many([
+        _due_followup('fails', next_followup_date=datetime.today() - timedelta(days=2)),
+        _due_followup('succeeds'),
+    ])
+
+    def send(email_params):
+        if email_params.convo_id == 'fails':
+            raise Exception('Pinpoint is down')
+
+    followup_care_scheduler.email_sender = Mock()
+    followup_care_scheduler.email_sender.send_followup_email.side_effect = send
+
+    process_followup_care()
+
+    failed = MongoDBClient.get_followup_care().find_one({'convo_id': 'fails'})
+    assert failed['state'] == 'new'
+    assert failed['locked_until'] is None
+    assert failed['send_attempts'] == 1
+    assert failed['last_send_error'] == 'Pinpoint is down'
+    assert failed['next_followup_date'] > datetime.today()
+    # The next batches of the run carry on after the failure
+    assert MongoDBClient.get_followup_care().find_one({'convo_id': 'succeeds'})['state'] == 'follow_up_1'
+    assert followup_care_scheduler.email_sender.send_followup_email.call_count == 2
+
+
+def test_failing_followup_is_dead_lettered(client):
+    from src.followup.followup_care import FollowupCare
+
+    MongoDBClient.get_followup_care().insert_one(
+        _due_followup('fails', send_attempts=FollowupCare.MAX_SEND_ATTEMPTS - 1))
+    followup_care_scheduler.email_sender = Mock()
+    followup_care_scheduler.email_sender.send_followup_email.side_effect = Exception('Pinpoint is down')
+
+    process_followup_care()
+
+    failed = MongoDBClient.get_followup_care().find_one({'convo_id': 'fails'})
+    assert failed['dead_letter'] is True
+    assert failed['send_attempts'] == FollowupCare.MAX_SEND_ATTEMPTS
+    MongoDBClient.get_followup_care().update_one({'convo_id': 'fails'},
+                                                 {'$set': {'next_followup_date': datetime.today()}})
+    assert FollowupCare.claim_eligible_convos(limit=10, lease=timedelta(minutes=15)) == []
+
+
+def test_legacy_locked_followups_are_not_claimed(client):
+    from src.followup.followup_care import FollowupCare
+
+    MongoDBClient.get_followup_care().insert_many([_due_followup('legacy', is_locked=True), _due_followup('free')])
+
+    batch = FollowupCare.claim_eligible_convos(limit=10, lease=timedelta(minutes=15))
+
+    assert [followup.convo_id for followup in batch] == ['free']
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.job_lease import JobLease, leader_only
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+INTERVAL = timedelta(hours=1)
+
+
+def test_job_runs_once_per_interval(setup):
+    runs = []
+    job = leader_only(lambda: runs.append(1), INTERVAL, job_name='job')
+
+    # Other workers firing the job in the same interval skip it.
+    job()
+    job()
+    job()
+
+    assert runs == [1]
+
+    MongoDBClient.get_job_leases().update_one({'_id': 'job'},
+                                              {'$set': {'last_run_at': datetime.now() - INTERVAL}})
+    job()
+    assert runs == [1, 1]
+
+
+def test_job_skipped_while_running_elsewhere(setup):
+    runs = []
+    lease = JobLease.try_acquire('job', INTERVAL)
+
+    leader_only(lambda: runs.append(1), INTERVAL, job_name='job')()
+
+    assert lease is not None
+    assert runs == []
+
+
+def test_dead_holder_is_taken_over(setup):
+    JobLease.try_acquire('job', INTERVAL)
+    MongoDBClient.get_job_leases().update_one({'_id': 'job'},
+                                              {'$set': {'expires_at': datetime.now() - timedelta(seconds=1)}})
+
+    runs = []
+    leader_only(lambda: runs.append(1), INTERVAL, job_name='job')()
+
+    assert runs == [1]
+
+
+def test_failed_job_is_retried_after_a_backoff(setup):
+    def fail():
+        raise ValueError('Failed')
+
+    with pytest.raises(ValueError):
+        leader_only(fail, INTERVAL, job_name='job')()
+
+    # Other workers firing the job right after skip it, until the retry is due
+    runs = []
+    leader_only(lambda: runs.append(1), INTERVAL, job_name='job')()
+    assert runs == []
+
+    lease = MongoDBClient.get_job_leases().find_one({'_id': 'job'})
+    assert lease['failures'] == 1
+    assert lease['last_attempt_at'] is not None
+    assert lease['retry_at'] - lease['last_attempt_at'] == JobLease.RETRY_DELAY
+
+    MongoDBClient.get_job_leases().update_one({'_id': 'job'}, {'$set': {'retry_at': datetime.now()}})
+    with pytest.raises(ValueError):
+        leader_only(fail, INTERVAL, job_name='job')()
+    lease = MongoDBClient.get_job_leases().find_one({'_id': 'job'})
+    assert lease['retry_at'] - lease['last_attempt_at'] == JobLease.RETRY_DELAY * 2
+
+    MongoDBClient.get_job_leases().update_one({'_id': 'job'}, {'$set': {'retry_at': datetime.now()}})
+    leader_only(lambda: runs.append(1), INTERVAL, job_name='job')()
+    assert runs == [1]
+    lease = MongoDBClient.get_job_leases().find_one({'_id': 'job'})
+    assert lease['failures'] == 0
+    assert lease['retry_at'] is None
+
+
+def test_failed_job_backoff_is_bounded_by_the_interval(setup, monkeypatch):
+    monkeypatch.setattr(JobLease, 'RETRY_DELAY', timedelta(hours=2))
+
+    with pytest.raises(ValueError):
+        leader_only(lambda: int('Failed'), INTERVAL, job_name='job')()
+
+    lease = MongoDBClient.get_job_leases().find_one({'_id': 'job'})
+    assert lease['retry_at'] - lease['last_attempt_at'] == INTERVAL
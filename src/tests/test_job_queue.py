@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.job_queue import JobQueue, process_job_queue
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    handlers = {}
+    monkeypatch.setattr(JobQueue, 'handlers', handlers)
+    return handlers
+
+
+def make_due(job_id):
+    MongoDBClient.get_jobs().update_one({'_id': job_id}, {'$set': {'run_at': datetime.now()}})
+
+
+def test_enqueue_is_idempotent(setup, handlers):
+    assert JobQueue.enqueue('job', 'offer:event', {'offer_id': 'offer'})
+    assert not JobQueue.enqueue('job', 'offer:event', {'offer_id': 'offer'})
+
+    assert MongoDBClient.get_jobs().count_documents({}) == 1
+
+
+def test_process_job_queue(setup, handlers):
+    runs = []
+    handlers['job'] = lambda offer_id: runs.append(offer_id)
+    JobQueue.enqueue('job', 'first', {'offer_id': 'first'})
+    JobQueue.enqueue('job', 'second', {'offer_id': 'second'})
+
+    assert process_job_queue() == 2
+    assert sorted(runs) == ['first', 'second']
+    assert JobQueue.stats() == {'pending': 0, 'running': 0, 'done': 2, 'dead': 0}
+
+    # Done jobs never run again
+    assert process_job_queue() == 0
+
+
+def test_failed_job_backs_off_then_dead_letters(setup, handlers, monkeypatch):
+    monkeypatch.setattr(JobQueue, 'MAX_ATTEMPTS', 3)
+
+    def fail(offer_id):
+        raise ValueError('EHR down')
+
+    handlers['job'] = fail
+    JobQueue.enqueue('job', 'offer', {'offer_id': 'offer'})
+
+    assert process_job_queue() == 1
+    job = MongoDBClient.get_jobs().find_one({'_id': 'job:offer'})
+    assert job['status'] == JobQueue.PENDING
+    assert job['attempts'] == 1
+    assert job['last_error'] == 'ValueError: EHR down'
+    assert job['run_at'] > datetime.now() + timedelta(seconds=20)
+
+    # Not due before its backoff
+    assert process_job_queue() == 0
+
+    make_due('job:offer')
+    process_job_queue()
+    job = MongoDBClient.get_jobs().find_one({'_id': 'job:offer'})
+    assert job['run_at'] > datetime.now() + timedelta(seconds=50)
+
+    make_due('job:offer')
+    process_job_queue()
+    job = MongoDBClient.get_jobs().find_one({'_id': 'job:offer'})
+    assert job['status'] == JobQueue.DEAD
+    assert job['attempts'] == 3
+
+    make_due('job:offer')
+    assert process_job_queue() == 0
+
+    handlers['job'] = lambda offer_id: None
+    assert JobQueue.retry('job:offer')
+    assert process_job_queue() == 1
+    assert MongoDBClient.get_jobs().find_one({'_id': 'job:offer'})['status'] == JobQueue.DONE
+
+
+def test_expired_claim_is_claimed_again(setup, handlers):
+    JobQueue.enqueue('job', 'offer', {'offer_id': 'offer'})
+
+    assert len(JobQueue.claim(10)) == 1
+    # Claimed by a worker, which died
+    assert JobQueue.claim(10) == []
+
+    MongoDBClient.get_jobs().update_one({'_id': 'job:offer'},
+                                        {'$set': {'locked_until': datetime.now() - timedelta(seconds=1)}})
+    jobs = JobQueue.claim(10)
+    assert [job['_id'] for job in jobs] == ['job:offer']
+
+
+def test_unknown_job_type_fails(setup, handlers):
+    JobQueue.enqueue('unknown', 'offer', {'offer_id': 'offer'})
+
+    process_job_queue()
+
+    job = MongoDBClient.get_jobs().find_one({'_id': 'unknown:offer'})
+    assert job['status'] == JobQueue.PENDING
+    assert job['last_error'] == 'No handler registered for job type unknown'
@@ -0,0 +1,121 @@
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.collection import Collection
+
+from src.migration import Migration, MigrationRunner
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+from update_diagonis_list import DiagnosisListMigration
+from update_feedback import FeedbackRatingMigration
+
+START = datetime(2023, 10, 1)
+
+
+class DoubleMigration(Migration):
+    name = 'double'
+    partition_size = timedelta(days=1)
+
+    def __init__(self, fail_on: int = None):
+        self.fail_on = fail_on
+
+    def collection(self) -> Collection:
+        return MongoDBClient.get_botstate()
+
+    def query(self) -> dict:
+        return {'value': {'$exists': True}}
+
+    def migrate(self, record: dict) -> Optional[dict]:
+        if record['value'] == self.fail_on:
+            raise ValueError('Failed')
+        return {'doubled': record['value'] * 2} if record['value'] % 3 != 0 else None
+
+
+def insert_records(count: int = 10):
+    MongoDBClient.get_botstate().insert_many([
+        {'username': f'convo-{index}', 'value': index,
+         # Two records a day
+         'created': (START + timedelta(days=index // 2, hours=index)).isoformat()}
+        for index in range(count)
+    ])
+
+
+def test_migration_runner(setup):
+    insert_records()
+
+    metrics = MigrationRunner(DoubleMigration(), workers=3, chunk_size=1, dry_run=False).run()
+
+    assert metrics['scanned'] == 10
+    assert metrics['changed'] == 6
+    assert metrics['failed_partitions'] == []
+    for record in MongoDBClient.get_botstate().find({}):
+        assert record.get('doubled') == (record['value'] * 2 if record['value'] % 3 != 0 else None)
+    assert MongoDBClient.get_migration_checkpoints().count_documents({'done': True}) == 5
+
+
+def test_dry_run_writes_diff_only(setup, tmp_path):
+    insert_records(4)
+    diff_path = tmp_path / 'diff.jsonl'
+
+    metrics = MigrationRunner(DoubleMigration(), dry_run=True, diff_path=str(diff_path)).run()
+
+    assert metrics['changed'] == 2
+    assert MongoDBClient.get_botstate().count_documents({'doubled': {'$exists': True}}) == 0
+    assert MongoDBClient.get_migration_checkpoints().count_documents({}) == 0
+    diffs = sorted((json.loads(line) for line in diff_path.read_text().splitlines()),
+                   key=lambda diff: diff['after']['doubled'])
+    assert [(diff['before'], diff['after']) for diff in diffs] == [({'doubled': None}, {'doubled': 2}),
+                                                                   ({'doubled': None}, {'doubled': 4})]
+
+
+def test_failed_partition_resumes_from_checkpoint(setup):
+    insert_records()
+
+    metrics = MigrationRunner(DoubleMigration(fail_on=5), chunk_size=1, dry_run=False).run()
+
+    # Records 4 and 5 are in the third partition, which stopped after record 4
+    assert metrics['failed_partitions'] == [str(START + timedelta(days=2))]
+    assert MongoDBClient.get_botstate().find_one({'value': 4})['doubled'] == 8
+    assert 'doubled' not in MongoDBClient.get_botstate().find_one({'value': 5})
+
+    metrics = MigrationRunner(DoubleMigration(), chunk_size=1, dry_run=False).run()
+
+    # Only the rest of the failed partition is migrated again
+    assert metrics['scanned'] == 1
+    assert MongoDBClient.get_botstate().find_one({'value': 5})['doubled'] == 10
+
+
+def test_feedback_migration(setup):
+    MongoDBClient.get_botstate().insert_many([
+        {'username': 'rated', 'conv_hist': {'feedback_agent': [{'role': 'assistant', 'content': 'Rate us'},
+                                                               {'role': 'user', 'content': 'great'},
+                                                               {'role': 'user', 'content': '7'}]}},
+        {'username': 'unrated', 'conv_hist': {'feedback_agent': [{'role': 'assistant', 'content': 'Rate us'},
+                                                                 {'role': 'user', 'content': 'no'}]}},
+    ])
+
+    metrics = MigrationRunner(FeedbackRatingMigration(), dry_run=False).run()
+
+    assert metrics['changed'] == 1
+    assert MongoDBClient.get_botstate().find_one({'username': 'rated'})['feedback_rating'] == 5
+    assert 'feedback_rating' not in MongoDBClient.get_botstate().find_one({'username': 'unrated'})
+
+
+def test_diagnosis_list_migration(setup, tmp_path):
+    exceptions_path = tmp_path / 'exceptions.csv'
+    MongoDBClient.get_botstate().insert_many([
+        {'username': 'diagnosed', 'created': '2023-05-01T00:00:00',
+         'conv_hist': {'diagnosis_agent': [
+             {'role': 'assistant', 'content': 'Based on what you told me:\n1. Gastritis (60% probability)\n'
+                                              '2. Ulcer (40% probability)'}]}},
+        {'username': 'other', 'created': '2023-05-02T00:00:00',
+         'conv_hist': {'diagnosis_agent': [{'role': 'assistant', 'content': 'Hello'}]}},
+    ])
+
+    MigrationRunner(DiagnosisListMigration(), dry_run=False, exceptions_path=str(exceptions_path)).run()
+
+    assert MongoDBClient.get_botstate().find_one({'username': 'diagnosed'})['diagnosis_list'] == ['GASTRITIS',
+                                                                                                   'ULCER']
+    assert 'diagnosis_list' not in MongoDBClient.get_botstate().find_one({'username': 'other'})
+    assert 'other,Does not look like diagnosis response' in exceptions_path.read_text()
@@ -0,0 +1,96 @@
+"""
+Runs the queries of the repository through explain() against a real mongod, and fails on collection scans.
+
+mongomock has no query planner, so the harness only runs with MONGO_EXPLAIN_URI pointing to a local mongod,
+e.g. MONGO_EXPLAIN_URI=mongodb://localhost:27017 python -m pytest src/tests/test_query_plans.py
+"""
+
+import os
+from datetime import datetime
+
+import pymongo
+import pytest
+
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+NOW = datetime.now()
+
+# (collection, filter, sort) of the hot queries of the repository
+QUERIES = [
+    ('collection', {'username': 'convo'}, None),
+    ('collection', {'analytics_state': {'$ne': 'PROCESSED'}, 'created': {'$lte': NOW.isoformat()}}, None),
+    ('collection', {'conv_hist.magic_minute_agent': {'$exists': True, '$ne': []}, 'created': {'$gte': NOW.isoformat()}},
+     [('created', 1)]),
+    ('collection', {'last_updated': {'$lt': NOW.isoformat()}}, [('last_updated', 1)]),
+    ('collection', {'last_updated': None, 'created': {'$lt': NOW.isoformat()}}, [('created', 1)]),
+    ('full_conv_hist', {'conversation_id': 'convo'}, None),
+    ('diagnosis_mapping', {'diagnosis': 'GASTRITIS'}, None),
+    ('diagnosis_mapping', {}, [('created', -1), ('_id', -1)]),
+    ('diagnosis_mapping', {'source': 'llm'}, [('created', -1), ('_id', -1)]),
+    ('ATS', {'username': 'convo'}, None),
+    ('followup_care', {'convo_id': 'convo'}, None),
+    ('followup_care', {'email_address': 'test@test.com', 'state': {'$nin': ['opted_out']}}, [('created', -1)]),
+    ('followup_care', {'state': {'$nin': ['opted_out', 'completed']}, 'next_followup_date': {'$lte': NOW},
+                       'is_locked': {'$ne': True}, 'dead_letter': {'$ne': True},
+                       '$or': [{'locked_until': None}, {'locked_until': {'$lt': NOW}}]}, [('next_followup_date', 1)]),
+    ('convo_analytics', {'convo_id': 'convo'}, None),
+    ('sessions', {'ai_session': {'$in': ['convo']}}, None),
+    ('users', {'email': 'test@test.com'}, None),
+    ('doctor_service_offer', {'convo_id': 'convo'}, [('created', -1)]),
+    ('doctor_service_offer', {'offer_id': 'offer'}, [('created', -1)]),
+    ('doctor_service_offer', {'offer_id': 'offer', 'event': 'ehr_sent'}, [('created', -1)]),
+    ('doctor_service_offer', {'ehr_task_id': 'task', 'event': 'ehr_sent'}, None),
+    ('stream_events', {'convo_id': 'convo', 'turn': 1, 'seq': {'$gt': 0}}, [('seq', 1)]),
+    ('stream_events', {'convo_id': 'convo'}, [('turn', -1)]),
+    ('email_outbox', {'$or': [{'status': 'pending', 'next_attempt_at': {'$lte': NOW}},
+                              {'status': 'sending', 'locked_until': {'$lt': NOW}}]}, [('created', 1)]),
+    ('jobs', {'$or': [{'status': 'pending', 'run_at': {'$lte': NOW}},
+                      {'status': 'running', 'locked_until': {'$lt': NOW}}]}, [('run_at', 1)]),
+]
+
+
+def _stages(plan: dict):
+    yield plan.get('stage')
+    for key in ['inputStage', 'queryPlan']:
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from _stages(child)
+
+
+@pytest.fixture(scope='module')
+def explain_db():
+    uri = os.getenv('MONGO_EXPLAIN_URI')
+    if not uri:
+        pytest.skip('MONGO_EXPLAIN_URI is not set')
+
+    client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=2000)
+    db = client['query_plans_test']
+    client.drop_database(db.name)
+    MongoDBClient.ensure_indexes(db)
+    yield db
+    client.drop_database(db.name)
+    client.close()
+
+
+@pytest.mark.parametrize('collection, filter_, sort', QUERIES)
+def test_query_uses_index(explain_db, collection, filter_, sort):
+    cursor = explain_db[collection].find(filter_)
+    if sort:
+        cursor = cursor.sort(sort)
+
+    plan = cursor.explain()['queryPlanner']['winningPlan']
+
+    assert 'COLLSCAN' not in set(_stages(plan)), f'{collection} {filter_} scans the collection: {plan}'
+
+
+def test_ensure_indexes(setup):
+    MongoDBClient.ensure_indexes()
+    MongoDBClient.ensure_indexes()
+
+    index_keys = [index['key'] for index in MongoDBClient.get_doctor_service_offer().list_indexes()]
+    assert {'offer_id': 1, 'event': 1, 'created': -1} in [dict(key) for key in index_keys]
+
+    stream_events_indexes = list(MongoDBClient.get_stream_events().list_indexes())
+    assert any(index.get('expireAfterSeconds') == 600 for index in stream_events_indexes)
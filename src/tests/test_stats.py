@@ -0,0 +1,68 @@
+from src.bot import Bot
+from src.stats import STATS_ID, counts_as_dx, reconcile_stats
+from src.tests.utils import setup
+from src.utils import MongoDBClient
+
+
+def test_counts_as_dx():
+    assert counts_as_dx('concierge_agent')
+    assert not counts_as_dx('chief_complaint_agent')
+    assert not counts_as_dx('')
+    assert not counts_as_dx(None)
+
+
+def test_dx_count_incremented_once_per_convo(setup):
+    bot = Bot(username='convo-stats')
+
+    bot.state.current_agent_name = 'name_enquiry_agent'
+    bot.update_conv()
+    assert MongoDBClient.get_stats().find_one({'_id': STATS_ID}) is None
+
+    bot.state.current_agent_name = 'concierge_agent'
+    bot.update_conv()
+    bot.update_conv()
+    assert MongoDBClient.get_stats().find_one({'_id': STATS_ID})['dxCount'] == 1
+
+    # The conversation stays counted when reloaded
+    bot = Bot(username='convo-stats')
+    bot.update_conv()
+    assert MongoDBClient.get_stats().find_one({'_id': STATS_ID})['dxCount'] == 1
+
+
+def test_reconcile_stats(setup):
+    MongoDBClient.get_stats().insert_one({'dxCount': 3})
+    MongoDBClient.get_stats().insert_one({'_id': STATS_ID, 'dxCount': 7})
+    MongoDBClient.get_botstate().insert_many([
+        {'username': 'counted', 'dx_counted': True, 'current_agent_name': 'chief_complaint_agent'},
+        {'username': 'before-dx-counted', 'current_agent_name': 'diagnosis_agent'},
+        {'username': 'intake', 'dx_counted': False, 'current_agent_name': 'chief_complaint_agent'},
+        {'username': 'empty', 'current_agent_name': ''},
+        {'username': 'new'},
+    ])
+    MongoDBClient.get_conversation_archive().insert_many([
+        {'_id': 'archived', 'dx_counted': True},
+        {'_id': 'archived-intake', 'dx_counted': False},
+    ])
+    # Not counted from the legacy collection anymore
+    MongoDBClient.get_chat_conversation().insert_one({'servicing_agent': 'concierge_agent'})
+
+    reconcile_stats()
+
+    assert list(MongoDBClient.get_stats().find()) == [{'_id': STATS_ID, 'dxCount': 3}]
+
+
+def test_reconcile_stats_matches_incremental_count(setup):
+    for username, agent_name in [('a', 'concierge_agent'), ('b', 'name_enquiry_agent'), ('c', 'diagnosis_agent')]:
+        bot = Bot(username=username)
+        bot.state.current_agent_name = agent_name
+        bot.update_conv()
+    # Going back to an intake agent does not uncount the conversation
+    bot = Bot(username='a')
+    bot.state.current_agent_name = 'chief_complaint_agent'
+    bot.update_conv()
+
+    incremented = MongoDBClient.get_stats().find_one({'_id': STATS_ID})['dxCount']
+    reconcile_stats()
+
+    assert incremented == 2
+    assert MongoDBClient.get_stats().find_one({'_id': STATS_ID})['dxCount'] == 2
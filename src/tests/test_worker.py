@@ -0,0 +1,27 @@
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from src.background import run_in_background
+from src.worker import register_jobs
+
+
+def test_register_jobs():
+    scheduler = BackgroundScheduler()
+
+    register_jobs(scheduler)
+
+    assert sorted(job.name for job in scheduler.get_jobs()) == ['EhrService.refresh_reference_data',
+                                                                'archive_idle_conversations',
+                                                                'dispatch_email_outbox', 'process_conversations',
+                                                                'process_followup_care', 'process_job_queue',
+                                                                'reconcile_stats', 'run_ats_on_recent_convs']
+
+
+def test_run_in_background():
+    assert run_in_background(lambda x: x * 2, 21).result(1) == 42
+
+
+def test_run_in_background_logs_failures():
+    def fail():
+        raise ValueError('Failed')
+
+    assert run_in_background(fail).result(1) is None
@@ -4,6 +4,7 @@ import os, json
 import pytest
 
 from src.bot import Bot
+from src.dx_mapping import DxMapping
 from src.utils import fake_llm, MongoDBClient
 
 
@@ -18,6 +19,7 @@ def setup_code():
     MongoDBClient.create_new_mock_instance()
 
     fake_llm.clear()
+    DxMapping.invalidate()
 
     # Drop the collections before each test
     MongoDBClient().client.db.drop_collection('collection')
@@ -72,7 +74,8 @@ def compare_state_dicts(initial_bot_state, final_bot_state):
     for key in initial_bot_state.keys():
         if key in ['engagement_minutes', 'last_updated',
                    'timeouts', 'prompt_tokens', 'completion_tokens',
-                   'successful_requests', 'total_cost', 'max_token_count', 'conv_train_msgs']:
+                   'successful_requests', 'total_cost', 'max_token_count', 'conv_train_msgs', 'revision',
+                   'dx_counted']:
             continue
         else:
             assert initial_bot_state[key] == final_bot_state[key], \
@@ -1,4 +1,5 @@
 import logging
+import math
 import os
 import re
 import sys
@@ -9,8 +10,10 @@ import ecs_logging
 import pymongo
 from langchain.llms.base import LLM
 from openai.error import Timeout as OpenAITimeout
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from pymongo.collection import Collection
 from pymongo.database import Database
+from pymongo.errors import OperationFailure
 
 from src.specialist import Specialist
 from src.sub_specialist import SubSpecialtyDxGroup
@@ -76,6 +79,60 @@ class MongoDBClient:
 
     _instance = None
 
+    # Indexes of every collection, by collection name, serving the queries of the repository.
+    # They are created by ensure_indexes, run by the worker at startup, by the web app with ENSURE_INDEXES=true,
+    # or by `python ensure_indexes.py`.
+    INDEXES: dict[str, list[IndexModel]] = {
+        'collection': [
+            IndexModel([('username', ASCENDING)]),
+            IndexModel([('created', ASCENDING)]),
+            # Also serves the legacy conversations without last_updated, by created
+            IndexModel([('last_updated', ASCENDING), ('created', ASCENDING)]),
+        ],
+        'full_conv_hist': [
+            IndexModel([('conversation_id', ASCENDING)]),
+        ],
+        'diagnosis_mapping': [
+            IndexModel([('diagnosis', ASCENDING)]),
+            IndexModel([('created', DESCENDING), ('_id', DESCENDING)]),
+        ],
+        'ATS': [
+            IndexModel([('username', ASCENDING)]),
+        ],
+        'followup_care': [
+            IndexModel([('convo_id', ASCENDING)]),
+            IndexModel([('email_address', ASCENDING), ('state', ASCENDING), ('created', DESCENDING)]),
+            IndexModel([('state', ASCENDING), ('next_followup_date', ASCENDING), ('locked_until', ASCENDING)]),
+        ],
+        'convo_analytics': [
+            IndexModel([('convo_id', ASCENDING)]),
+        ],
+        'sessions': [
+            IndexModel([('ai_session', ASCENDING)]),
+        ],
+        'users': [
+            IndexModel([('email', ASCENDING)]),
+        ],
+        'doctor_service_offer': [
+            IndexModel([('convo_id', ASCENDING), ('created', DESCENDING)]),
+            IndexModel([('offer_id', ASCENDING), ('event', ASCENDING), ('created', DESCENDING)]),
+            IndexModel([('ehr_task_id', ASCENDING), ('event', ASCENDING)]),
+        ],
+        'stream_events': [
+            IndexModel([('created', ASCENDING)], expireAfterSeconds=int(os.getenv('STREAM_REPLAY_TTL', '600'))),
+            IndexModel([('convo_id', ASCENDING), ('turn', ASCENDING), ('seq', ASCENDING)]),
+        ],
+        'email_outbox': [
+            IndexModel([('status', ASCENDING), ('next_attempt_at', ASCENDING)]),
+            IndexModel([('status', ASCENDING), ('locked_until', ASCENDING)]),
+            IndexModel([('created', ASCENDING)]),
+        ],
+        'jobs': [
+            IndexModel([('status', ASCENDING), ('run_at', ASCENDING)]),
+            IndexModel([('status', ASCENDING), ('locked_until', ASCENDING)]),
+        ],
+    }
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
@@ -103,6 +160,20 @@ class MongoDBClient:
     def get_db(cls) -> Database:
         return cls().client['bot_state_db']
 
+    @classmethod
+    def ensure_indexes(cls, db: Database = None) -> None:
+        """
+        Creates the declared indexes which do not exist yet. An index conflicting with an existing one is logged
+        and skipped, so that it can be migrated by hand.
+        """
+        db = db if db is not None else cls.get_db()
+        for collection_name, indexes in cls.INDEXES.items():
+            try:
+                db[collection_name].create_indexes(indexes)
+            except OperationFailure as e:
+                logging.error(f'Error creating indexes of collection {collection_name}', exc_info=e)
+        logging.info(f'Ensured indexes of {len(cls.INDEXES)} collections')
+
     @classmethod
     def get_botstate(cls) -> Collection:
         return cls.get_db()['collection']
@@ -151,6 +222,57 @@ class MongoDBClient:
     def get_doctor_service_offer(cls):
         return cls.get_db()['doctor_service_offer']
 
+    @classmethod
+    def get_doctor_service_offer_head(cls) -> Collection:
+        return cls.get_db()['doctor_service_offer_head']
+
+    @classmethod
+    def get_stream_events(cls) -> Collection:
+        return cls.get_db()['stream_events']
+
+    @classmethod
+    def get_conversation_leases(cls) -> Collection:
+        return cls.get_db()['conversation_leases']
+
+    @classmethod
+    def get_job_leases(cls) -> Collection:
+        return cls.get_db()['job_leases']
+
+    @classmethod
+    def get_email_outbox(cls) -> Collection:
+        return cls.get_db()['email_outbox']
+
+    @classmethod
+    def get_reference_data(cls) -> Collection:
+        return cls.get_db()['reference_data']
+
+    @classmethod
+    def get_job_watermarks(cls) -> Collection:
+        return cls.get_db()['job_watermarks']
+
+    @classmethod
+    def get_jobs(cls) -> Collection:
+        return cls.get_db()['jobs']
+
+    @classmethod
+    def get_migration_checkpoints(cls) -> Collection:
+        return cls.get_db()['migration_checkpoints']
+
+    @classmethod
+    def get_conversation_archive(cls) -> Collection:
+        return cls.get_db()['conversation_archive']
+
+
+EARTH_RADIUS_KM = 6371.0
+# Length of a degree of latitude, and of longitude at the equator
+KM_PER_DEGREE = 111.0
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
 
 def map_url_name(character: str) -> Tuple[Specialist, SubSpecialtyDxGroup]:
     # First check for sub-speciality
@@ -164,40 +286,6 @@ def map_url_name(character: str) -> Tuple[Specialist, SubSpecialtyDxGroup]:
     return specialist, dx_group
 
 
-def refresh_view():
-    MongoDBClient.get_chat_conversation().aggregate([
-        {
-            "$match": {
-                "servicing_agent": {
-                    "$nin": [
-                        "",
-                        "chief_complaint_agent",
-                        "followup_agent",
-                        "name_enquiry_agent"
-                    ]
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": {},
-                "dxCount": {
-                    "$sum": 1
-                }
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "dxCount": 1
-            }
-        },
-        {
-            "$out": "Stats"
-        }
-    ])
-
-
 def base_url():
     if os.getenv('ENVIRONMENT', 'dev') == 'production':
         return "https://cody.md/"
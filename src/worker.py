@@ -0,0 +1,75 @@
+"""
+Background worker, which owns the scheduled jobs, so that they do not compete with /ask in the web workers.
+
+    python -m src.worker
+
+Run it next to the web app started with IN_PROCESS_SCHEDULER=false. It ensures the mongo indexes at startup.
+WORKER_JOB_THREADS bounds how many jobs run at once. Jobs keep their cluster-wide leases, so running several workers
+is safe.
+"""
+
+import logging
+import os
+from datetime import timedelta
+
+import dotenv
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.base import BaseScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from src.analytics.analytics_scheduler import process_conversations
+from src.ats.scheduler import run_ats_on_recent_convs
+from src.conversation_archive import archive_idle_conversations
+from src.followup.followup_care_scheduler import process_followup_care
+from src.job_lease import leader_only
+from src.job_queue import process_job_queue
+from src.notifications.email_outbox import dispatch_email_outbox
+# Registers the handlers of the EHR jobs
+from src.rx.doctor_service import DoctorService  # noqa: F401
+from src.rx.ehr_service import EhrService
+from src.stats import reconcile_stats
+from src.utils import MongoDBClient
+
+
+def register_jobs(scheduler: BaseScheduler) -> None:
+    # Every process may schedule the jobs, but each run happens in a single process of the cluster.
+    scheduler.add_job(leader_only(reconcile_stats, timedelta(hours=6)), 'interval', hours=6, max_instances=1)
+    scheduler.add_job(leader_only(run_ats_on_recent_convs, timedelta(hours=1)), 'interval', hours=1, max_instances=1)
+    scheduler.add_job(leader_only(process_followup_care, timedelta(hours=1)), 'interval', hours=1, max_instances=1)
+    scheduler.add_job(leader_only(process_conversations, timedelta(hours=1)), 'interval', hours=1, max_instances=1)
+    scheduler.add_job(leader_only(dispatch_email_outbox, timedelta(seconds=30)), 'interval', seconds=30,
+                      max_instances=1)
+    # Only calls Akute once the shared reference data is due, so that it is refreshed even when nobody reads it.
+    scheduler.add_job(leader_only(EhrService.refresh_reference_data, timedelta(hours=1)), 'interval', hours=1,
+                      max_instances=1)
+    scheduler.add_job(leader_only(archive_idle_conversations, timedelta(hours=6)), 'interval', hours=6,
+                      max_instances=1)
+    # Not leader only, every process consumes the job queue, as each job is claimed with a lease.
+    scheduler.add_job(process_job_queue, 'interval', seconds=int(os.getenv('JOB_QUEUE_POLL_SECONDS', '5')),
+                      max_instances=1)
+
+
+def main():
+    dotenv.load_dotenv()
+
+    # Logs to stdout with the ECS handler of src.utils, like the web app. The scheduler logs every run at INFO.
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger('apscheduler').level = logging.WARN
+
+    MongoDBClient.ensure_indexes()
+    EhrService.warm_up()
+
+    scheduler = BlockingScheduler(executors={
+        'default': ThreadPoolExecutor(int(os.getenv('WORKER_JOB_THREADS', '4')))
+    })
+    register_jobs(scheduler)
+
+    logging.info('Starting background worker')
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        logging.info('Background worker stopped')
+
+
+if __name__ == '__main__':
+    main()
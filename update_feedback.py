@@ -1,57 +1,47 @@
 import logging
+from typing import Optional
 
-from src.utils import MongoDBClient
-
-logging.getLogger().setLevel(logging.INFO)
-
-dry_run = True
-
-
-def init():
-    # conv_hist.diagnosis_agent is array and need to check if it has elements
+from pymongo.collection import Collection
 
-    query = {'conv_hist.feedback_agent': {'$exists': True, '$ne': [], '$not': {'$size': 1}},
-             'feedback_rating': {'$exists': False},
-             }
-
-    documents = MongoDBClient.get_botstate().count_documents(query)
-
-    logging.info("Total documents to be processed: ", documents)
-
-    find_all = MongoDBClient.get_botstate().find(query)
+from src.migration import Migration, main
+from src.utils import MongoDBClient
 
-    for record in find_all:
 
-        agent_ = record.get('conv_hist').get('feedback_agent')
-        for message in agent_:
-            # find first human message
-            if message.get('role') == 'user':
-                logging.info("Human response for conversation ID: " + record.get('username') + " is: " + message.get(
-                    'content'))
+class FeedbackRatingMigration(Migration):
+    """
+    Parses the feedback rating of conversations from the answers to the feedback agent.
+    """
+    name = 'update_feedback'
+    # Covers the conversations without a created date too
+    partition_field = '_id'
+    projection = {'username': 1, 'feedback_rating': 1, 'conv_hist.feedback_agent': 1}
 
-                try:
-                    rating = int(round(float(message.get('content'))))
+    def collection(self) -> Collection:
+        return MongoDBClient.get_botstate()
 
-                    if rating > 5:
-                        logging.info(
-                            f"Rating {rating} is greater than 5. Adjusting to 5.")
-                        rating = 5
+    def query(self) -> dict:
+        return {'conv_hist.feedback_agent': {'$exists': True, '$ne': [], '$not': {'$size': 1}},
+                'feedback_rating': {'$exists': False}}
 
-                    record['feedback_rating'] = rating
+    def migrate(self, record: dict) -> Optional[dict]:
+        rating = None
+        # The latest human response which is a rating wins
+        for message in record['conv_hist']['feedback_agent']:
+            if message.get('role') != 'user':
+                continue
 
-                    if not dry_run:
-                        logging.info("Updating feedback rating to " + str(rating) + " for conversation ID: " + record.get(
-                            'username'))
+            try:
+                rating = int(round(float(message.get('content'))))
+            except ValueError:
+                logging.info(f"Could not parse {message.get('content')} as a number. Skipping feedback rating.")
+                continue
 
-                        MongoDBClient.get_botstate().update_one({'_id': record.get('_id')},
-                                                                {'$set': {'feedback_rating': rating}})
-                    else:
-                        logging.info("DRY RUN: feedback rating to " + str(rating) + " for conversation ID: " + record.get(
-                            'username'))
+            if rating > 5:
+                logging.info(f"Rating {rating} is greater than 5. Adjusting to 5.")
+                rating = 5
 
-                except ValueError:
-                    logging.info(
-                        f"Could not parse {message.get('content')} as a number. Skipping feedback rating.")
+        return {'feedback_rating': rating} if rating is not None else None
 
 
-init()
+if __name__ == '__main__':
+    main(FeedbackRatingMigration())